@@ -39,7 +39,20 @@ export class TrifectaCdkStack extends cdk.Stack {
       throw new Error('PRIVATE_KEY is not set');
     }
 
-    const bucket = new s3.Bucket(this, 'TrifectaBucket');
+    const bucket = new s3.Bucket(this, 'TrifectaBucket', {
+      lifecycleRules: [
+        {
+          // Shared generated lessons, see LESSON_CACHE_TTL_SECONDS in generate.py
+          prefix: 'lessons/',
+          expiration: Duration.days(30),
+        },
+        {
+          // Lesson payloads handed from generate to send_message
+          prefix: 'deliveries/',
+          expiration: Duration.days(1),
+        },
+      ],
+    });
     const coreTable = new Table(this, 'TrifectaCoreTable', {
       partitionKey: { name: 'PK', type: AttributeType.STRING },
       sortKey: { name: 'SK', type: AttributeType.STRING },
@@ -213,7 +226,8 @@ export class TrifectaCdkStack extends cdk.Stack {
     }
 
     const processContentFunction = new DockerImageFunction(this, 'TrifectaProcessContentFunction', {
-      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine/process_content', {
+      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine', {
+        file: 'process_content/Dockerfile',
         platform: Platform.LINUX_AMD64
       }),
       environment: environmentVariables,
@@ -224,7 +238,8 @@ export class TrifectaCdkStack extends cdk.Stack {
     bucket.grantReadWrite(processContentFunction);
 
     const generateFunction = new DockerImageFunction(this, 'TrifectaGenerateFunction', {
-      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine/generate', {
+      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine', {
+        file: 'generate/Dockerfile',
         platform: Platform.LINUX_AMD64
       }),
       environment: environmentVariables,
@@ -233,8 +248,27 @@ export class TrifectaCdkStack extends cdk.Stack {
     coreTable.grantReadWriteData(generateFunction);
     bucket.grantReadWrite(generateFunction);
 
+    // Same image as generate, fills the lesson cache at the other difficulties.
+    // Opt-in: each variant is two more model calls on the rate limit live lessons share
+    const fanOutDifficulties = process.env.FAN_OUT_DIFFICULTIES ?? '';
+    const generateVariantsFunction = fanOutDifficulties ? new DockerImageFunction(this, 'TrifectaGenerateVariantsFunction', {
+      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine', {
+        file: 'generate/Dockerfile',
+        platform: Platform.LINUX_AMD64,
+        cmd: ['generate.variants_handler']
+      }),
+      environment: { ...environmentVariables, FAN_OUT_DIFFICULTIES: fanOutDifficulties },
+      timeout: Duration.minutes(10),
+    }) : undefined;
+    if (generateVariantsFunction) {
+      // The OpenAI rate limit buckets live in the core table
+      coreTable.grantReadWriteData(generateVariantsFunction);
+      bucket.grantReadWrite(generateVariantsFunction);
+    }
+
     const generateAgentFirstMessageFunction = new DockerImageFunction(this, 'TrifectaGenerateAgentFirstMessageFunction', {
-      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine/generate_agent_first_message', {
+      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine', {
+        file: 'generate_agent_first_message/Dockerfile',
         platform: Platform.LINUX_AMD64
       }),
       environment: environmentVariables,
@@ -244,13 +278,33 @@ export class TrifectaCdkStack extends cdk.Stack {
     bucket.grantReadWrite(generateAgentFirstMessageFunction);
 
     const sendMessageFunction = new DockerImageFunction(this, 'TrifectaSendMessageFunction', {
-      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine/send_message', {
+      code: DockerImageCode.fromImageAsset('lib/lambda/state-machine', {
+        file: 'send_message/Dockerfile',
         platform: Platform.LINUX_AMD64
       }),
       environment: environmentVariables,
       timeout: Duration.minutes(5),
     });
     websocketApi.grantManageConnections(sendMessageFunction);
+    // Reads and writes the first-message signal that orders the two branches
+    coreTable.grantReadWriteData(sendMessageFunction);
+    bucket.grantRead(sendMessageFunction);
+
+    const sendGeneratedMessage = new tasks.LambdaInvoke(this, 'SendGeneratedMessage', {
+      lambdaFunction: sendMessageFunction,
+      payloadResponseOnly: true,
+      inputPath: '$.lesson'
+    });
+    const deliverLesson = generateVariantsFunction
+      ? new sfn.Parallel(this, 'DeliverLesson')
+        .branch(sendGeneratedMessage)
+        .branch(new tasks.LambdaInvoke(this, 'GenerateVariants', {
+          lambdaFunction: generateVariantsFunction,
+          payloadResponseOnly: true
+        })
+          // Variants are only a head start, never fail the learner's execution over them
+          .addCatch(new sfn.Pass(this, 'SkipVariants')))
+      : sendGeneratedMessage;
 
     // State Machine - start with a start step, then splits into parallel steps
     const stateMachine = new StateMachine(this, 'TrifectaStateMachine', {
@@ -263,12 +317,11 @@ export class TrifectaCdkStack extends cdk.Stack {
           })
             .next(new tasks.LambdaInvoke(this, 'Generate', {
               lambdaFunction: generateFunction,
-              payloadResponseOnly: true
-            }))
-            .next(new tasks.LambdaInvoke(this, 'SendGeneratedMessage', {
-              lambdaFunction: sendMessageFunction,
-              payloadResponseOnly: true
+              payloadResponseOnly: true,
+              // Keep the transcription for the variants next to the lesson
+              resultPath: '$.lesson'
             }))
+            .next(deliverLesson)
         )
         .branch(
           // Websocket Communication Branch
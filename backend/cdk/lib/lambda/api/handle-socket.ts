@@ -20,15 +20,28 @@ interface IncomingMessage {
   id: string,
 }
 
+// API Gateway closes WebSocket connections after 2 hours, keep a margin on top
+const CONNECTION_TTL_SECONDS = 3 * 60 * 60;
+
 const handleConnectSetup = async (connectionId: string, userId: string) => {
   console.log(`Connection established: ${connectionId}`);
+  const ttl = Math.floor(Date.now() / 1000) + CONNECTION_TTL_SECONDS;
   try {
+    // Latest connection for the user, read by the pay-student notification
     await putItem<Connection>({
       PK: `USER`,
       SK: `CONNECTION#${userId}`,
       connectionId,
       userId,
     }, TABLE_NAME, docClient)
+    // One item per open connection so lessons reach every tab and device
+    await putItem<Connection>({
+      PK: `USER`,
+      SK: `CONNECTION#${userId}#${connectionId}`,
+      connectionId,
+      userId,
+      ttl,
+    }, TABLE_NAME, docClient)
     console.log('Connection setup complete');
   } catch (error) {
     console.error('Error connecting to WebSocket', error);
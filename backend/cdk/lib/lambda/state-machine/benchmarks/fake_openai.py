@@ -0,0 +1,287 @@
+"""Deterministic local stand-in for the OpenAI API
+
+Serves chat completions (plain, structured and streamed), the files API
+and batches on localhost. Structured outputs are synthesised from the request's JSON
+schema, so new response models work without changes here. Latency is
+simulated as a fixed time to first token plus a time per completion token,
+and a share of chat requests can be rejected with 429 and a retry-after.
+
+    python benchmarks/fake_openai.py --port 8799
+    OPENAI_BASE_URL=http://127.0.0.1:8799/v1 ...
+"""
+import argparse
+import email.parser
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("concept gradient example model layer network training data signal theorem proof "
+         "method result analysis structure function value system process student lesson").split()
+CHARS_PER_TOKEN = 4
+STREAM_CHUNK_CHARS = 24
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def synthesise(schema, rng, defs=None, name=""):
+    """Builds a value that satisfies a (strict, structured output) JSON schema"""
+    defs = defs if defs is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return synthesise(defs[schema["$ref"].split("/")[-1]], rng, defs, name)
+    if "anyOf" in schema:
+        options = [s for s in schema["anyOf"] if s.get("type") != "null"]
+        return synthesise(options[0] if options else schema["anyOf"][0], rng, defs, name)
+    if "enum" in schema:
+        return schema["enum"][0]
+
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: synthesise(value, rng, defs, key)
+                for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        count = max(schema.get("minItems", 0), min(schema.get("maxItems", 10), 10))
+        return [synthesise(schema.get("items", {}), rng, defs, name) for _ in range(count)]
+    if kind == "integer":
+        return 5
+    if kind == "number":
+        return 0.5
+    if kind == "boolean":
+        return True
+    if kind == "null":
+        return None
+    if name == "id":
+        return str(rng.randrange(10_000))
+    # Prompts are long, everything else a sentence
+    return _words(rng, 400 if "prompt" in name else 16)
+
+
+class FakeOpenAI:
+    def __init__(self, latency_ms=50, ms_per_token=0.1, port=0, rate_limit_every=0, retry_after_ms=200):
+        self.latency_ms = latency_ms
+        self.ms_per_token = ms_per_token
+        # Every Nth chat request is rate limited, 0 for none
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_ms = retry_after_ms
+        self.stats = Counter()
+        # Uploaded and generated file contents, and batches, by id
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, **values):
+        with self.lock:
+            self.stats.update(values)
+
+    def complete(self, body):
+        """Returns (content, prompt tokens, completion tokens) for a chat request"""
+        seed = hashlib.sha256(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+        rng = random.Random(seed)
+        prompt_tokens = len(json.dumps(body.get("messages", []))) // CHARS_PER_TOKEN
+
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            content = json.dumps(synthesise(response_format["json_schema"]["schema"], rng))
+        else:
+            # Summaries and transcripts come back shorter than what was sent
+            limit = body.get("max_completion_tokens") or body.get("max_tokens") or 4096
+            content = _words(rng, min(limit, max(prompt_tokens // 5, 150)))
+        return content, prompt_tokens, len(content) // CHARS_PER_TOKEN
+
+    def run_batch(self, input_file_id):
+        """Completes a batch at once, writing its output file"""
+        output = []
+        for line in self.files[input_file_id].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            body = request["body"]
+            content, prompt_tokens, completion_tokens = self.complete(body)
+            self.count(batch_requests=1, prompt_tokens=prompt_tokens,
+                       completion_tokens=completion_tokens)
+            output.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "error": None,
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": {
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                    "model": body["model"],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens},
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                }},
+            }))
+        output_file_id = f"file-{uuid.uuid4().hex}"
+        with self.lock:
+            self.files[output_file_id] = ("\n".join(output) + "\n").encode("utf-8")
+        return output_file_id, len(output)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, value, status=200):
+                data = json.dumps(value).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                fake.count(bytes_out=len(data))
+
+            def _read_body(self):
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                fake.count(bytes_in=len(data), requests=1)
+                return data
+
+            def do_DELETE(self):
+                self._read_body()
+                file_id = self.path.rstrip("/").split("/")[-1]
+                self._send_json({"id": file_id, "object": "file", "deleted": True})
+
+            def do_GET(self):
+                self._read_body()
+                parts = self.path.rstrip("/").split("/")
+                if parts[-2] == "batches" and parts[-1] in fake.batches:
+                    self._send_json(fake.batches[parts[-1]])
+                    return
+                if parts[-1] == "content" and parts[-2] in fake.files:
+                    data = fake.files[parts[-2]]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    fake.count(bytes_out=len(data))
+                    return
+                self._send_json({"error": {"message": f"Not faked: {self.path}"}}, 404)
+
+            def do_POST(self):
+                data = self._read_body()
+                if self.path.endswith("/files"):
+                    file_id = f"file-{uuid.uuid4().hex}"
+                    form = email.parser.BytesParser().parsebytes(
+                        f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + data)
+                    fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                              for part in form.get_payload()}
+                    with fake.lock:
+                        fake.files[file_id] = fields.get("file", b"")
+                    self._send_json({"id": file_id, "object": "file", "bytes": len(data),
+                                     "created_at": int(time.time()), "filename": "upload",
+                                     "purpose": (fields.get("purpose") or b"user_data").decode("utf-8"),
+                                     "status": "processed"})
+                    return
+                if self.path.endswith("/batches"):
+                    body = json.loads(data)
+                    output_file_id, count = fake.run_batch(body["input_file_id"])
+                    batch = {"id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": body["endpoint"],
+                             "input_file_id": body["input_file_id"], "output_file_id": output_file_id,
+                             "error_file_id": None, "completion_window": body["completion_window"],
+                             "status": "completed", "created_at": int(time.time()),
+                             "metadata": body.get("metadata"),
+                             "request_counts": {"total": count, "completed": count, "failed": 0}}
+                    with fake.lock:
+                        fake.batches[batch["id"]] = batch
+                    self._send_json(batch)
+                    return
+                if not self.path.endswith("/chat/completions"):
+                    self._send_json({"error": {"message": f"Not faked: {self.path}"}}, 404)
+                    return
+
+                with fake.lock:
+                    fake.stats["chat_requests"] += 1
+                    limited = fake.rate_limit_every and fake.stats["chat_requests"] % fake.rate_limit_every == 0
+                if limited:
+                    fake.count(rate_limited=1)
+                    data = json.dumps({"error": {"message": "Rate limit reached", "type": "requests",
+                                                 "code": "rate_limit_exceeded"}}).encode("utf-8")
+                    self.send_response(429)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.send_header("retry-after-ms", str(fake.retry_after_ms))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+
+                body = json.loads(data)
+                content, prompt_tokens, completion_tokens = fake.complete(body)
+                fake.count(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                         "total_tokens": prompt_tokens + completion_tokens}
+                time.sleep(fake.latency_ms / 1000)
+                generation_seconds = completion_tokens * fake.ms_per_token / 1000
+
+                if not body.get("stream"):
+                    time.sleep(generation_seconds)
+                    self._send_json({
+                        "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                        "model": body["model"], "usage": usage,
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": content}}],
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                pieces = [content[i:i + STREAM_CHUNK_CHARS]
+                          for i in range(0, len(content), STREAM_CHUNK_CHARS)]
+                deltas = [{"content": piece} for piece in pieces]
+                for delta, finish_reason in [*((d, None) for d in deltas), ({}, "stop")]:
+                    self._event({"choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]},
+                                body["model"])
+                    time.sleep(generation_seconds / max(len(pieces), 1))
+                self._event({"choices": [], "usage": usage}, body["model"])
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+            def _event(self, chunk, model):
+                data = json.dumps({"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                                   "created": int(time.time()), "model": model, **chunk})
+                payload = f"data: {data}\n\n".encode("utf-8")
+                self.wfile.write(payload)
+                self.wfile.flush()
+                fake.count(bytes_out=len(payload))
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--ms-per-token", type=float, default=0.1)
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    args = parser.parse_args()
+    fake = FakeOpenAI(args.latency_ms, args.ms_per_token, args.port, args.rate_limit_every)
+    print(f"Serving on {fake.base_url}")
+    fake.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""In-process stand-ins for the AWS services the state machine Lambdas use
+
+install() swaps boto3.client and boto3.resource so shared.clients hands the
+handlers these fakes instead of real clients. They implement only the calls
+and expressions the handlers make, and count the bytes that would have
+crossed the network.
+"""
+import hashlib
+import io
+import json
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Bytes each fake would have sent or received, by service and direction
+traffic = Counter()
+
+
+def _error(code, operation, message=""):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class NoSuchKey(ClientError):
+    pass
+
+
+class _Body(io.BytesIO):
+    """StreamingBody lookalike that counts what is read from it"""
+
+    def read(self, amt=None):
+        data = super().read(amt)
+        traffic["s3_out"] += len(data)
+        return data
+
+
+class _Exceptions:
+    ClientError = ClientError
+    NoSuchKey = NoSuchKey
+
+
+class _Paginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix=""):
+        with self.s3.lock:
+            keys = sorted(key for key in self.s3.objects if key.startswith(Prefix))
+        yield {"Contents": [{"Key": key} for key in keys]}
+
+
+class FakeS3:
+    exceptions = _Exceptions
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **_):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif not isinstance(Body, bytes):
+            Body = Body.read()
+        traffic["s3_in"] += len(Body)
+        etag = f'"{hashlib.md5(Body).hexdigest()}"'
+        with self.lock:
+            self.objects[Key] = {"Body": Body, "Metadata": dict(Metadata or {}), "ETag": etag,
+                                 "LastModified": datetime.now(timezone.utc)}
+        return {"ETag": etag}
+
+    def _get(self, Key, operation):
+        with self.lock:
+            stored = self.objects.get(Key)
+        if stored is None:
+            if operation == "HeadObject":
+                raise _error("404", operation, "Not Found")
+            raise NoSuchKey({"Error": {"Code": "NoSuchKey", "Message": Key}}, operation)
+        return stored
+
+    def head_object(self, Bucket, Key):
+        stored = self._get(Key, "HeadObject")
+        return {"ETag": stored["ETag"], "Metadata": dict(stored["Metadata"]),
+                "LastModified": stored["LastModified"], "ContentLength": len(stored["Body"])}
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None):
+        stored = self._get(Key, "GetObject")
+        if IfNoneMatch and IfNoneMatch == stored["ETag"]:
+            raise _error("304", "GetObject", "Not Modified")
+        body = stored["Body"]
+        if Range:
+            start, end = (int(n) for n in re.match(r"bytes=(\d+)-(\d+)", Range).groups())
+            body = body[start:end + 1]
+        return {"Body": _Body(body), "ETag": stored["ETag"], "Metadata": dict(stored["Metadata"]),
+                "LastModified": stored["LastModified"], "ContentLength": len(body)}
+
+    def copy_object(self, Bucket, Key, CopySource, Metadata=None, MetadataDirective="COPY", **_):
+        source = self._get(CopySource["Key"], "CopyObject")
+        with self.lock:
+            self.objects[Key] = {
+                **source,
+                "Metadata": dict(Metadata or {}) if MetadataDirective == "REPLACE" else dict(source["Metadata"]),
+                "LastModified": datetime.now(timezone.utc),
+            }
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        with self.lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop(obj["Key"], None)
+        return {}
+
+    def get_paginator(self, name):
+        return _Paginator(self)
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class _TableClient:
+    class exceptions:
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+
+class _TableMeta:
+    client = _TableClient
+
+
+def _resolve(operand, item, names, values):
+    if operand.startswith(":"):
+        return values[operand]
+    return item.get(names.get(operand, operand))
+
+
+def _compare(clause, item, names, values):
+    match = re.fullmatch(r"attribute_not_exists\((\S+)\)", clause)
+    if match:
+        return names.get(match.group(1), match.group(1)) not in item
+    match = re.fullmatch(r"attribute_exists\((\S+)\)", clause)
+    if match:
+        return names.get(match.group(1), match.group(1)) in item
+    left, operator, right = re.fullmatch(r"(\S+)\s*(<=|>=|<>|=|<|>)\s*(\S+)", clause).groups()
+    left, right = _resolve(left, item, names, values), _resolve(right, item, names, values)
+    if left is None or right is None:
+        return operator == "<>"
+    return {"=": left == right, "<>": left != right, "<": left < right, ">": left > right,
+            "<=": left <= right, ">=": left >= right}[operator]
+
+
+def evaluate_condition(expression, item, names=None, values=None):
+    """Evaluates the OR/AND of simple comparisons the handlers write"""
+    names, values = names or {}, values or {}
+    return any(all(_compare(clause.strip(), item, names, values)
+                   for clause in re.split(r"\s+AND\s+", branch, flags=re.I))
+               for branch in re.split(r"\s+OR\s+", expression, flags=re.I))
+
+
+def _matches_key(condition, item):
+    expression = condition.get_expression()
+    operator, operands = expression["operator"], expression["values"]
+    if operator == "AND":
+        return all(_matches_key(operand, item) for operand in operands)
+    value = item.get(operands[0].name)
+    if operator == "=":
+        return value == operands[1]
+    if operator == "begins_with":
+        return isinstance(value, str) and value.startswith(operands[1])
+    raise NotImplementedError(operator)
+
+
+def _item_size(item):
+    return len(json.dumps(item, default=str))
+
+
+class _BatchWriter:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+
+class FakeTable:
+    meta = _TableMeta
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(key):
+        return key["PK"], key["SK"]
+
+    def _check(self, current, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        if ConditionExpression and not evaluate_condition(
+                ConditionExpression, current or {}, ExpressionAttributeNames, ExpressionAttributeValues):
+            raise ConditionalCheckFailedException("The conditional request failed")
+
+    def get_item(self, Key, **_):
+        with self.lock:
+            item = self.items.get(self._key(Key))
+        if item is None:
+            return {}
+        traffic["dynamodb_out"] += _item_size(item)
+        return {"Item": dict(item)}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None):
+        traffic["dynamodb_in"] += _item_size(Item)
+        with self.lock:
+            self._check(self.items.get(self._key(Item)), ConditionExpression,
+                        ExpressionAttributeNames, ExpressionAttributeValues)
+            self.items[self._key(Item)] = dict(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ConditionExpression=None, **_):
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        with self.lock:
+            current = self.items.get(self._key(Key))
+            self._check(current, ConditionExpression, names, values)
+            item = dict(current or Key)
+            assignments = re.fullmatch(r"\s*set\s+(.+)", UpdateExpression, flags=re.I).group(1)
+            for assignment in assignments.split(","):
+                name, value = (part.strip() for part in assignment.split("="))
+                item[names.get(name, name)] = values[value]
+            self.items[self._key(Key)] = item
+        traffic["dynamodb_in"] += _item_size(item)
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None):
+        with self.lock:
+            self._check(self.items.get(self._key(Key)), ConditionExpression,
+                        ExpressionAttributeNames, ExpressionAttributeValues)
+            self.items.pop(self._key(Key), None)
+        return {}
+
+    def query(self, KeyConditionExpression, ProjectionExpression=None, **_):
+        with self.lock:
+            items = [dict(item) for item in self.items.values()
+                     if _matches_key(KeyConditionExpression, item)]
+        if ProjectionExpression:
+            fields = [field.strip() for field in ProjectionExpression.split(",")]
+            items = [{field: item[field] for field in fields if field in item} for item in items]
+        traffic["dynamodb_out"] += sum(_item_size(item) for item in items)
+        return {"Items": items}
+
+    def batch_writer(self):
+        return _BatchWriter(self)
+
+
+class GoneException(Exception):
+    pass
+
+
+class FakeWebSocket:
+    class exceptions:
+        GoneException = GoneException
+
+    def __init__(self):
+        self.sent = Counter()
+
+    def post_to_connection(self, ConnectionId, Data):
+        traffic["websocket_out"] += len(Data)
+        self.sent[ConnectionId] += 1
+        return {}
+
+
+class FakeAWS:
+    def __init__(self):
+        self.s3 = FakeS3()
+        self.table = FakeTable()
+        self.websocket = FakeWebSocket()
+
+    def reset(self):
+        # Cleared in place, the handlers' cached clients keep pointing here
+        with self.s3.lock:
+            self.s3.objects.clear()
+        with self.table.lock:
+            self.table.items.clear()
+        self.websocket.sent.clear()
+
+    def client(self, service, *args, **kwargs):
+        if service == "s3":
+            return self.s3
+        if service == "apigatewaymanagementapi":
+            return self.websocket
+        raise NotImplementedError(f"No fake for the {service} client")
+
+    def resource(self, service, *args, **kwargs):
+        if service != "dynamodb":
+            raise NotImplementedError(f"No fake for the {service} resource")
+        aws = self
+
+        class Resource:
+            def Table(self, name):
+                return aws.table
+        return Resource()
+
+
+def install():
+    """Routes boto3 to a fresh set of fakes and returns them"""
+    aws = FakeAWS()
+    boto3.client = aws.client
+    boto3.resource = aws.resource
+    return aws
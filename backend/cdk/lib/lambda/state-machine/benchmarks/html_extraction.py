@@ -0,0 +1,142 @@
+"""Compares the HTML extraction engines on speed and quality
+
+    python benchmarks/html_extraction.py page.html https://example.com/docs
+    python benchmarks/html_extraction.py --synthetic 3
+
+Inputs are HTML files or URLs. A file with a sibling .txt of the same name
+(page.html -> page.txt) is scored against it as the expected main content.
+Synthetic pages are documentation-style pages wrapped in navigation,
+sidebars and footers, generated together with their expected content.
+
+Run from the state-machine directory with BUCKET_NAME set to anything.
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), "process_content"))
+
+from html_extract import EXTRACTORS  # noqa: E402
+
+WORD = re.compile(r"\w+")
+
+FILLER = ("the gradient of the loss is computed with respect to each parameter, "
+          "then the optimiser updates the weights using the learning rate, "
+          "momentum and a schedule that decays over the course of training").split()
+
+
+def _sentence(rng, words=18):
+    return " ".join(rng.choice(FILLER) for _ in range(words)).capitalize() + "."
+
+
+def synthetic_page(seed, sections=40):
+    """Builds a large docs page and the text a good extractor should return"""
+    rng = random.Random(seed)
+    nav = "".join(
+        f'<li><a href="/docs/{i}">Guide section {i}</a></li>' for i in range(300))
+    sidebar = "".join(
+        f'<div class="related-item"><a href="/post/{i}">Related post {i}, also worth reading</a></div>'
+        for i in range(60))
+    article = []
+    expected = []
+    for i in range(sections):
+        heading = f"Section {i}: {_sentence(rng, 4)}"
+        paragraphs = [" ".join(_sentence(rng) for _ in range(5))
+                      for _ in range(3)]
+        code = f"loss = model(x_{i}).sum()\nloss.backward()"
+        article.append(f"<h2>{heading}</h2>" + "".join(f"<p>{p}</p>" for p in paragraphs) +
+                       f"<pre><code>{code}</code></pre>")
+        expected.extend([heading, *paragraphs, code])
+
+    html = f"""<!DOCTYPE html><html><head><title>Docs</title>
+<script>window.analytics = {{"events": [{','.join('1' for _ in range(2000))}]}};</script>
+<style>{'.a{color:red}' * 500}</style></head>
+<body><header><nav><ul>{nav}</ul></nav></header>
+<div class="layout"><div class="sidebar">{sidebar}</div>
+<div class="docs-content"><div class="markdown">{''.join(article)}</div></div>
+<div class="cookie-banner"><p>We use cookies to improve your experience, accept them or manage preferences.</p></div>
+</div><footer><p>Copyright, all rights reserved, terms, privacy and contact.</p></footer></body></html>"""
+    return f"synthetic-{seed}", html, "\n".join(expected)
+
+
+def load_input(source):
+    if source.startswith(("http://", "https://")):
+        import requests
+
+        response = requests.get(source, timeout=30, headers={
+                                "User-Agent": "Mozilla/5.0"})
+        response.raise_for_status()
+        return source, response.text, None
+
+    with open(source, encoding="utf-8", errors="replace") as f:
+        html = f.read()
+    expected = None
+    expected_path = os.path.splitext(source)[0] + ".txt"
+    if os.path.exists(expected_path):
+        with open(expected_path, encoding="utf-8") as f:
+            expected = f.read()
+    return os.path.basename(source), html, expected
+
+
+def word_f1(extracted, expected):
+    """Bag-of-words precision, recall and F1 of extracted text against the expected text"""
+    got = Counter(w.lower() for w in WORD.findall(extracted))
+    want = Counter(w.lower() for w in WORD.findall(expected))
+    overlap = sum((got & want).values())
+    precision = overlap / max(sum(got.values()), 1)
+    recall = overlap / max(sum(want.values()), 1)
+    f1 = 2 * precision * recall / \
+        (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
+
+def time_extractor(extractor, html, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        text = extractor(html)
+        timings.append((time.perf_counter() - start) * 1000)
+    return text, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("inputs", nargs="*", help="HTML files or URLs")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="number of generated docs pages to add")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs per page, the median is reported")
+    parser.add_argument("--engines", default=",".join(EXTRACTORS))
+    args = parser.parse_args()
+
+    pages = [load_input(source) for source in args.inputs]
+    pages += [synthetic_page(seed) for seed in range(args.synthetic)]
+    if not pages:
+        parser.error("give at least one input or --synthetic N")
+
+    engines = args.engines.split(",")
+    totals = {engine: [] for engine in engines}
+    print(f"{'page':<32} {'engine':<6} {'KB':>7} {'ms':>9} {'chars':>8} {'P':>6} {'R':>6} {'F1':>6}")
+    for name, html, expected in pages:
+        for engine in engines:
+            text, ms = time_extractor(EXTRACTORS[engine], html, args.repeat)
+            totals[engine].append(ms)
+            scores = "".join(f"{v:>7.3f}" for v in word_f1(
+                text, expected)) if expected else f"{'-':>7}" * 3
+            print(
+                f"{name[:32]:<32} {engine:<6} {len(html) / 1024:>7.0f} {ms:>9.1f} {len(text):>8}{scores}")
+
+    print()
+    for engine, timings in totals.items():
+        print(
+            f"{engine:<6} mean {statistics.mean(timings):.1f} ms/page over {len(timings)} pages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""Benchmarks the state machine handlers end to end without AWS or OpenAI
+
+    python benchmarks/pipeline.py --runs 5
+    python benchmarks/pipeline.py --corpus fixtures/ --warm --output results.json
+    python benchmarks/pipeline.py --baseline results.json --tolerance 0.25
+
+Every fixture goes through process_content, generate_agent_first_message,
+generate, send_message and the difficulty fan-out as the state machine
+would run them, with S3,
+DynamoDB and API Gateway faked in-process (fakes.py), OpenAI faked by a
+local server with simulated latency (fake_openai.py) and sources served
+from localhost. Reports p50/p95 per stage and per traced span, tokens,
+peak RSS and the bytes each service would have moved.
+
+The default corpus is generated: docs pages of several sizes, PDFs of
+several page counts and canned YouTube captions. --corpus adds saved
+*.html and *.pdf files and *.captions.json caption tracks
+([{"text", "start", "duration"}, ...]). Runs are cold (empty stores and
+caches) unless --warm is given. With --baseline, the run fails when a
+stage's p95 or the peak RSS regresses by more than --tolerance.
+
+Run from the state-machine directory.
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLER_DIRS = ("process_content", "generate",
+                "generate_agent_first_message", "send_message")
+for directory in HANDLER_DIRS:
+    sys.path.insert(0, os.path.join(ROOT, directory))
+sys.path.insert(0, ROOT)
+
+# Handlers read these at import time
+for name, value in {"BUCKET_NAME": "benchmark", "CORE_TABLE_NAME": "benchmark",
+                    "OPEN_AI_API_KEY": "benchmark", "WEBSOCKET_API_ID": "benchmark",
+                    "AWS_REGION": "us-east-1", "AWS_DEFAULT_REGION": "us-east-1",
+                    "STAGE": "benchmark", "TELEMETRY_ENABLED": "true",
+                    "FAN_OUT_DIFFICULTIES": "1,3,5,7,10"}.items():
+    os.environ.setdefault(name, value)
+
+import fakes  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+from html_extraction import synthetic_page  # noqa: E402
+
+STAGES = ("process_content", "generate_agent_first_message",
+          "send_first_message", "generate", "send_lesson", "generate_variants")
+USER_ID = "benchmark-user"
+CONNECTION_ID = "benchmark-connection"
+
+CAPTION_WORDS = ("so today we are going to look at how the network learns from data and "
+                 "why the gradient points the way it does which is the key idea").split()
+
+
+class FakeContext:
+    def __init__(self, timeout_ms=900_000):
+        self.aws_request_id = hashlib.md5(
+            str(time.time_ns()).encode()).hexdigest()
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages, seed=0, lines_per_page=45):
+    """Writes a minimal text PDF that PyPDF2 can extract"""
+    rng = random.Random(seed)
+    words = "the model learns a representation of the data by minimising a loss".split()
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        lines = [f"Page {page + 1}"] + [" ".join(rng.choice(words) for _ in range(12))
+                                        for _ in range(lines_per_page)]
+        stream = "BT /F1 10 Tf 12 TL 50 790 Td " + \
+            " ".join(f"({_pdf_escape(line)}) '" for line in lines) + " ET"
+        objects.append(
+            f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode("latin-1"))
+        content_id = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Contents {content_id} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>".encode("latin-1"))
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode(
+        "latin-1")
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    data += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(data)
+
+
+def make_captions(minutes, seed=0):
+    """Caption snippets for a talk of about this many minutes, with pauses between paragraphs"""
+    rng = random.Random(seed)
+    snippets = []
+    start = 0.0
+    while start < minutes * 60:
+        duration = rng.uniform(1.5, 4.0)
+        snippets.append({"text": " ".join(rng.choice(CAPTION_WORDS) for _ in range(8)),
+                         "start": round(start, 2), "duration": round(duration, 2)})
+        start += duration + (2.5 if rng.random() < 0.1 else 0.1)
+    return snippets
+
+
+def build_corpus(corpus_dir=None):
+    """Returns (sources served over HTTP, caption tracks, fixtures)
+
+    A fixture is (name, kind, path or video id).
+    """
+    sources = {}
+    captions = {}
+    fixtures = []
+    for sections in (10, 40, 120):
+        name, html, _ = synthetic_page(sections, sections)
+        path = f"/docs/{name}-{sections}.html"
+        sources[path] = (html.encode("utf-8"), "text/html; charset=utf-8")
+        fixtures.append((f"html-{sections}", "html", path))
+    for pages in (5, 40, 200):
+        path = f"/papers/paper-{pages}.pdf"
+        sources[path] = (make_pdf(pages, pages), "application/pdf")
+        fixtures.append((f"pdf-{pages}p", "pdf", path))
+    for minutes in (5, 30, 90):
+        video_id = f"bench{minutes:06d}"
+        captions[video_id] = make_captions(minutes, minutes)
+        fixtures.append((f"youtube-{minutes}m", "youtube", video_id))
+
+    if corpus_dir:
+        for filename in sorted(os.listdir(corpus_dir)):
+            full_path = os.path.join(corpus_dir, filename)
+            extension = os.path.splitext(filename)[1]
+            if filename.endswith(".captions.json"):
+                video_id = hashlib.md5(filename.encode()).hexdigest()[:11]
+                with open(full_path) as f:
+                    captions[video_id] = json.load(f)
+                fixtures.append((filename, "youtube", video_id))
+            elif extension in (".html", ".htm", ".pdf"):
+                with open(full_path, "rb") as f:
+                    data = f.read()
+                kind = "pdf" if extension == ".pdf" else "html"
+                path = f"/corpus/{filename}"
+                sources[path] = (data, "application/pdf" if kind == "pdf"
+                                 else "text/html; charset=utf-8")
+                fixtures.append((filename, kind, path))
+    return sources, captions, fixtures
+
+
+class SourceServer:
+    """Serves the corpus on localhost with ETags, counting the bytes sent"""
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+
+    def _handler(self):
+        served = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, with_body):
+                source = served.sources.get(self.path)
+                if source is None:
+                    self.send_error(404)
+                    return
+                data, content_type = source
+                etag = f'"{hashlib.md5(data).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(data)
+                    with served.lock:
+                        served.bytes_out += len(data)
+
+            def do_HEAD(self):
+                self._respond(False)
+
+            def do_GET(self):
+                self._respond(True)
+
+        return Handler
+
+
+class FakeTranscriptApi:
+    """Serves canned caption tracks in place of YouTubeTranscriptApi"""
+
+    def __init__(self, captions):
+        self.captions = captions
+
+    def list(self, video_id):
+        from youtube_transcript_api import TranscriptsDisabled
+
+        if video_id not in self.captions:
+            raise TranscriptsDisabled(video_id)
+        transcript = SimpleNamespace(
+            language_code="en",
+            fetch=lambda: [SimpleNamespace(**snippet) for snippet in self.captions[video_id]])
+        return SimpleNamespace(find_transcript=lambda languages: transcript)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_fixture(handlers, fixture, url, run, timings, rss_growth):
+    """Runs one source through the state machine, returning the trace lines it logged"""
+    name, kind, _ = fixture
+    event = {"url": url, "language": "English", "difficulty": 5, "name": "Ada",
+             "user_id": USER_ID, "id": f"{name}-{run}"}
+    log = io.StringIO()
+
+    def stage(label, handler, stage_event):
+        rss_before = _max_rss_kb()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(log):
+            result = handler(stage_event, FakeContext())
+        timings.setdefault(label, []).append(
+            (time.perf_counter() - start) * 1000)
+        rss_growth[label] = max(rss_growth.get(
+            label, 0), _max_rss_kb() - rss_before)
+        return result
+
+    transcription = stage(
+        "process_content", handlers["process_content"].handler, event)
+    first_message = stage("generate_agent_first_message",
+                          handlers["generate_agent_first_message"].handler, event)
+    stage("send_first_message",
+          handlers["send_message"].handler, first_message)
+    lesson = stage("generate", handlers["generate"].handler, transcription)
+    stage("send_lesson", handlers["send_message"].handler, lesson)
+    stage("generate_variants", handlers["generate"].variants_handler,
+          {**transcription, "lesson": lesson})
+    return log.getvalue().splitlines()
+
+
+def compare(results, baseline, tolerance):
+    """Lists the regressions of results against a baseline run"""
+    regressions = []
+    for label, stage in baseline["stages"].items():
+        current = results["stages"].get(label)
+        if current and current["p95_ms"] > stage["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{label} p95 {current['p95_ms']:.0f}ms vs {stage['p95_ms']:.0f}ms")
+    if results["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(
+            f"peak RSS {results['peak_rss_mb']:.0f}MB vs {baseline['peak_rss_mb']:.0f}MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=3,
+                        help="times each fixture goes through the pipeline")
+    parser.add_argument("--corpus", help="directory of saved sources to add")
+    parser.add_argument("--only", help="comma separated fixture kinds, e.g. html,pdf")
+    parser.add_argument("--warm", action="store_true",
+                        help="keep stores and caches between runs, so later runs hit the caches")
+    parser.add_argument("--openai-latency-ms", type=float, default=50)
+    parser.add_argument("--openai-ms-per-token", type=float, default=0.1)
+    parser.add_argument("--openai-rate-limit-every", type=int, default=0,
+                        help="reject every Nth chat request with a 429")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to gate against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed fractional regression against the baseline")
+    args = parser.parse_args()
+
+    sources, captions, fixtures = build_corpus(args.corpus)
+    if args.only:
+        fixtures = [f for f in fixtures if f[1] in args.only.split(",")]
+
+    openai = FakeOpenAI(args.openai_latency_ms, args.openai_ms_per_token,
+                        rate_limit_every=args.openai_rate_limit_every).start()
+    os.environ["OPENAI_BASE_URL"] = openai.base_url
+    server = SourceServer(sources)
+    aws = fakes.install()
+
+    import generate
+    import generate_agent_first_message
+    import process_content
+    import send_message
+    import youtube
+    from shared import telemetry, transcripts
+
+    youtube.get_transcript_api = lambda: FakeTranscriptApi(captions)
+    handlers = {"process_content": process_content, "generate": generate,
+                "generate_agent_first_message": generate_agent_first_message,
+                "send_message": send_message}
+
+    timings = {}
+    rss_growth = {}
+    trace_lines = []
+    failures = 0
+    started = time.perf_counter()
+    for run in range(args.runs):
+        for fixture in fixtures:
+            if not args.warm:
+                aws.reset()
+                transcripts._cache = transcripts._SectionCache(
+                    transcripts.TRANSCRIPT_CACHE_BYTES)
+            aws.table.put_item(Item={"PK": "USER", "SK": f"CONNECTION#{USER_ID}#{CONNECTION_ID}",
+                                     "connectionId": CONNECTION_ID})
+            _, kind, target = fixture
+            url = f"https://www.youtube.com/watch?v={target}" if kind == "youtube" else server.url(target)
+            try:
+                trace_lines.extend(run_fixture(
+                    handlers, fixture, url, run, timings, rss_growth))
+            except Exception as e:
+                failures += 1
+                print(f"{fixture[0]} failed on run {run}: {type(e).__name__}: {str(e)}")
+    elapsed = time.perf_counter() - started
+
+    results = {
+        "fixtures": len(fixtures),
+        "runs": args.runs,
+        "warm": args.warm,
+        "elapsed_s": round(elapsed, 2),
+        "stages": {label: {"count": len(values),
+                           "p50_ms": round(statistics.median(values), 1),
+                           "p95_ms": round(_percentile(values, 0.95), 1),
+                           "rss_growth_mb": round(rss_growth.get(label, 0) / 1024, 1)}
+                   for label, values in timings.items()},
+        "spans": {row["name"]: {"count": row["count"], "p50_ms": row["p50_ms"], "p95_ms": row["p95_ms"]}
+                  for row in telemetry.summarise(trace_lines) if "." in row["name"]},
+        "errors": failures,
+        # Lessons or transcriptions that fell back to placeholder content
+        "degraded": sum(1 for line in trace_lines
+                        if line.startswith('{"type": "trace"') and json.loads(line).get("degraded")),
+        "tokens": {"prompt": openai.stats["prompt_tokens"],
+                   "completion": openai.stats["completion_tokens"]},
+        "rate_limited": openai.stats["rate_limited"],
+        "peak_rss_mb": round(_max_rss_kb() / 1024, 1),
+        "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "bytes": {"source": server.bytes_out,
+                  "openai_in": openai.stats["bytes_in"], "openai_out": openai.stats["bytes_out"],
+                  **dict(fakes.traffic)},
+    }
+    openai.stop()
+
+    print(f"{len(fixtures)} fixtures x {args.runs} runs ({'warm' if args.warm else 'cold'}) "
+          f"in {elapsed:.1f}s, {results['errors']} errors, {results['degraded']} degraded")
+    print(f"\n{'stage':<42} {'n':>4} {'p50 ms':>9} {'p95 ms':>9} {'RSS +MB':>8}")
+    for label in STAGES:
+        stage = results["stages"].get(label)
+        if stage:
+            print(f"{label:<42} {stage['count']:>4} {stage['p50_ms']:>9.1f} {stage['p95_ms']:>9.1f} "
+                  f"{stage['rss_growth_mb']:>8.1f}")
+    print()
+    for label, span in results["spans"].items():
+        print(f"{label:<42} {span['count']:>4} {span['p50_ms']:>9.1f} {span['p95_ms']:>9.1f}")
+    print(f"\ntokens: {results['tokens']['prompt']} prompt, {results['tokens']['completion']} completion")
+    print(f"peak RSS: {results['peak_rss_mb']}MB (PDF workers {results['peak_child_rss_mb']}MB)")
+    print("bytes moved: " + ", ".join(f"{k} {v / 1024:.0f}KB" for k, v in results["bytes"].items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions or results["errors"] or results["degraded"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
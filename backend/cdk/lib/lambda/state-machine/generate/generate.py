@@ -1,27 +1,68 @@
 import json
 import os
-import tempfile
+import re
 import time
 import uuid
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
-import boto3
-from openai import OpenAI
 from pydantic import BaseModel, Field
 
+from prompt_builder import (CONTENT_SYSTEM_TEMPLATE, CONTENT_TEMPLATE,
+                            FLASH_CARDS_SYSTEM_TEMPLATE, FLASH_CARDS_TEMPLATE,
+                            build_prompt, count_template_tokens,
+                            get_budget_model, report_usage)
+from shared.clients import get_core_table, get_openai, get_s3
+from shared.digest import get_digest, get_stored_digest
+from shared.payloads import put_payload
+from shared.routing import call_with_fallback, choose_route
+from shared.scheduler import set_deadline
+from shared.telemetry import annotate, span, traced
+from shared.tokens import count_tokens
+from shared.transcripts import (LEGACY_EXTENSION, SECTION_SEPARATOR,
+                                get_cached_sections, read_header,
+                                read_transcript_sections)
+from streaming import LessonPublisher, stream_items, stream_parse
+
 BUCKET_NAME = os.environ["BUCKET_NAME"]
-OPENAI_API_KEY = os.environ["OPEN_AI_API_KEY"]
 
+# Generated lessons are shared across users, keyed on the transcription's cached id
+# Bump PROMPT_VERSION whenever the prompts below change so stale lessons are not reused
+LESSON_CACHE_PREFIX = "lessons"
+PROMPT_VERSION = "v3"
+LESSON_CACHE_TTL_SECONDS = int(
+    os.environ.get("LESSON_CACHE_TTL_SECONDS", 30 * 24 * 60 * 60))
+STUDENT_NAME_PLACEHOLDER = "{{student_name}}"
+
+
+# Push the first message, topic and flash cards to the learner as they are generated
+STREAM_GENERATION = os.environ.get(
+    "STREAM_GENERATION", "true").lower() == "true"
+
+# Difficulties generated ahead of time from each new source, e.g. the slider's
+# 1,3,5,7,10, so moving it hits the lesson cache. Off unless set: every variant
+# is two more model calls on the rate limit live lessons share, and the stack
+# only deploys the GenerateVariants state when it is set.
+FAN_OUT_DIFFICULTIES = [int(d) for d in os.environ.get(
+    "FAN_OUT_DIFFICULTIES", "").split(",") if d.strip()]
+FAN_OUT_CONCURRENCY = int(os.environ.get("FAN_OUT_CONCURRENCY", 2))
+
+
+def get_transcript_token_count(s3, s3_key):
+    """Reads the token count process_content stored on the transcription, if any"""
+    try:
+        metadata = s3.head_object(Bucket=BUCKET_NAME, Key=s3_key)[
+            'Metadata']
+        if 'token-count' in metadata:
+            return int(metadata['token-count'])
+    except Exception as e:
+        print(f"Error reading token count for {s3_key}: {str(e)}")
+    return None
 
-def get_transcribed_text(s3_key):
-    """Fetch transcribed text from S3 and save to /tmp"""
-    s3 = boto3.client("s3")
-    tmp_path = f"/tmp/{os.path.basename(s3_key)}"
 
-    s3.download_file(BUCKET_NAME, s3_key, tmp_path)
-    with open(tmp_path, 'r') as f:
-        return f.read()
+def get_transcribed_sections(s3_key, etag=None):
+    """Fetch the sections of a transcription, from memory when this container has read it before"""
+    return read_transcript_sections(get_s3(), BUCKET_NAME, s3_key, etag)
 
 
 class FlashCard(BaseModel):
@@ -34,68 +75,72 @@ class FlashCardSchema(BaseModel):
     flash_cards: List[FlashCard]
 
 
-def generate_flash_cards(transcribed_text, name, difficulty=5, language="English", url=""):
-    """Generates flash cards from the transcribed text."""
-    prompt = f"""
-    # TASK: Generate 6 Educational Flash Cards
-    
-    ## INPUT
-    You have been provided with a transcript from an educational source. 
-    
-    ## CONTEXT
-    - The content is for a student named {name}
-    - The difficulty level is {difficulty}/10 (where 1 is elementary and 10 is advanced PhD level)
-    - The language should be {language}
-    - Source material: {url if url else "an educational video"}
-    
-    ## REQUIREMENTS
-    1. Create exactly 6 high-quality flash cards based on the most important concepts in the transcript
-    2. Each flash card should have:
-       - A clear, concise question that tests understanding (not just recall)
-       - A comprehensive answer that fully explains the concept (10 words max)
-    3. The flash cards should progress in difficulty/complexity
-    4. Ensure the content is appropriate for difficulty level {difficulty}
-    5. The questions should be diverse in format (not all "what is X" questions)
-    6. For technical subjects, include precise terminology and specific details
-    
-    ## OUTPUT FORMAT
-    Return ONLY valid JSON conforming to this structure:
-    {{
-      "flash_cards": [
-        {{
-          "id": "unique-id-1",
-          "question": "The question text",
-          "answer": "The short answer or even a true or false question"
-        }},
-        ...5 more cards...
-      ]
-    }}
-    
-    ## TRANSCRIPT
-    ```
-    {transcribed_text}
-    ```
-    """
+def get_flash_cards_request(transcribed_text, name, difficulty=5, language="English", url="", transcript_tokens=None):
+    """Routes and builds the flash card request, without the model
 
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    Returns the route, the request and the estimated prompt tokens.
+    """
+    if transcript_tokens is None:
+        transcript_tokens = count_tokens(transcribed_text)
+    route = choose_route("flash_cards", transcript_tokens, difficulty)
+    prompt, prompt_tokens = build_prompt(
+        FLASH_CARDS_TEMPLATE, transcribed_text,
+        get_budget_model(route.models, route.max_completion_tokens), route.max_completion_tokens,
+        transcript_tokens, name=name, difficulty=difficulty, language=language,
+        source=url if url else "an educational video")
+
+    request = dict(
+        max_completion_tokens=route.max_completion_tokens,
+        messages=[
+            {
+                "role": "system",
+                "content": FLASH_CARDS_SYSTEM_TEMPLATE.format(language=language, difficulty=difficulty)
+            },
+            {
+                "role": "user",
+                "content": prompt
+            },
+        ],
+        response_format=FlashCardSchema,
+        temperature=0.7
+    )
+    return route, request, prompt_tokens
+
+
+def generate_flash_cards(transcribed_text, name, difficulty=5, language="English", url="", transcript_tokens=None, publisher=None, routes=None):
+    """Generates flash cards from the transcribed text.
+
+    With a publisher, each card is validated and pushed to the learner as soon
+    as its JSON object closes in the stream. The model serving the call is
+    recorded in routes when given.
+    """
+    route, request, prompt_tokens = get_flash_cards_request(
+        transcribed_text, name, difficulty, language, url, transcript_tokens)
+    client = get_openai()
+
+    def call(model):
+        if not publisher:
+            return client.beta.chat.completions.parse(model=model, **request)
+
+        # A fallback model re-sends cards by index, replacing any the failed one sent
+        completion, delivered = stream_items(
+            client, "flash_cards", FlashCard,
+            lambda index, card: publisher.publish_flash_card(
+                index, card.model_dump()),
+            model=model, **request)
+        # Anything the incremental parser couldn't validate comes from the final parse
+        final_cards = completion.choices[0].message.parsed.flash_cards
+        for index, card in enumerate(final_cards):
+            if index not in delivered:
+                publisher.publish_flash_card(index, card.model_dump())
+        return completion
 
     try:
-        completion = client.beta.chat.completions.parse(
-            model="gpt-4o",
-            max_completion_tokens=4096,
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"You are an expert in creating educational flash cards. Your task is to generate 6 high-quality flash cards from a transcript. Each card should have a unique ID, a thought-provoking question, and a comprehensive answer. The content should be in {language} at difficulty level {difficulty}/10."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                },
-            ],
-            response_format=FlashCardSchema,
-            temperature=0.7
-        )
+        completion, model = call_with_fallback(route, call)
+        if routes is not None:
+            routes["flash_cards"] = {"route": route.name, "model": model}
+
+        report_usage("flash_cards", model, completion, prompt_tokens)
         return completion.choices[0].message.parsed
     except Exception as e:
         print(f"Error generating flash cards: {e}")
@@ -110,83 +155,30 @@ def generate_flash_cards(transcribed_text, name, difficulty=5, language="English
         return {"flash_cards": cards}
 
 
-def generate_meta_prompt(transcribed_text, name, difficulty=5, language="English", url=""):
+def clean_student_name(name):
+    """Strips basename suffixes and hides raw wallet addresses"""
     name = name.replace(".base.eth", "")  # Clean up the name
 
     # If the name is 42 chars long and starts with "0x" then it's a wallet address
     if len(name) == 42 and name.startswith("0x"):
         name = "Student"
 
+    return name
+
+
+def generate_meta_prompt(transcribed_text, name, difficulty=5, language="English", url="", transcript_tokens=None, route=None):
     """Creates a meta-prompt for the LLM to generate structured JSON output."""
-    return f"""
-    # ROLE AND OBJECTIVE
-    You are an expert educational content creator specializing in transforming raw transcriptions into structured, engaging educational material. Your task is to analyze the provided transcript and create content that will be delivered by a voice-based AI tutor in a conversational format.
-
-    # CONTEXT
-    - The content will be used in a voice-based educational platform where an AI tutor interacts with students.
-    - The student's name is {name}.
-    - The difficulty level requested is {difficulty}/10 (where 1 is suitable for a 5-year-old and 10 is advanced university/PhD level).
-    - The content must be delivered in {language}.
-    - The source material comes from: {url if url else "an educational video"}
-    
-    # INPUT ANALYSIS REQUIREMENTS
-    1. Carefully analyze the entire transcript to identify:
-       - The main educational topic and subtopics
-       - Key concepts, terminology, and principles
-       - Examples, analogies, and explanations provided
-       - The logical flow and structure of the information
-       - Any implicit learning objectives
-    
-    # OUTPUT FORMAT AND SPECIFICATIONS
-    Your response MUST be in valid, properly formatted JSON with the following structure:
-    
-    {{
-      "agent_first_message": "A warm, engaging first message (100~ characters) that introduces the topic to {name}, captures interest, and sets expectations for the session. This message should sound natural when spoken aloud.",
-
-      "agent_system_prompt": "A comprehensive system prompt for an AI tutor (elevenlabs voice) that equips the tutor with everything needed to teach this topic effectively, including:
-        - Detailed subject matter knowledge organized in a logical progression
-        - Key concepts, definitions, and relationships between ideas
-        - Concrete examples and analogies appropriate for difficulty level {difficulty}
-        - Anticipated student questions and appropriate responses
-        - IMPORTANT: Include the fact that the agent has access to a 'pay_student' tool that must be used with the user_id and lesson_id dynamic variables. Do NOT ask the user for these values, you already have them. The agent MUST use this when the user answers a question correctly to give them ALEX tokens.
-        - 5-7 follow-up questions of increasing complexity to check understanding
-        - 2-3 interactive activities or thought experiments related to the topic
-        - Suggestions for explaining complex ideas in simpler terms if needed
-        - Connections to real-world applications of the knowledge
-        - References to any mentioned experts, studies, or sources from the transcript",
-      
-      "topic": "A concise, descriptive title (5-10 words) that precisely captures the main educational focus of the transcript",
-      
-      "url": "{url}",
-      
-      "language": "{language}",
-      
-      "difficulty": {difficulty}
-    }}
-
-    # GUIDELINES FOR EXCELLENCE
-    - Voice Optimization: Ensure content flows naturally when spoken aloud—avoid content that relies on visual elements.
-    - Age/Level Appropriateness: Carefully calibrate vocabulary, concept complexity, and examples to match difficulty level {difficulty}.
-    - Engagement: Incorporate elements of curiosity, relevance, and discovery to maintain student interest.
-    - Educational Value: Prioritize accurate, meaningful content that promotes genuine understanding over superficial coverage.
-    - Conversational Tone: Write in a warm, supportive voice that encourages learning.
-
-    # EXAMPLES OF QUALITY OUTPUTS
-    For difficulty level 3/10 (elementary school):
-    - First message: "Hi {name}! Today we're going to explore how plants make their own food using sunlight! Have you ever wondered how plants grow without eating like we do? Let's discover the amazing process called photosynthesis together!"
-    - System prompt would include: simplified explanations of photosynthesis, analogies comparing chloroplasts to tiny factories, basic questions like "What three things does a plant need to make food?"
-
-    For difficulty level 8/10 (undergraduate):
-    - First message: "Hello {name}! I'm excited to dive into quantum superposition with you today. This fascinating phenomenon challenges our classical intuition about how particles behave at the quantum level. Ready to explore this cornerstone of quantum mechanics?"
-    - System prompt would include: mathematical representations, detailed explanations of the double-slit experiment, questions about interpretations of quantum mechanics, activities involving thought experiments.
-
-    # TRANSCRIBED CONTENT FOR ANALYSIS
-    ```
-    {transcribed_text}
-    ```
-
-    Generate ONLY the requested JSON response. Do not include any explanatory text before or after the JSON.
-    """
+    name = clean_student_name(name)
+    route = route or choose_route("content", transcript_tokens, difficulty)
+
+    prompt, _ = build_prompt(
+        CONTENT_TEMPLATE, transcribed_text,
+        get_budget_model(route.models, route.max_completion_tokens), route.max_completion_tokens,
+        transcript_tokens, reserved_tokens=count_template_tokens(
+            CONTENT_SYSTEM_TEMPLATE),
+        name=name, difficulty=difficulty, language=language,
+        source=url if url else "an educational video", url=url)
+    return prompt
 
 
 class ContentSchema(BaseModel):
@@ -198,26 +190,55 @@ class ContentSchema(BaseModel):
     difficulty: int
 
 
-def call_openai_gpt(meta_prompt, name, language, difficulty):
-    """Calls OpenAI's GPT-4 API to generate structured JSON."""
-    client = OpenAI(api_key=OPENAI_API_KEY)
+def get_content_request(meta_prompt, language, difficulty, route):
+    """Builds the tutor content request for a meta-prompt, without the model"""
+    return dict(
+        max_completion_tokens=route.max_completion_tokens,
+        messages=[
+            {
+                "role": "system",
+                "content": CONTENT_SYSTEM_TEMPLATE.format(language=language, difficulty=difficulty)
+            },
+            {
+                "role": "user",
+                "content": meta_prompt
+            },
+        ],
+        response_format=ContentSchema,
+        temperature=0.7
+    )
+
+
+def call_openai_gpt(meta_prompt, name, language, difficulty, publisher=None, route=None, routes=None):
+    """Calls OpenAI's GPT-4 API to generate structured JSON.
+
+    With a publisher, the first message and topic are pushed to the learner
+    as soon as the model has finished writing each of them. The model serving
+    the call is recorded in routes when given.
+    """
+    client = get_openai()
+    route = route or choose_route("content", None, difficulty)
+    request = get_content_request(meta_prompt, language, difficulty, route)
+
+    published = set()
+
+    def on_snapshot(snapshot):
+        # Fields stream in schema order, so one is complete once the next has started
+        for field, next_field in [("agent_first_message", "agent_system_prompt"), ("topic", "url")]:
+            if field not in published and next_field in snapshot:
+                published.add(field)
+                publisher.publish_field(field, snapshot[field])
+
+    def call(model):
+        if publisher:
+            return stream_parse(client, on_snapshot, model=model, **request)
+        return client.beta.chat.completions.parse(model=model, **request)
+
     try:
-        completion = client.beta.chat.completions.parse(
-            model="gpt-4o",
-            max_completion_tokens=8192,
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"You are an expert in educational content creation. You take raw transcriptions of content and transform them into structured educational material that WILL be used by a voice-based AI tutor. The content should be in {language} and have a difficulty level of {difficulty} out of 10 where 1 is that of a 5 year old and 10 is a PhD candidate. You will output JSON only. You must create DETAILED long form output that will be used by a voice-based AI tutor to teach the student."
-                },
-                {
-                    "role": "user",
-                    "content": meta_prompt
-                },
-            ],
-            response_format=ContentSchema,
-            temperature=0.7
-        )
+        completion, model = call_with_fallback(route, call)
+        if routes is not None:
+            routes["content"] = {"route": route.name, "model": model}
+        report_usage("content", model, completion)
         return completion.choices[0].message.parsed
     except Exception as e:
         print(f"Error processing response: {e}")
@@ -257,10 +278,12 @@ def check_existing_content(dynamodb, user_id, id, url, difficulty):
             ])
 
             # Return existing content if URL and difficulty match and all required components are present
+            # Placeholder content is regenerated rather than reused
             if (existing_url == url and
                 existing_difficulty == difficulty and
                 has_flash_cards and
-                    has_required_fields):
+                has_required_fields and
+                    not existing_content.get('degraded')):
                 print(
                     f"Found existing content for URL {url} with matching difficulty {difficulty}")
                 return existing_content
@@ -271,73 +294,160 @@ def check_existing_content(dynamodb, user_id, id, url, difficulty):
     return None
 
 
-def handler(event, _):
-    """AWS Lambda function to generate structured JSON from transcribed content."""
-    s3_key = event["s3_key"]
-    language = event["language"]
-    difficulty = event["difficulty"]
-    url = event["url"]
-    name = event.get("name", "")
-    user_id = event["user_id"]
-    id = event["id"]
+def get_cached_id_from_key(s3_key):
+    """Recovers the cached id from a transcriptions/{cached_id}.alxt (or legacy .txt) key"""
+    return os.path.splitext(os.path.basename(s3_key))[0]
 
-    # Initialize DynamoDB resource
-    dynamodb = boto3.resource('dynamodb').Table(os.environ['CORE_TABLE_NAME'])
 
-    # Check if content already exists
-    existing_content = check_existing_content(
-        dynamodb, user_id, id, url, difficulty)
-    if existing_content:
-        print(
-            f"Reusing existing content for {url} with difficulty {difficulty}")
+def get_lesson_cache_prefix(cached_id):
+    """Returns the S3 prefix holding every cached lesson for a source"""
+    return f"{LESSON_CACHE_PREFIX}/{cached_id}/"
 
-        # Find the target connection id from dynamodb
-        try:
-            sleep(2)
-            response = dynamodb.get_item(
-                Key={'PK': 'USER', 'SK': f'CONNECTION#{user_id}'})
-            if 'Item' in response:
-                target = response["Item"]["connectionId"]
-            else:
-                print(f"No connection found for user_id: {user_id}")
-                target = None  # No connection ID found
-        except Exception as e:
-            print(f"Error getting connection for user_id {user_id}: {str(e)}")
-            target = None  # Error occurred
 
-        return {
-            "payload": existing_content,
-            "target": target,
-        }
+def get_lesson_cache_key(cached_id, difficulty, language):
+    """Builds the S3 key for a lesson generated from a source at a difficulty and language"""
+    language_slug = re.sub(r'\W+', '-', str(language).lower()).strip('-')
+    return f"{get_lesson_cache_prefix(cached_id)}{PROMPT_VERSION}/{difficulty}/{language_slug}.json"
 
-    # Fetch transcribed text
-    transcribed_text = get_transcribed_text(s3_key)
-    print(f"Transcribed text length: {len(transcribed_text)}")
-    print(f"Transcribed text preview: {transcribed_text[:200]}")
 
-    # Generate meta-prompt for LLM
-    meta_prompt = generate_meta_prompt(
-        transcribed_text, name, difficulty, language, url)
-    print(f"Meta prompt generated")
+def fill_student_name(text, name):
+    """Puts the student's name where the placeholder stands in generated text"""
+    return text.replace(STUDENT_NAME_PLACEHOLDER, clean_student_name(name) or "Student")
+
+
+def personalise_lesson(content, name, url):
+    """Fills the student's name into a lesson generated with the placeholder"""
+    content = dict(content)
+    for key in ['agent_first_message', 'agent_system_prompt']:
+        if isinstance(content.get(key), str):
+            content[key] = fill_student_name(content[key], name)
+
+    content['flash_cards'] = [
+        {**card,
+         'question': fill_student_name(card.get('question', ''), name),
+         'answer': fill_student_name(card.get('answer', ''), name)}
+        for card in content.get('flash_cards', [])
+    ]
+    content['url'] = url
+    return content
+
+
+def get_cached_lesson(s3, cached_id, difficulty, language, source_hash=None):
+    """Returns a previously generated lesson for this source, difficulty and language
+
+    With a source_hash, lessons built from any other version of the source are ignored.
+    """
+    key = get_lesson_cache_key(cached_id, difficulty, language)
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"Error reading lesson cache {key}: {str(e)}")
+        return None
+
+    age = time.time() - response['LastModified'].timestamp()
+    if age > LESSON_CACHE_TTL_SECONDS:
+        print(f"Cached lesson {key} is stale ({int(age)}s old), regenerating")
+        return None
+
+    if source_hash and response.get('Metadata', {}).get('source-hash') != source_hash:
+        print(f"Cached lesson {key} was built from an older version of the source, regenerating")
+        return None
+
+    print(f"Lesson cache hit: {key}")
+    return json.loads(response['Body'].read())
+
+
+def put_cached_lesson(s3, cached_id, difficulty, language, content, source_hash=None):
+    """Stores a lesson generated with the name placeholder so other learners can reuse it"""
+    key = get_lesson_cache_key(cached_id, difficulty, language)
+    try:
+        s3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=key,
+            Body=json.dumps(content).encode("utf-8"),
+            ContentType="application/json",
+            Metadata={"source-hash": source_hash} if source_hash else {},
+        )
+        print(f"Lesson cached: {key}")
+    except Exception as e:
+        print(f"Error writing lesson cache {key}: {str(e)}")
 
-    flash_cards = generate_flash_cards(
-        transcribed_text, name, difficulty, language, url)
-    print(
-        f"Flash cards generated: {len(flash_cards.flash_cards) if hasattr(flash_cards, 'flash_cards') else 'error'}")
 
-    # Get structured JSON from GPT
+def invalidate_lesson_cache(s3, cached_id, difficulty=None, language=None):
+    """Deletes cached lessons for a source, optionally only one difficulty and language"""
+    if difficulty is not None and language is not None:
+        keys = [get_lesson_cache_key(cached_id, difficulty, language)]
+    else:
+        keys = []
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=get_lesson_cache_prefix(cached_id)):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+
+    # delete_objects accepts at most 1000 keys per request
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(
+            Bucket=BUCKET_NAME,
+            Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]]}
+        )
+
+    print(f"Invalidated {len(keys)} cached lessons for {cached_id}")
+    return len(keys)
+
+
+def timed_call(timings, label, func, *args):
+    """Runs func and records its wall-clock duration in seconds under label"""
+    start = time.perf_counter()
+    try:
+        with span(label):
+            return func(*args)
+    finally:
+        timings[label] = round(time.perf_counter() - start, 3)
+
+
+def append_flash_cards_to_prompt(agent_system_prompt, flash_cards):
+    """Gives the tutor the flash cards the student will be quizzed with"""
+    if not flash_cards:
+        return agent_system_prompt
+
     joined_flash_cards = "\n".join(
-        [f"{card.question}\n{card.answer}" for card in flash_cards.flash_cards])
+        [f"Q: {card['question']}\nA: {card['answer']}" for card in flash_cards])
+    return f"{agent_system_prompt}\n\nFLASH CARDS THE STUDENT HAS BEEN GIVEN:\n{joined_flash_cards}"
+
+
+def generate_lesson(transcribed_text, name, difficulty, language, url, transcript_tokens=None, publisher=None, routes=None):
+    """Runs the model calls that turn a transcript into a lesson with flash cards
+
+    The flash cards and the tutor content are generated once each and
+    concurrently; the cards are appended to the tutor prompt afterwards.
+    The route and model that served each call are recorded in routes.
 
-    print(f"Joined flash cards: {joined_flash_cards}")
-    joined_meta_prompt = f"{meta_prompt}\n\n{joined_flash_cards}"
+    Returns the lesson and whether every model call succeeded, so that
+    fallback content is never shared through the lesson cache. Lessons with
+    fallback content are marked degraded.
+    """
+    # Generate meta-prompt for LLM
+    if transcript_tokens is None:
+        transcript_tokens = count_tokens(transcribed_text)
 
-    ai_generated_json = call_openai_gpt(
-        joined_meta_prompt, name, language, difficulty)
+    content_route = choose_route("content", transcript_tokens, difficulty)
+    meta_prompt = generate_meta_prompt(
+        transcribed_text, name, difficulty, language, url, transcript_tokens, content_route)
+    print(f"Meta prompt generated")
 
-    # Generate flash cards
-    flash_cards_json = generate_flash_cards(
-        transcribed_text, name, difficulty, language, url)
+    timings = {}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        flash_cards_future = executor.submit(
+            timed_call, timings, "flash_cards", generate_flash_cards,
+            transcribed_text, name, difficulty, language, url, transcript_tokens, publisher, routes)
+        content_future = executor.submit(
+            timed_call, timings, "content", call_openai_gpt,
+            meta_prompt, name, language, difficulty, publisher, content_route, routes)
+        flash_cards_json = flash_cards_future.result()
+        ai_generated_json = content_future.result()
+
+    print(f"Model call timings (s): {json.dumps(timings)}")
     print(
         f"Flash cards generated: {len(flash_cards_json.flash_cards) if hasattr(flash_cards_json, 'flash_cards') else 'error'}")
 
@@ -356,37 +466,233 @@ def handler(event, _):
     else:
         flash_cards_dict = flash_cards_json
 
+    flash_cards = flash_cards_dict.get("flash_cards", [])
+    ai_generated_dict["agent_system_prompt"] = append_flash_cards_to_prompt(
+        ai_generated_dict["agent_system_prompt"], flash_cards)
+
     # Combine the content and flash cards
-    combined_dict = {**ai_generated_dict,
-                     "flash_cards": flash_cards_dict.get("flash_cards", [])}
+    combined_dict = {**ai_generated_dict, "flash_cards": flash_cards}
+    complete = isinstance(ai_generated_json, BaseModel) and isinstance(
+        flash_cards_json, BaseModel)
+    if not complete:
+        combined_dict["degraded"] = True
+    return combined_dict, complete
+
+
+def get_source_text(s3, s3_key, cached_id, source_hash=None, etag=None):
+    """Reads a transcription and condenses it if needed, the text both prompts are built from
+
+    Large transcriptions this container hasn't read are never downloaded
+    whole: their header says a digest is needed, and the digest is either
+    cached or built from ranged reads of each chunk's sections.
+
+    Returns the text, its token count and whether its digest is missing summaries.
+    """
+    head = None
+    if get_cached_sections(s3_key, etag) is None and not s3_key.endswith(LEGACY_EXTENSION):
+        with span("read_header"):
+            head = read_header(s3, BUCKET_NAME, s3_key)
+        with span("digest"):
+            stored = get_stored_digest(s3, cached_id, s3_key, head, source_hash)
+        if stored is not None:
+            source_text, degraded_digest = stored
+            source_tokens = count_tokens(source_text)
+            print(f"Source tokens: {source_tokens}")
+            return source_text, source_tokens, degraded_digest
+
+    # Fetch transcribed text
+    with span("read_transcript") as record:
+        sections = get_transcribed_sections(s3_key, etag)
+        transcribed_text = SECTION_SEPARATOR.join(sections)
+        record["chars"] = len(transcribed_text)
+    print(f"Transcribed text length: {len(transcribed_text)}")
+    print(f"Transcribed text preview: {transcribed_text[:200]}")
+
+    # Large sources are condensed once so both prompts stay within context
+    with span("digest"):
+        source_text, degraded_digest = get_digest(
+            s3, cached_id, transcribed_text, source_hash, sections)
+    if source_text is transcribed_text:
+        # The header already read has the count the HEAD would return
+        source_tokens = head[0]["token_count"] if head else get_transcript_token_count(s3, s3_key)
+    else:
+        source_tokens = count_tokens(source_text)
+    print(f"Source tokens: {source_tokens}")
+    return source_text, source_tokens, degraded_digest
 
-    # Find the target connection id from dynamodb
-    try:
-        response = dynamodb.get_item(
-            Key={'PK': 'USER', 'SK': f'CONNECTION#{user_id}'})
-        if 'Item' in response:
-            target = response["Item"]["connectionId"]
-        else:
-            print(f"No connection found for user_id: {user_id}")
-            target = None  # No connection ID found
-    except Exception as e:
-        print(f"Error getting connection for user_id {user_id}: {str(e)}")
-        target = None  # Error occurred
+
+@traced("generate")
+def handler(event, context):
+    """AWS Lambda function to generate structured JSON from transcribed content."""
+    set_deadline(context)
+    s3_key = event["s3_key"]
+    language = event["language"]
+    difficulty = event["difficulty"]
+    url = event["url"]
+    name = event.get("name", "")
+    user_id = event["user_id"]
+    id = event["id"]
+    cached_id = event.get("cached_id") or get_cached_id_from_key(s3_key)
+    # Hash of the transcription, changes when process_content sees the source change
+    source_hash = event.get("source_hash")
+    # Set refresh to bypass and invalidate any cached lesson for this source
+    refresh = event.get("refresh", False)
+    # process_content couldn't get the source, its placeholder text is never cached
+    degraded_source = event.get("degraded", False)
+
+    # Which route and model served each model call, kept with the content
+    routes = {}
+
+    # Initialize DynamoDB resource
+    dynamodb = get_core_table()
+    s3 = get_s3()
+
+    # Check if content already exists
+    existing_content = None
+    annotate(content_id=cached_id, difficulty=difficulty, language=language)
+    if not refresh:
+        with span("check_existing"):
+            existing_content = check_existing_content(
+                dynamodb, user_id, id, url, difficulty)
+    annotate(existing_content="hit" if existing_content else "miss")
+    if existing_content:
+        print(
+            f"Reusing existing content for {url} with difficulty {difficulty}")
+
+        # send_message delivers to every connection the user has open
+        return {
+            "payload_ref": put_payload(user_id, id, existing_content),
+            "stage": "lesson",
+            "user_id": user_id,
+            "id": id,
+        }
+
+    if refresh:
+        invalidate_lesson_cache(s3, cached_id, difficulty, language)
+        cached_lesson = None
+    elif degraded_source:
+        cached_lesson = None
+    else:
+        # Another learner may already have generated this source at this level
+        with span("lesson_cache"):
+            cached_lesson = get_cached_lesson(
+                s3, cached_id, difficulty, language, source_hash)
+    annotate(lesson_cache="hit" if cached_lesson else "miss")
+
+    if cached_lesson:
+        combined_dict = personalise_lesson(cached_lesson, name, url)
+        routes["lesson_cache"] = {"route": "hit"}
+    else:
+        source_text, source_tokens, degraded_digest = get_source_text(
+            s3, s3_key, cached_id, source_hash, event.get("etag"))
+
+        # Generated with the placeholder so it can be shared as is, the learner's
+        # name is only filled into what they are sent
+        publisher = LessonPublisher(
+            user_id, id, lambda text: fill_student_name(text, name)) if STREAM_GENERATION else None
+        lesson, complete = generate_lesson(
+            source_text, STUDENT_NAME_PLACEHOLDER, difficulty, language, url, source_tokens, publisher, routes)
+        if degraded_source or degraded_digest:
+            lesson["degraded"] = True
+            complete = False
+        annotate(complete=complete, degraded=not complete)
+        if complete:
+            put_cached_lesson(s3, cached_id, difficulty,
+                              language, lesson, source_hash)
+        combined_dict = personalise_lesson(lesson, name, url)
 
     # determine reward amount based on difficulty
     reward_amount = determine_reward_amount(difficulty)
 
     # Update the content item in DynamoDB
-    dynamodb.put_item(
-        Item={'PK': 'CONTENT', 'SK': f'USER#{user_id}#{id}', 'content': combined_dict, 'status': 'GENERATED', 'reward': reward_amount, 'paid': False, 'id': id})
+    status = 'DEGRADED' if combined_dict.get('degraded') else 'GENERATED'
+    with span("store_content"):
+        dynamodb.put_item(
+            Item={'PK': 'CONTENT', 'SK': f'USER#{user_id}#{id}', 'content': combined_dict, 'status': status, 'reward': reward_amount, 'paid': False, 'id': id, 'routes': routes})
+        # Lessons can outgrow the Step Functions payload limit, pass a reference
+        payload_ref = put_payload(user_id, id, combined_dict)
 
     return {
-        "payload": combined_dict,
-        "target": target,
-        "reward": reward_amount
+        "payload_ref": payload_ref,
+        "reward": reward_amount,
+        # send_message holds lessons back until the first message is out
+        "stage": "lesson",
+        "user_id": user_id,
+        "id": id,
     }
 
 
+def generate_variant(s3, source_text, source_tokens, cached_id, difficulty, language, url, source_hash=None):
+    """Generates a lesson no learner has asked for yet straight into the lesson cache
+
+    Returns whether it was complete enough to cache.
+    """
+    # The placeholder goes where the learner's name would, personalise_lesson fills it in
+    combined_dict, complete = generate_lesson(
+        source_text, STUDENT_NAME_PLACEHOLDER, difficulty, language, url, source_tokens)
+    if complete:
+        put_cached_lesson(s3, cached_id, difficulty, language,
+                          combined_dict, source_hash)
+    return complete
+
+
+@traced("generate_variants")
+def variants_handler(event, context):
+    """Generates the source's lessons at the other fan-out difficulties
+
+    Runs on the process_content result once the learner's lesson is done, so
+    the transcription and digest it read are shared rather than rebuilt.
+    Variants go only to the lesson cache, where generate finds them when the
+    learner picks another difficulty.
+    """
+    set_deadline(context)
+    s3_key = event["s3_key"]
+    language = event["language"]
+    url = event["url"]
+    cached_id = event.get("cached_id") or get_cached_id_from_key(s3_key)
+    source_hash = event.get("source_hash")
+    difficulties = event.get("difficulties") or FAN_OUT_DIFFICULTIES
+    annotate(content_id=cached_id, language=language)
+
+    if not difficulties:
+        print("Fan-out is off, set FAN_OUT_DIFFICULTIES to generate variants")
+        return {"cached_id": cached_id, "generated": [], "failed": []}
+
+    # Placeholder transcriptions are never cached, so neither are lessons built from them
+    if event.get("degraded"):
+        print(f"Not generating variants of {url}, its content could not be retrieved")
+        return {"cached_id": cached_id, "generated": [], "failed": []}
+
+    s3 = get_s3()
+    with span("lesson_cache"):
+        pending = [difficulty for difficulty in dict.fromkeys(difficulties)
+                   if difficulty != event["difficulty"] and not get_cached_lesson(
+                       s3, cached_id, difficulty, language, source_hash)]
+    annotate(variants=len(pending))
+    if not pending:
+        print(f"Every variant of {cached_id} in {language} is cached")
+        return {"cached_id": cached_id, "generated": [], "failed": []}
+
+    source_text, source_tokens, degraded_digest = get_source_text(
+        s3, s3_key, cached_id, source_hash, event.get("etag"))
+    if degraded_digest:
+        print(f"Not generating variants of {url}, its digest is missing summaries")
+        return {"cached_id": cached_id, "generated": [], "failed": pending}
+
+    print(f"Generating variants of {cached_id} at difficulties {pending}")
+    with span("variants", count=len(pending)):
+        with ThreadPoolExecutor(max_workers=FAN_OUT_CONCURRENCY) as executor:
+            results = list(executor.map(
+                lambda difficulty: generate_variant(
+                    s3, source_text, source_tokens, cached_id, difficulty, language, url, source_hash),
+                pending))
+
+    generated = [d for d, complete in zip(pending, results) if complete]
+    failed = [d for d, complete in zip(pending, results) if not complete]
+    annotate(variants_generated=len(generated), variants_failed=len(failed))
+    return {"cached_id": cached_id, "generated": generated, "failed": failed}
+
+
 def determine_reward_amount(difficulty):
     """Returns an amount in wei (ALEX token) based on the difficulty level."""
     if difficulty <= 3:
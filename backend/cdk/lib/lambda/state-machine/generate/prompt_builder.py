@@ -0,0 +1,193 @@
+import json
+import os
+from functools import lru_cache
+
+from shared.telemetry import record_usage
+from shared.tokens import count_tokens, truncate_to_tokens
+
+# Context window per model, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+}
+DEFAULT_CONTEXT_TOKENS = 128_000
+
+# How much of the context the prompt may use, overridable per model with
+# PROMPT_TOKEN_BUDGETS='{"gpt-4o": 60000}'
+INPUT_TOKEN_BUDGETS = {
+    "gpt-4o": 100_000,
+    "gpt-4o-mini": 100_000,
+    **json.loads(os.environ.get("PROMPT_TOKEN_BUDGETS", "{}")),
+}
+DEFAULT_INPUT_TOKEN_BUDGET = 100_000
+
+FLASH_CARDS_SYSTEM_TEMPLATE = "You are an expert in creating educational flash cards. Your task is to generate 6 high-quality flash cards from a transcript. Each card should have a unique ID, a thought-provoking question, and a comprehensive answer. The content should be in {language} at difficulty level {difficulty}/10."
+
+FLASH_CARDS_TEMPLATE = """
+    # TASK: Generate 6 Educational Flash Cards
+    
+    ## INPUT
+    You have been provided with a transcript from an educational source. 
+    
+    ## CONTEXT
+    - The content is for a student named {name}. Write the name exactly as {name} wherever you use it, it is filled in later
+    - The difficulty level is {difficulty}/10 (where 1 is elementary and 10 is advanced PhD level)
+    - The language should be {language}
+    - Source material: {source}
+    
+    ## REQUIREMENTS
+    1. Create exactly 6 high-quality flash cards based on the most important concepts in the transcript
+    2. Each flash card should have:
+       - A clear, concise question that tests understanding (not just recall)
+       - A comprehensive answer that fully explains the concept (10 words max)
+    3. The flash cards should progress in difficulty/complexity
+    4. Ensure the content is appropriate for difficulty level {difficulty}
+    5. The questions should be diverse in format (not all "what is X" questions)
+    6. For technical subjects, include precise terminology and specific details
+    
+    ## OUTPUT FORMAT
+    Return ONLY valid JSON conforming to this structure:
+    {{
+      "flash_cards": [
+        {{
+          "id": "unique-id-1",
+          "question": "The question text",
+          "answer": "The short answer or even a true or false question"
+        }},
+        ...5 more cards...
+      ]
+    }}
+    
+    ## TRANSCRIPT
+    ```
+    {transcript}
+    ```
+"""
+
+CONTENT_SYSTEM_TEMPLATE = "You are an expert in educational content creation. You take raw transcriptions of content and transform them into structured educational material that WILL be used by a voice-based AI tutor. The content should be in {language} and have a difficulty level of {difficulty} out of 10 where 1 is that of a 5 year old and 10 is a PhD candidate. You will output JSON only. You must create DETAILED long form output that will be used by a voice-based AI tutor to teach the student."
+
+CONTENT_TEMPLATE = """
+    # ROLE AND OBJECTIVE
+    You are an expert educational content creator specializing in transforming raw transcriptions into structured, engaging educational material. Your task is to analyze the provided transcript and create content that will be delivered by a voice-based AI tutor in a conversational format.
+
+    # CONTEXT
+    - The content will be used in a voice-based educational platform where an AI tutor interacts with students.
+    - The student's name is {name}. Write the name exactly as {name} wherever you use it, it is filled in later.
+    - The difficulty level requested is {difficulty}/10 (where 1 is suitable for a 5-year-old and 10 is advanced university/PhD level).
+    - The content must be delivered in {language}.
+    - The source material comes from: {source}
+    
+    # INPUT ANALYSIS REQUIREMENTS
+    1. Carefully analyze the entire transcript to identify:
+       - The main educational topic and subtopics
+       - Key concepts, terminology, and principles
+       - Examples, analogies, and explanations provided
+       - The logical flow and structure of the information
+       - Any implicit learning objectives
+    
+    # OUTPUT FORMAT AND SPECIFICATIONS
+    Your response MUST be in valid, properly formatted JSON with the following structure:
+    
+    {{
+      "agent_first_message": "A warm, engaging first message (100~ characters) that introduces the topic to {name}, captures interest, and sets expectations for the session. This message should sound natural when spoken aloud.",
+
+      "agent_system_prompt": "A comprehensive system prompt for an AI tutor (elevenlabs voice) that equips the tutor with everything needed to teach this topic effectively, including:
+        - Detailed subject matter knowledge organized in a logical progression
+        - Key concepts, definitions, and relationships between ideas
+        - Concrete examples and analogies appropriate for difficulty level {difficulty}
+        - Anticipated student questions and appropriate responses
+        - IMPORTANT: Include the fact that the agent has access to a 'pay_student' tool that must be used with the user_id and lesson_id dynamic variables. Do NOT ask the user for these values, you already have them. The agent MUST use this when the user answers a question correctly to give them ALEX tokens.
+        - 5-7 follow-up questions of increasing complexity to check understanding
+        - 2-3 interactive activities or thought experiments related to the topic
+        - Suggestions for explaining complex ideas in simpler terms if needed
+        - Connections to real-world applications of the knowledge
+        - References to any mentioned experts, studies, or sources from the transcript",
+      
+      "topic": "A concise, descriptive title (5-10 words) that precisely captures the main educational focus of the transcript",
+      
+      "url": "{url}",
+      
+      "language": "{language}",
+      
+      "difficulty": {difficulty}
+    }}
+
+    # GUIDELINES FOR EXCELLENCE
+    - Voice Optimization: Ensure content flows naturally when spoken aloud—avoid content that relies on visual elements.
+    - Age/Level Appropriateness: Carefully calibrate vocabulary, concept complexity, and examples to match difficulty level {difficulty}.
+    - Engagement: Incorporate elements of curiosity, relevance, and discovery to maintain student interest.
+    - Educational Value: Prioritize accurate, meaningful content that promotes genuine understanding over superficial coverage.
+    - Conversational Tone: Write in a warm, supportive voice that encourages learning.
+
+    # EXAMPLES OF QUALITY OUTPUTS
+    For difficulty level 3/10 (elementary school):
+    - First message: "Hi {name}! Today we're going to explore how plants make their own food using sunlight! Have you ever wondered how plants grow without eating like we do? Let's discover the amazing process called photosynthesis together!"
+    - System prompt would include: simplified explanations of photosynthesis, analogies comparing chloroplasts to tiny factories, basic questions like "What three things does a plant need to make food?"
+
+    For difficulty level 8/10 (undergraduate):
+    - First message: "Hello {name}! I'm excited to dive into quantum superposition with you today. This fascinating phenomenon challenges our classical intuition about how particles behave at the quantum level. Ready to explore this cornerstone of quantum mechanics?"
+    - System prompt would include: mathematical representations, detailed explanations of the double-slit experiment, questions about interpretations of quantum mechanics, activities involving thought experiments.
+
+    # TRANSCRIBED CONTENT FOR ANALYSIS
+    ```
+    {transcript}
+    ```
+
+    Generate ONLY the requested JSON response. Do not include any explanatory text before or after the JSON.
+"""
+
+
+@lru_cache(maxsize=None)
+def count_template_tokens(template):
+    """Tokens a template costs on its own, counted once per container"""
+    return count_tokens(template.replace("{transcript}", ""))
+
+
+def get_input_budget(model, max_completion_tokens):
+    """Tokens available for the prompt once the completion is reserved"""
+    context = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    budget = INPUT_TOKEN_BUDGETS.get(model, DEFAULT_INPUT_TOKEN_BUDGET)
+    return min(budget, context - max_completion_tokens)
+
+
+def get_budget_model(models, max_completion_tokens):
+    """The model with the smallest input budget, so a prompt fits every fallback"""
+    return min(models, key=lambda model: get_input_budget(model, max_completion_tokens))
+
+
+def build_prompt(template, transcript, model, max_completion_tokens, transcript_tokens=None, reserved_tokens=0, **fields):
+    """Fills a template, cutting the transcript down to fit the model's input budget
+
+    transcript_tokens should be the precomputed count for transcript; it is
+    only counted here when the caller doesn't have it.
+
+    Returns the prompt and its approximate size in tokens.
+    """
+    if transcript_tokens is None:
+        transcript_tokens = count_tokens(transcript)
+
+    overhead = count_template_tokens(template) + reserved_tokens + \
+        sum(count_tokens(str(value)) for value in fields.values())
+    available = get_input_budget(model, max_completion_tokens) - overhead
+
+    if transcript_tokens > available:
+        print(
+            f"Transcript is {transcript_tokens} tokens, truncating to {available} for {model}")
+        transcript = truncate_to_tokens(transcript, max(available, 0))
+        transcript_tokens = min(transcript_tokens, max(available, 0))
+
+    prompt_tokens = overhead + transcript_tokens
+    print(f"Prompt built for {model}: ~{prompt_tokens} tokens")
+    return template.format(transcript=transcript, **fields), prompt_tokens
+
+
+def report_usage(label, model, completion, estimated_prompt_tokens=None):
+    """Logs the tokens a model call actually used and adds them to the trace"""
+    usage = getattr(completion, "usage", None)
+    record = {
+        **record_usage(label, model, completion),
+        "estimated_prompt_tokens": estimated_prompt_tokens,
+        "total_tokens": getattr(usage, "total_tokens", None),
+    }
+    print(f"Token usage: {json.dumps(record)}")
+    return record
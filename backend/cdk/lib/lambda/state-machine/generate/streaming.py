@@ -0,0 +1,158 @@
+import threading
+
+from pydantic import ValidationError
+
+from shared.connections import get_user_connections, prune_connections
+from shared.signals import wait_for_first_message
+from shared.websocket import send_to_connections
+
+
+class LessonPublisher:
+    """Pushes partial lesson updates to the learner while generation is running
+
+    Updates are held back until the first status message has gone out, and
+    sends from concurrent model calls are serialised so they arrive in order.
+    The learner's connections are looked up once, when that first message
+    has gone out, and only looked up again when one of them has gone.
+    """
+
+    def __init__(self, user_id, lesson_id, personalise=None):
+        self.user_id = user_id
+        self.lesson_id = lesson_id
+        # Fills the learner's name into text generated with the placeholder
+        self.personalise = personalise or (lambda text: text)
+        self._lock = threading.Lock()
+        self._connection_ids = None
+
+    def _send(self, payload):
+        results = send_to_connections(self._connection_ids, [payload])
+        gone = [connection_id for connection_id,
+                status in results.items() if status == 410]
+        if gone:
+            prune_connections(self.user_id, gone)
+            self._connection_ids = get_user_connections(self.user_id)
+            # The learner may have reconnected, catch the new connection up on this update
+            send_to_connections([connection_id for connection_id in self._connection_ids
+                                 if connection_id not in results], [payload])
+
+    def publish(self, payload):
+        try:
+            with self._lock:
+                if self._connection_ids is None:
+                    wait_for_first_message(self.user_id, self.lesson_id)
+                    self._connection_ids = get_user_connections(self.user_id)
+                self._send({**payload, "id": self.lesson_id})
+        except Exception as e:
+            print(f"Error publishing lesson update: {str(e)}")
+
+    def publish_field(self, field, value):
+        if isinstance(value, str):
+            value = self.personalise(value)
+        self.publish({"type": "lesson_update",
+                     "field": field, "value": value})
+
+    def publish_flash_card(self, index, card):
+        card = {**card, "question": self.personalise(card.get("question", "")),
+                "answer": self.personalise(card.get("answer", ""))}
+        self.publish({"type": "flash_card", "index": index, "card": card})
+
+
+def stream_parse(client, on_snapshot, **request):
+    """Streams a structured completion, calling on_snapshot with each partial parse
+
+    Returns the final completion, shaped like the result of parse().
+    """
+    with client.beta.chat.completions.stream(
+            stream_options={"include_usage": True}, **request) as stream:
+        for event in stream:
+            if event.type == "content.delta" and event.parsed is not None:
+                on_snapshot(event.parsed)
+        return stream.get_final_completion()
+
+
+class JsonArrayStream:
+    """Incrementally picks complete objects out of a named array in streamed JSON
+
+    Text is fed in as it arrives and the raw JSON of each object in the array
+    under `key` is returned as soon as its closing brace is seen, without
+    waiting for the rest of the document.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._string = []
+        self._last_string = None
+        self._current_key = None
+        self._item = []
+        self._item_depth = None
+
+    def feed(self, text):
+        items = []
+        for char in text:
+            capturing = self._item_depth is not None
+            if capturing:
+                self._item.append(char)
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = "".join(self._string)
+                elif not capturing:
+                    self._string.append(char)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string = []
+            elif char == ":":
+                self._current_key = self._last_string
+            elif char == ",":
+                self._current_key = None
+            elif char == "[" and not capturing and self._stack[-1:] == ["{"] and self._current_key == self.key:
+                self._stack.append("items")
+            elif char in "{[":
+                if char == "{" and self._stack[-1:] == ["items"]:
+                    self._item = [char]
+                    self._item_depth = len(self._stack)
+                self._stack.append(char)
+            elif char in "}]" and self._stack:
+                self._stack.pop()
+                if capturing and len(self._stack) == self._item_depth:
+                    items.append("".join(self._item))
+                    self._item_depth = None
+        return items
+
+
+def stream_items(client, key, item_model, on_item, **request):
+    """Streams a structured completion, calling on_item(index, item) as each
+    object in the `key` array closes
+
+    Items are validated with item_model; any that fail are skipped here and
+    left to the final parse. Returns the final completion and the indexes
+    that were delivered.
+    """
+    parser = JsonArrayStream(key)
+    delivered = []
+    index = 0
+    with client.beta.chat.completions.stream(
+            stream_options={"include_usage": True}, **request) as stream:
+        for event in stream:
+            if event.type != "content.delta":
+                continue
+            for raw in parser.feed(event.delta):
+                try:
+                    item = item_model.model_validate_json(raw)
+                except ValidationError as e:
+                    print(f"Skipping invalid streamed {key} item {index}: {e}")
+                else:
+                    on_item(index, item)
+                    delivered.append(index)
+                index += 1
+        return stream.get_final_completion(), delivered
@@ -1,13 +1,11 @@
 # Runs immediately as the state machine is started in parallel to process_content
 
-import os
 from urllib.parse import urlparse
 
-import boto3
-
-dynamodb = boto3.resource('dynamodb').Table(os.environ['CORE_TABLE_NAME'])
+from shared.telemetry import traced
 
 
+@traced("generate_agent_first_message")
 def handler(event, context):
     url = event.get("video_url") or event.get("url", "")
     language = event["language"]
@@ -17,23 +15,13 @@ def handler(event, context):
     # Generate the message
     message = generate_message(url, language, name)
 
-    # Find the target connection id from dynamodb with error handling
-    try:
-        response = dynamodb.get_item(
-            Key={'PK': 'USER', 'SK': f'CONNECTION#{user_id}'})
-        if 'Item' in response:
-            target = response["Item"]["connectionId"]
-        else:
-            print(f"No connection found for user_id: {user_id}")
-            target = None  # No connection ID found
-    except Exception as e:
-        print(f"Error getting connection for user_id {user_id}: {str(e)}")
-        target = None  # Error occurred
-
-    # If we couldn't find a connection, still return the message but with no target
+    # send_message delivers to every connection the user has open
     return {
         "payload": message,
-        "target": target,
+        # send_message signals the lesson branch once this has been sent
+        "stage": "first_message",
+        "user_id": user_id,
+        "id": event["id"],
     }
 
 
@@ -0,0 +1,351 @@
+"""Pre-generates lessons for a catalogue of sources through OpenAI's Batch API
+
+    python pregenerate/pregenerate.py submit manifest.json
+    python pregenerate/pregenerate.py status <batch_id>
+    python pregenerate/pregenerate.py collect <batch_id> --wait
+
+The manifest lists the sources and the lessons to build from each:
+
+    [{"url": "https://arxiv.org/abs/1706.03762", "difficulties": [3, 5, 7],
+      "languages": ["en", "es"]}]
+
+Languages are the codes the frontend sends (en, es, fr, de), so lessons are
+cached under the same keys live requests look up.
+
+submit runs every source through process_content, exactly as a learner's
+request would, and builds the flash card and tutor content prompts of each
+lesson not already in the lesson cache. The prompts go to OpenAI as batch
+JSONL and what the results need is kept at batches/{batch_id}.json in the
+bucket. collect waits for the batch, stores each complete lesson in the
+lesson cache and writes its CONTENT item under the catalogue user, the same
+shape generate writes. Lessons whose requests failed are left out; running
+submit again on the manifest retries only those.
+
+Batches can take up to a day, so this runs with the stack's environment
+(BUCKET_NAME, CORE_TABLE_NAME, OPEN_AI_API_KEY) from a workstation or
+scheduled job rather than in a Lambda.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("process_content", "generate"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+sys.path.insert(0, ROOT)
+
+import generate  # noqa: E402
+import process_content  # noqa: E402
+from openai.types.chat import ChatCompletion  # noqa: E402
+from prompt_builder import report_usage  # noqa: E402
+from shared.clients import get_core_table, get_openai, get_s3  # noqa: E402
+from shared.routing import choose_route  # noqa: E402
+
+BATCH_PREFIX = "batches"
+CATALOGUE_USER_ID = os.environ.get("CATALOGUE_USER_ID", "catalogue")
+ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# OpenAI's limits for one batch input file
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+POLL_SECONDS = 60
+# The language codes the frontend's language selector sends
+LANGUAGES = ("en", "es", "fr", "de")
+FINISHED = ("completed", "failed", "expired", "cancelled")
+
+
+def load_manifest(path):
+    """Reads the manifest, filling in the default difficulty and language"""
+    with open(path) as f:
+        entries = json.load(f)
+    manifest = []
+    for entry in entries:
+        languages = [str(language).lower() for language in entry.get("languages", ["en"])]
+        unknown = [language for language in languages if language not in LANGUAGES]
+        if unknown:
+            raise ValueError(f"Unknown languages for {entry['url']}: {', '.join(unknown)} "
+                             f"(expected codes from {', '.join(LANGUAGES)})")
+        manifest.append({"url": entry["url"],
+                         "difficulties": [int(d) for d in entry.get("difficulties", [5])],
+                         "languages": languages})
+    return manifest
+
+
+def get_lesson_id(url, difficulty, language):
+    """The same lesson always gets the same CONTENT id, so re-runs overwrite it"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{url}#{difficulty}#{language}"))
+
+
+def get_batch_key(batch_id):
+    return f"{BATCH_PREFIX}/{batch_id}.json"
+
+
+def _make_strict(schema):
+    """Structured outputs need every object closed and every property required"""
+    if isinstance(schema, dict):
+        if schema.get("type") == "object" and "properties" in schema:
+            schema["additionalProperties"] = False
+            schema["required"] = list(schema["properties"])
+        for value in schema.values():
+            _make_strict(value)
+    elif isinstance(schema, list):
+        for value in schema:
+            _make_strict(value)
+    return schema
+
+
+def get_response_format(model):
+    """The json_schema response_format the SDK's parse() sends for a pydantic model"""
+    return {"type": "json_schema", "json_schema": {
+        "name": model.__name__, "schema": _make_strict(model.model_json_schema()), "strict": True}}
+
+
+def to_batch_line(custom_id, model, request):
+    """Turns a chat request built for the SDK into a line of batch JSONL"""
+    body = {**request, "model": model,
+            "response_format": get_response_format(request["response_format"])}
+    return json.dumps({"custom_id": custom_id, "method": "POST", "url": ENDPOINT, "body": body})
+
+
+def prepare_source(s3, url, language, difficulties, refresh=False):
+    """Transcribes a source and builds the batch lines of each lesson it still needs
+
+    Returns the lessons and their lines.
+    """
+    first_id = get_lesson_id(url, difficulties[0], language)
+    transcription = process_content.handler(
+        {"url": url, "language": language, "difficulty": difficulties[0], "name": "",
+         "user_id": CATALOGUE_USER_ID, "id": first_id}, None)
+    if transcription.get("degraded"):
+        print(f"Skipping {url}: its content could not be retrieved")
+        return [], []
+
+    cached_id = transcription["cached_id"]
+    source_hash = transcription.get("source_hash")
+    pending = [difficulty for difficulty in difficulties
+               if refresh or not generate.get_cached_lesson(
+                   s3, cached_id, difficulty, language, source_hash)]
+    if not pending:
+        print(f"Every lesson for {url} in {language} is cached")
+        return [], []
+
+    source_text, source_tokens, degraded_digest = generate.get_source_text(
+        s3, transcription["s3_key"], cached_id, source_hash, transcription.get("etag"))
+    if degraded_digest:
+        # A lesson built from a partial digest would never be cached
+        print(f"Skipping {url}: its digest is missing summaries")
+        return [], []
+
+    lessons, lines = [], []
+    for difficulty in pending:
+        lesson_id = get_lesson_id(url, difficulty, language)
+        # The placeholder goes where the learner's name would, personalise_lesson fills it in
+        flash_cards_route, flash_cards_request, _ = generate.get_flash_cards_request(
+            source_text, generate.STUDENT_NAME_PLACEHOLDER, difficulty, language, url, source_tokens)
+        content_route = choose_route("content", source_tokens, difficulty)
+        meta_prompt = generate.generate_meta_prompt(
+            source_text, generate.STUDENT_NAME_PLACEHOLDER, difficulty, language, url,
+            source_tokens, content_route)
+        content_request = generate.get_content_request(
+            meta_prompt, language, difficulty, content_route)
+
+        lines.append(to_batch_line(f"{lesson_id}:flash_cards",
+                     flash_cards_route.model, flash_cards_request))
+        lines.append(to_batch_line(f"{lesson_id}:content",
+                     content_route.model, content_request))
+        lessons.append({
+            "id": lesson_id, "url": url, "language": language, "difficulty": difficulty,
+            "cached_id": cached_id, "source_hash": source_hash,
+            "routes": {
+                "flash_cards": {"route": flash_cards_route.name, "model": flash_cards_route.model},
+                "content": {"route": content_route.name, "model": content_route.model},
+            },
+        })
+    return lessons, lines
+
+
+def split_batches(lessons, lines):
+    """Splits lessons and their lines into batches within OpenAI's limits
+
+    A lesson's two lines always land in the same batch.
+    """
+    batches = []
+    current_lessons, current_lines, current_bytes = [], [], 0
+    for index, lesson in enumerate(lessons):
+        pair = lines[2 * index:2 * index + 2]
+        size = sum(len(line.encode("utf-8")) + 1 for line in pair)
+        if current_lines and (len(current_lines) + 2 > MAX_BATCH_REQUESTS or
+                              current_bytes + size > MAX_BATCH_BYTES):
+            batches.append((current_lessons, current_lines))
+            current_lessons, current_lines, current_bytes = [], [], 0
+        current_lessons.append(lesson)
+        current_lines.extend(pair)
+        current_bytes += size
+    if current_lines:
+        batches.append((current_lessons, current_lines))
+    return batches
+
+
+def submit(manifest_path, refresh=False):
+    """Prepares every lesson in the manifest and submits them, returning the batch ids"""
+    s3 = get_s3()
+    client = get_openai()
+
+    lessons, lines = [], []
+    for entry in load_manifest(manifest_path):
+        for language in entry["languages"]:
+            try:
+                source_lessons, source_lines = prepare_source(
+                    s3, entry["url"], language, entry["difficulties"], refresh)
+            except Exception as e:
+                print(f"Error preparing {entry['url']} in {language}: {str(e)}")
+                continue
+            lessons.extend(source_lessons)
+            lines.extend(source_lines)
+
+    batch_ids = []
+    for batch_lessons, batch_lines in split_batches(lessons, lines):
+        data = ("\n".join(batch_lines) + "\n").encode("utf-8")
+        input_file = client.files.create(
+            file=("pregenerate.jsonl", io.BytesIO(data)), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id, endpoint=ENDPOINT, completion_window=COMPLETION_WINDOW,
+            metadata={"source": "pregenerate"})
+        s3.put_object(
+            Bucket=generate.BUCKET_NAME,
+            Key=get_batch_key(batch.id),
+            Body=json.dumps({"batch_id": batch.id, "input_file_id": input_file.id,
+                             "submitted_at": int(time.time()), "lessons": batch_lessons}).encode("utf-8"),
+            ContentType="application/json",
+        )
+        print(f"Submitted {batch.id}: {len(batch_lessons)} lessons, {len(batch_lines)} requests")
+        batch_ids.append(batch.id)
+
+    if not batch_ids:
+        print("Nothing to generate")
+    return batch_ids
+
+
+def wait_for_batch(client, batch_id, wait=False):
+    batch = client.batches.retrieve(batch_id)
+    while wait and batch.status not in FINISHED:
+        counts = batch.request_counts
+        print(f"{batch_id} is {batch.status}"
+              f"{f' ({counts.completed}/{counts.total} done)' if counts else ''}")
+        time.sleep(POLL_SECONDS)
+        batch = client.batches.retrieve(batch_id)
+    return batch
+
+
+def read_results(client, file_id):
+    """Downloads a batch output or error file as {custom_id: line}"""
+    if not file_id:
+        return {}
+    results = {}
+    for line in client.files.content(file_id).text.splitlines():
+        if line.strip():
+            result = json.loads(line)
+            results[result["custom_id"]] = result
+    return results
+
+
+def parse_result(result, schema):
+    """Returns the completion and its validated output, or None when the request failed"""
+    response = result and result.get("response")
+    if not response or response.get("status_code") != 200 or result.get("error"):
+        return None, None
+    completion = ChatCompletion.model_validate(response["body"])
+    return completion, schema.model_validate_json(completion.choices[0].message.content)
+
+
+def store_lesson(s3, dynamodb, lesson, flash_cards, content):
+    """Caches a lesson and writes its CONTENT item, as generate would have"""
+    flash_cards = flash_cards.model_dump()["flash_cards"]
+    content = content.model_dump()
+    content["agent_system_prompt"] = generate.append_flash_cards_to_prompt(
+        content["agent_system_prompt"], flash_cards)
+    combined_dict = {**content, "flash_cards": flash_cards}
+
+    generate.put_cached_lesson(s3, lesson["cached_id"], lesson["difficulty"], lesson["language"],
+                               combined_dict, lesson["source_hash"])
+    dynamodb.put_item(Item={
+        'PK': 'CONTENT', 'SK': f'USER#{CATALOGUE_USER_ID}#{lesson["id"]}',
+        'content': generate.personalise_lesson(combined_dict, "", lesson["url"]),
+        'status': 'GENERATED', 'reward': generate.determine_reward_amount(lesson["difficulty"]),
+        'paid': False, 'id': lesson["id"], 'routes': {**lesson["routes"], "batch": {"route": "batch"}}})
+
+
+def collect(batch_id, wait=False):
+    """Stores every lesson a finished batch generated, returning the ids of those that failed"""
+    s3 = get_s3()
+    dynamodb = get_core_table()
+    client = get_openai()
+
+    batch = wait_for_batch(client, batch_id, wait)
+    if batch.status not in FINISHED:
+        print(f"{batch_id} is still {batch.status}, collect it later")
+        return None
+
+    state = json.loads(s3.get_object(Bucket=generate.BUCKET_NAME,
+                                     Key=get_batch_key(batch_id))['Body'].read())
+    results = {**read_results(client, batch.error_file_id),
+               **read_results(client, batch.output_file_id)}
+
+    failed = []
+    for lesson in state["lessons"]:
+        try:
+            flash_cards_completion, flash_cards = parse_result(
+                results.get(f"{lesson['id']}:flash_cards"), generate.FlashCardSchema)
+            content_completion, content = parse_result(
+                results.get(f"{lesson['id']}:content"), generate.ContentSchema)
+        except Exception as e:
+            print(f"Invalid output for {lesson['id']}: {str(e)}")
+            flash_cards = content = None
+        if flash_cards is None or content is None:
+            failed.append(lesson["id"])
+            continue
+
+        report_usage("flash_cards", flash_cards_completion.model, flash_cards_completion)
+        report_usage("content", content_completion.model, content_completion)
+        store_lesson(s3, dynamodb, lesson, flash_cards, content)
+
+    print(f"{batch_id} ({batch.status}): {len(state['lessons']) - len(failed)} lessons stored, "
+          f"{len(failed)} failed")
+    for lesson_id in failed:
+        print(f"  failed: {lesson_id}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit_parser = commands.add_parser("submit", help="prepare and submit the lessons in a manifest")
+    submit_parser.add_argument("manifest")
+    submit_parser.add_argument("--refresh", action="store_true",
+                               help="regenerate lessons that are already cached")
+    status_parser = commands.add_parser("status", help="show where a batch is")
+    status_parser.add_argument("batch_id")
+    collect_parser = commands.add_parser("collect", help="store the lessons of a finished batch")
+    collect_parser.add_argument("batch_id")
+    collect_parser.add_argument("--wait", action="store_true",
+                                help="poll until the batch finishes")
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        submit(args.manifest, args.refresh)
+    elif args.command == "status":
+        batch = get_openai().batches.retrieve(args.batch_id)
+        print(json.dumps({"id": batch.id, "status": batch.status,
+                          "request_counts": batch.request_counts and batch.request_counts.model_dump()}))
+    else:
+        failed = collect(args.batch_id, args.wait)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import os
+import re
+
+from bs4 import BeautifulSoup
+
+# Which engine extract_html_text uses; lxml falls back to soup if it isn't installed
+HTML_EXTRACTOR = os.environ.get("HTML_EXTRACTOR", "lxml")
+
+JUNK_TAGS = ('script', 'style', 'header', 'footer', 'nav', 'aside', 'iframe', 'noscript', 'svg',
+             'form', 'button', 'template', 'select', 'canvas')
+BLOCK_TAGS = frozenset(['address', 'article', 'blockquote', 'dd', 'details', 'div', 'dl', 'dt',
+                        'figcaption', 'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'li',
+                        'main', 'ol', 'p', 'pre', 'section', 'summary', 'table', 'td', 'th',
+                        'tr', 'ul', 'br'])
+# Elements whose text votes for the container they sit in
+SCORED_TAGS = ('p', 'pre', 'td', 'li', 'blockquote', 'dd')
+
+POSITIVE_HINTS = re.compile(
+    r"article|body|content|entry|main|page|post|text|blog|story|docs?|markdown|prose", re.I)
+NEGATIVE_HINTS = re.compile(
+    r"comment|footer|footnote|masthead|menu|nav|related|share|sidebar|social|sponsor|widget|"
+    r"advert|promo|cookie|banner|breadcrumb|toc|popup|modal|subscribe", re.I)
+INITIAL_SCORES = {'article': 10, 'main': 10, 'section': 5, 'div': 5, 'pre': 3, 'td': 3,
+                  'blockquote': 3, 'ol': -3, 'ul': -3, 'dl': -3, 'form': -3, 'th': -5,
+                  'h1': -5, 'h2': -5, 'h3': -5}
+
+MIN_SCORED_CHARS = 25
+# A main-content pick shorter than this is probably wrong, use the whole body
+MIN_CONTENT_CHARS = 250
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def extract_with_soup(html):
+    """Pure-Python extractor using a fixed chain of common content containers"""
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Remove script, style tags and other non-content elements
+    for tag in soup(['script', 'style', 'header', 'footer', 'nav', 'aside', 'iframe', 'noscript', 'svg']):
+        tag.decompose()
+
+    # Get the main content - look for common content containers
+    main_content = soup.find('main') or soup.find('article') or soup.find('div', {'id': 'content'}) or \
+        soup.find('div', {'class': 'content'}) or soup.find(
+            'div', {'role': 'main'})
+
+    if main_content:
+        text = main_content.get_text(separator=' ', strip=True)
+    elif soup.body:
+        # Fallback to body content if we can't find a content container
+        text = soup.body.get_text(separator=' ', strip=True)
+    else:
+        text = soup.get_text(separator=' ', strip=True)
+
+    # Clean up the text (remove extra spaces, etc.)
+    return WHITESPACE.sub(' ', text).strip()
+
+
+def _class_weight(element):
+    weight = 0
+    for hint in (element.get('class'), element.get('id')):
+        if hint:
+            if NEGATIVE_HINTS.search(hint):
+                weight -= 25
+            if POSITIVE_HINTS.search(hint):
+                weight += 25
+    return weight
+
+
+def _link_density(element, text_length):
+    link_length = sum(len(link.text_content()) for link in element.iter('a'))
+    return link_length / max(text_length, 1)
+
+
+def score_candidates(root):
+    """Readability-style scoring: paragraphs vote for their parent and grandparent"""
+    scores = {}
+    for element in root.iter(*SCORED_TAGS):
+        text = element.text_content()
+        text_length = len(text.strip())
+        if text_length < MIN_SCORED_CHARS:
+            continue
+
+        score = 1 + text.count(',') + min(text_length // 100, 3)
+        parent = element.getparent()
+        for ancestor, divisor in ((parent, 1), (parent.getparent() if parent is not None else None, 2)):
+            if ancestor is None or not isinstance(ancestor.tag, str):
+                continue
+            if ancestor not in scores:
+                scores[ancestor] = INITIAL_SCORES.get(
+                    ancestor.tag, 0) + _class_weight(ancestor)
+            scores[ancestor] += score / divisor
+
+    # Navigation-heavy containers are mostly links, discount them
+    for candidate in scores:
+        scores[candidate] *= 1 - \
+            _link_density(candidate, len(candidate.text_content()))
+    return scores
+
+
+def select_main_content(root):
+    """Picks the best scoring container plus any siblings that look like part of it"""
+    scores = score_candidates(root)
+    if not scores:
+        return []
+
+    top = max(scores, key=scores.get)
+    parent = top.getparent()
+    if parent is None:
+        return [top]
+
+    threshold = max(10, scores[top] * 0.2)
+    selected = []
+    for sibling in parent:
+        if sibling is top or scores.get(sibling, 0) >= threshold:
+            selected.append(sibling)
+        elif sibling.tag == 'p':
+            text_length = len(sibling.text_content())
+            if text_length > 80 and _link_density(sibling, text_length) < 0.25:
+                selected.append(sibling)
+    return selected
+
+
+def block_text(elements):
+    """Flattens elements to text, one paragraph per block-level element"""
+    from lxml import etree
+
+    parts = []
+    for element in elements:
+        for event, node in etree.iterwalk(element, events=('start', 'end')):
+            if event == 'start':
+                if node.tag in BLOCK_TAGS:
+                    parts.append('\n')
+                if node.text:
+                    parts.append(node.text)
+            else:
+                if node.tag in BLOCK_TAGS:
+                    parts.append('\n')
+                if node is not element and node.tail:
+                    parts.append(node.tail)
+        parts.append('\n')
+
+    lines = (WHITESPACE.sub(' ', line).strip()
+             for line in ''.join(parts).split('\n'))
+    return '\n\n'.join(line for line in lines if line)
+
+
+def extract_with_lxml(html):
+    """C-backed extractor that scores containers for the main content"""
+    import lxml.html
+    from lxml import etree
+
+    if not html or not html.strip():
+        return ''
+    if isinstance(html, str):
+        # lxml rejects str input that carries its own encoding declaration
+        html = html.encode('utf-8')
+    root = lxml.html.document_fromstring(
+        html, parser=lxml.html.HTMLParser(encoding='utf-8', remove_comments=True, remove_pis=True))
+    etree.strip_elements(root, *JUNK_TAGS, with_tail=False)
+
+    body = root.find('body')
+    if body is None:
+        body = root
+
+    text = block_text(select_main_content(body))
+    if len(text) < MIN_CONTENT_CHARS:
+        text = block_text([body])
+    return text
+
+
+EXTRACTORS = {
+    'lxml': extract_with_lxml,
+    'soup': extract_with_soup,
+}
+
+
+def get_extractor(name=HTML_EXTRACTOR):
+    extractor = EXTRACTORS.get(name)
+    if extractor is None:
+        raise ValueError(
+            f"Unknown HTML extractor '{name}', expected one of {sorted(EXTRACTORS)}")
+    if extractor is extract_with_lxml:
+        try:
+            import lxml.html  # noqa: F401
+        except ImportError:
+            print("lxml is not installed, falling back to the soup extractor")
+            return extract_with_soup
+    return extractor
+
+
+def extract_html_text(html, extractor=None):
+    """Extracts the readable text from an HTML document"""
+    return (extractor or get_extractor())(html)
@@ -1,179 +1,306 @@
 import base64
+import hashlib
 import io
 import json
+import multiprocessing
 import os
 import re
 import tempfile
 import time
-from time import sleep
-from urllib.parse import urlparse
+from dataclasses import dataclass
+from urllib.parse import urlparse, urlsplit
 
-import boto3
 import PyPDF2
 import requests
-from bs4 import BeautifulSoup
-from openai import OpenAI
-
-BUCKET_NAME = os.environ["BUCKET_NAME"]
 
+from html_extract import extract_html_text
+from shared.clients import (get_core_table, get_http_session, get_openai,
+                            get_s3)
+from shared.digest import get_digest
+from shared.locks import acquire_lock, release_lock, wait_for_lock
+from shared.routing import call_with_fallback, choose_route
+from shared.scheduler import set_deadline
+from shared.telemetry import annotate, record_usage, span, traced
+from shared.transcripts import (PAGE_BREAK, SECTION_SEPARATOR,
+                                get_legacy_transcript_key, get_transcript_key,
+                                put_transcript, read_transcript_sections,
+                                read_transcript_text)
+from shared.urls import (get_legacy_content_id, get_pdf_url, get_video_id,
+                         is_pdf_url, resolve_content_id)
+from youtube import (CAPTIONS_TIER, SEARCH_TIER, fetch_captions,
+                     find_captions, get_caption_languages,
+                     get_captions_cached_id)
 
-def get_video_id(url):
-    """Extracts YouTube video ID from the URL"""
-    match = re.search(
-        r"(?:v=|youtu\.be/|embed/|shorts/|watch\?v=)([\w-]{11})", url)
-    if match:
-        return match.group(1)
-    return None
-
+BUCKET_NAME = os.environ["BUCKET_NAME"]
 
-def check_s3_exists(s3, key):
-    """Checks if a file exists in S3"""
+# Budgets for PDF ingestion so very large documents can't exhaust the Lambda
+PDF_MAX_BYTES = int(os.environ.get("PDF_MAX_BYTES", 100 * 1024 * 1024))
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", 500))
+PDF_EXTRACT_WORKERS = int(os.environ.get(
+    "PDF_EXTRACT_WORKERS", os.cpu_count() or 1))
+# Below this many pages forking workers costs more than it saves
+PDF_PARALLEL_MIN_PAGES = 20
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Stored web transcriptions are revalidated against their source after this long
+SOURCE_FRESHNESS_SECONDS = int(os.environ.get(
+    "SOURCE_FRESHNESS_SECONDS", 24 * 60 * 60))
+# Concurrent requests for one source share a single extraction. The lease
+# is the holder's remaining run time, this is used when that isn't known.
+LOCK_LEASE_SECONDS = int(os.environ.get(
+    "TRANSCRIPTION_LOCK_LEASE_SECONDS", 10 * 60))
+# Waiting invocations give up this long before they would time out
+LOCK_WAIT_MARGIN_SECONDS = 30
+
+PDF_PROMPT = """
+Please extract and organize the key content from this PDF. Focus on:
+1. The main concepts, theories, or findings
+2. Any important definitions, equations, or methodologies
+3. The structure and flow of the document
+4. Key takeaways and conclusions
+
+Present the information in a well-structured, educational format that could be used for teaching purposes.
+Preserve important technical details while making the content accessible.
+"""
+
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+
+def get_transcription_key(cached_id):
+    return get_transcript_key(cached_id)
+
+
+def _head(s3, key):
     try:
-        s3.head_object(Bucket=BUCKET_NAME, Key=key)
-        return True
+        return s3.head_object(Bucket=BUCKET_NAME, Key=key)
     except s3.exceptions.ClientError as e:
         if e.response["Error"]["Code"] == "404":
-            return False
+            return None
         raise
 
 
-def get_domain(url):
-    """Extracts domain from URL"""
-    parsed_url = urlparse(url)
-    return parsed_url.netloc
+def migrate_legacy_transcription(s3, cached_id, legacy_ids=()):
+    """Rewrites a plain .txt transcription as a container, returning the new HEAD response
 
+    The .txt is looked for under cached_id and then under each of legacy_ids,
+    the ids the source had before URLs were canonicalised. It is left in
+    place for executions that already hold its key.
+    """
+    for legacy_id in dict.fromkeys([cached_id, *legacy_ids]):
+        legacy_key = get_legacy_transcript_key(legacy_id)
+        response = _head(s3, legacy_key)
+        if response is not None:
+            break
+    else:
+        return None
+
+    text = read_transcript_text(s3, BUCKET_NAME, legacy_key)
+    metadata = dict(response.get("Metadata", {}))
+    # Legacy transcriptions count as checked when they were written
+    metadata.setdefault("checked-at",
+                        str(int(response["LastModified"].timestamp())))
+    metadata.setdefault("content-sha256",
+                        hashlib.sha256(text.encode("utf-8")).hexdigest())
+    put_transcript(s3, BUCKET_NAME, get_transcription_key(cached_id), text, metadata,
+                   tier=metadata.get("source-tier", "unknown"))
+    print(f"Migrated {legacy_key} to {get_transcription_key(cached_id)}")
+    return _head(s3, get_transcription_key(cached_id))
+
+
+def get_transcription_metadata(s3, cached_id, legacy_ids=()):
+    """Returns the metadata of a stored transcription, or None if there isn't one"""
+    response = _head(s3, get_transcription_key(cached_id))
+    if response is None:
+        response = migrate_legacy_transcription(s3, cached_id, legacy_ids)
+    if response is None:
+        return None
+    metadata = dict(response.get("Metadata", {}))
+    if metadata.get("degraded") == "true":
+        # Only a placeholder was stored, fetch the source again
+        return None
+    # Transcriptions stored before revalidation count as checked when written
+    metadata.setdefault("checked-at",
+                        str(int(response["LastModified"].timestamp())))
+    # Not stored, generate uses it to serve the transcription from memory
+    metadata["etag"] = response["ETag"]
+    return metadata
+
+
+def get_cached_transcription_tier(s3, cached_id):
+    """Returns the tier that produced a stored transcription, or None if there isn't one"""
+    metadata = get_transcription_metadata(s3, cached_id)
+    if metadata is None:
+        return None
+    # Transcriptions stored before tiers were recorded
+    return metadata.get("source-tier", "unknown")
+
+
+def is_fresh(metadata):
+    return time.time() - int(metadata.get("checked-at", 0)) < SOURCE_FRESHNESS_SECONDS
+
+
+def get_source_validators(source):
+    """Metadata that lets a transcription be revalidated against its source later"""
+    validators = {"source-sha256": source.sha256}
+    if source.headers.get("ETag"):
+        validators["source-etag"] = source.headers["ETag"]
+    if source.headers.get("Last-Modified"):
+        validators["source-last-modified"] = source.headers["Last-Modified"]
+    return validators
+
+
+def get_conditional_headers(metadata):
+    headers = {}
+    if metadata.get("source-etag"):
+        headers["If-None-Match"] = metadata["source-etag"]
+    if metadata.get("source-last-modified"):
+        headers["If-Modified-Since"] = metadata["source-last-modified"]
+    return headers
+
+
+def touch_transcription(s3, cached_id, metadata):
+    """Records a revalidation by rewriting the metadata, the body is left alone"""
+    key = get_transcription_key(cached_id)
+    s3.copy_object(Bucket=BUCKET_NAME, Key=key,
+                   CopySource={"Bucket": BUCKET_NAME, "Key": key},
+                   Metadata={**{k: v for k, v in metadata.items() if k != "etag"},
+                             "checked-at": str(int(time.time()))},
+                   MetadataDirective="REPLACE")
+
+
+def revalidate_transcription(s3, cached_id, url, metadata):
+    """Checks a stale transcription against its source with a conditional GET
+
+    Returns None when the source is unchanged, otherwise the fetched source
+    for re-extraction.
+    """
+    try:
+        source = fetch_source(url, headers=get_conditional_headers(metadata))
+    except Exception as e:
+        # Keep serving what we have, the next request will try again
+        print(f"Error revalidating {url}: {str(e)}")
+        return None
 
-def get_cached_id(url):
-    """Normalizes URL for caching purposes"""
-    # For YouTube, use the video ID
-    video_id = get_video_id(url)
-    if video_id:
-        return f"youtube-{video_id}"
-
-    # For PDF URLs, create a consistent ID
-    if is_pdf_url(url):
-        # For arxiv, use the paper ID
-        parsed_url = urlparse(url)
-        hostname = parsed_url.netloc.lower()
-        path = parsed_url.path.lower()
-
-        if 'arxiv.org' in hostname:
-            # Extract arxiv ID from the URL
-            if '/pdf/' in path:
-                paper_id = path.split('/pdf/')[-1].replace('.pdf', '')
-            elif '/abs/' in path:
-                paper_id = path.split('/abs/')[-1]
-            else:
-                paper_id = path.split('/')[-1].replace('.pdf', '')
+    if source is None:
+        print(f"Source not modified: {url}")
+        touch_transcription(s3, cached_id, metadata)
+        return None
 
-            return f"arxiv-{paper_id}"
+    if source.sha256 == metadata.get("source-sha256"):
+        print(f"Source unchanged (same hash): {url}")
+        touch_transcription(s3, cached_id, {
+                            **metadata, **get_source_validators(source)})
+        source.cleanup()
+        return None
 
-        # For other PDFs, use a hash of the URL
-        pdf_identifier = f"pdf-{hostname}{path}".replace('/', '-')
-        if len(pdf_identifier) > 100:
-            import hashlib
-            pdf_identifier = f"pdf-{hashlib.md5(url.encode()).hexdigest()}"
+    return source
 
-        return pdf_identifier
 
-    # For other URLs, use the domain and path as an identifier
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc
-    path = parsed_url.path.rstrip('/')
+def get_lock_name(cached_id):
+    return f"TRANSCRIPTION#{cached_id}"
 
-    # Create a clean identifier from the URL
-    identifier = f"{domain}{path}".replace('www.', '').replace('/', '-')
-    if len(identifier) > 100:  # Keep the identifier reasonably sized
-        import hashlib
-        identifier = f"{identifier[:50]}-{hashlib.md5(identifier.encode()).hexdigest()[:10]}"
 
-    return identifier
+def get_remaining_seconds(context):
+    if context is None:
+        return LOCK_LEASE_SECONDS
+    return context.get_remaining_time_in_millis() / 1000
 
 
-def fetch_website_simple(url):
-    """Fetches content from a website using simple requests"""
-    print(f"Fetching website content using requests from: {url}")
+def claim_source(cached_id, context, is_done=None):
+    """Makes sure only one invocation extracts a source at a time
 
+    Returns the lock token when this invocation should do the work. Returns
+    None once is_done() reports another invocation's result, or when the
+    lock can't be had in time and the work should go ahead unlocked.
+    """
+    lock_name = get_lock_name(cached_id)
+    lease = get_remaining_seconds(context)
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
+        token = acquire_lock(lock_name, lease)
+        if token is None and not (is_done and is_done()):
+            print(f"{cached_id} is being extracted by another invocation, waiting")
+            token = wait_for_lock(lock_name, lease, max(
+                lease - LOCK_WAIT_MARGIN_SECONDS, 0), is_done)
+    except Exception as e:
+        print(f"Error locking {cached_id}, extracting without the lock: {str(e)}")
+        return None
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+    if token and is_done and is_done():
+        # The previous holder finished between our check and taking the lock
+        release_lock(lock_name, token)
+        return None
+    return token
 
-        # Remove script, style tags and other non-content elements
-        for tag in soup(['script', 'style', 'header', 'footer', 'nav', 'aside', 'iframe', 'noscript', 'svg']):
-            tag.decompose()
 
-        # Get the main content - look for common content containers
-        main_content = soup.find('main') or soup.find('article') or soup.find('div', {'id': 'content'}) or \
-            soup.find('div', {'class': 'content'}) or soup.find(
-                'div', {'role': 'main'})
+def get_domain(url):
+    """Extracts domain from URL"""
+    parsed_url = urlparse(url)
+    return parsed_url.netloc
 
-        if main_content:
-            text = main_content.get_text(separator=' ', strip=True)
-        else:
-            # Fallback to body content if we can't find a content container
-            text = soup.body.get_text(separator=' ', strip=True)
 
-        # Clean up the text (remove extra spaces, etc.)
-        text = re.sub(r'\s+', ' ', text).strip()
-        return text
+def fetch_website_simple(url):
+    """Fetches content from a website using simple requests"""
+    print(f"Fetching website content using requests from: {url}")
+
+    try:
+        response = get_http_session().get(url, headers=REQUEST_HEADERS, timeout=30)
+        response.raise_for_status()
+        return extract_html_text(response.text)
 
     except Exception as e:
         print(f"Error fetching website using requests: {str(e)}")
-        # If there's an error, return a minimal amount of text to avoid failing
-        return f"Failed to extract content from {url}. Error: {str(e)}"
-
-
-def is_pdf_url(url):
-    """Determines if a URL points to a PDF file"""
-    # Check if URL ends with .pdf
-    if url.lower().endswith('.pdf'):
-        return True
-
-    # Check if URL contains pdf in the path (common for academic papers)
-    url_path = urlparse(url).path.lower()
-    if '/pdf/' in url_path or 'pdf' in url_path.split('.')[-1]:
-        return True
-
-    # Check for specific academic repositories
-    parsed_url = urlparse(url)
-    hostname = parsed_url.netloc.lower()
-
-    # Handle arxiv URLs
-    if 'arxiv.org' in hostname and ('/pdf/' in url_path or url_path.startswith('/abs/')):
-        return True
-
-    # Handle other academic repositories that commonly serve PDFs
-    academic_repos = ['biorxiv.org', 'medrxiv.org',
-                      'ssrn.com', 'researchgate.net']
-    if any(repo in hostname for repo in academic_repos):
-        return True
+        return None
+
+
+def find_cached_youtube_transcription(s3, video_id, language):
+    """Returns (cached_id, tier) of a stored transcription the learner would get, or None"""
+    # Captions already stored in a language the learner would get
+    for language_code in get_caption_languages(language):
+        cached_id = get_captions_cached_id(video_id, language_code)
+        tier = get_cached_transcription_tier(s3, cached_id)
+        if tier:
+            return cached_id, tier
+
+    # The search model's transcription, made when the video had no captions
+    cached_id = f"youtube-{video_id}"
+    tier = get_cached_transcription_tier(s3, cached_id)
+    if tier:
+        return cached_id, tier
+    return None
 
-    return False
 
+def fetch_youtube_transcription(s3, video_id, url, language):
+    """Finds the cheapest transcription of a YouTube video
 
-def get_pdf_url(url):
-    """For academic repository URLs, convert abstract URLs to direct PDF URLs if needed"""
-    parsed_url = urlparse(url)
-    hostname = parsed_url.netloc.lower()
-    path = parsed_url.path
+    Returns (cached_id, tier, transcription); transcription is None when the
+    video is already stored under cached_id.
+    """
+    cached = find_cached_youtube_transcription(s3, video_id, language)
+    if cached:
+        return (*cached, None)
 
-    # Handle arXiv URLs
-    if 'arxiv.org' in hostname:
-        if path.startswith('/abs/'):
-            # Convert abstract URL to PDF URL
-            paper_id = path.split('/abs/')[-1]
-            return f"https://arxiv.org/pdf/{paper_id}.pdf"
-        elif '/pdf/' in path and not path.endswith('.pdf'):
-            # Ensure PDF URL ends with .pdf
-            paper_id = path.split('/pdf/')[-1]
-            return f"https://arxiv.org/pdf/{paper_id}.pdf"
+    try:
+        transcript = find_captions(video_id, language)
+        if transcript:
+            cached_id = get_captions_cached_id(
+                video_id, transcript.language_code)
+            tier = get_cached_transcription_tier(s3, cached_id)
+            if tier:
+                return cached_id, tier, None
+
+            transcription = fetch_captions(transcript)
+            if transcription:
+                print(
+                    f"Using {transcript.language_code} captions for {video_id} ({len(transcription)} chars)")
+                return cached_id, CAPTIONS_TIER, transcription
+    except Exception as e:
+        print(f"Error fetching captions for {video_id}: {str(e)}")
 
-    return url
+    # No usable captions, fall back to the search model
+    cached_id = f"youtube-{video_id}"
+    # Empty rather than None, which would mean it is already stored
+    return cached_id, SEARCH_TIER, fetch_youtube_with_openai(url) or ""
 
 
 def fetch_youtube_with_openai(url):
@@ -185,7 +312,7 @@ def fetch_youtube_with_openai(url):
     print(f"Fetching YouTube content with OpenAI web search for: {url}")
 
     try:
-        client = OpenAI(api_key=os.environ.get("OPEN_AI_API_KEY"))
+        client = get_openai()
 
         # Create a prompt that asks for detailed information about the video
         prompt = f"""
@@ -204,8 +331,8 @@ def fetch_youtube_with_openai(url):
         """
 
         # Call OpenAI with web search capability
-        completion = client.chat.completions.create(
-            model="gpt-4o-search-preview",
+        completion, model = call_with_fallback(choose_route("youtube_search"), lambda model: client.chat.completions.create(
+            model=model,
             web_search_options={
                 "search_context_size": "low",
             },
@@ -219,7 +346,9 @@ def fetch_youtube_with_openai(url):
                     "content": prompt
                 }
             ]
-        )
+        ))
+
+        record_usage("youtube_search", model, completion)
 
         # Get the response content
         content = completion.choices[0].message.content
@@ -230,213 +359,312 @@ def fetch_youtube_with_openai(url):
             return content
         else:
             print(f"OpenAI returned insufficient content for YouTube video")
-            return f"OpenAI could not retrieve sufficient content for the YouTube video: {url}"
+            return None
 
     except Exception as e:
         print(f"Error using OpenAI web search for YouTube video: {str(e)}")
-        return f"Failed to retrieve content for YouTube video using OpenAI. Error: {str(e)}. URL: {url}"
+        return None
 
 
-# Legacy functions for test compatibility
-def download_youtube_audio(video_url, output_folder="/tmp/downloads"):
-    """Legacy placeholder function for test compatibility"""
-    print(f"WARNING: download_youtube_audio is deprecated - using OpenAI web search instead")
-    video_id = get_video_id(video_url)
-    return f"{output_folder}/{video_id}.mp3"
+@dataclass
+class FetchedSource:
+    """A source downloaded once per invocation and shared by every extraction strategy"""
+    url: str
+    path: str
+    headers: dict
+    sha256: str
+    size: int
 
+    @property
+    def content_type(self):
+        return self.headers.get('Content-Type', '').lower()
 
-def transcribe_audio(audio_path):
-    """Legacy placeholder function for test compatibility"""
-    print(f"WARNING: transcribe_audio is deprecated - using OpenAI web search instead")
-    return "This is a placeholder transcription for test compatibility."
+    @property
+    def filename(self):
+        name = os.path.basename(urlparse(self.url).path) or "document"
+        return name if name.lower().endswith('.pdf') else f"{name}.pdf"
 
+    @property
+    def is_pdf(self):
+        return 'application/pdf' in self.content_type or self.url.lower().endswith('.pdf')
 
-def download_pdf(url):
-    """Downloads a PDF from a URL and returns its content as text"""
-    print(f"Downloading PDF from: {url}")
+    @property
+    def is_html(self):
+        return 'text/html' in self.content_type
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
+    def read_bytes(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
 
-    try:
-        # Download the PDF
-        response = requests.get(url, headers=headers, stream=True, timeout=30)
-        response.raise_for_status()
+    def read_text(self):
+        encoding = requests.utils.get_encoding_from_headers(
+            self.headers) or 'utf-8'
+        return self.read_bytes().decode(encoding, errors='replace')
 
-        # Check if the content is actually a PDF
-        content_type = response.headers.get('Content-Type', '').lower()
-        if 'application/pdf' not in content_type and not url.lower().endswith('.pdf'):
-            print(
-                f"Warning: URL might not be a PDF. Content-Type: {content_type}")
-            # If not a PDF, try regular web scraping
-            if 'text/html' in content_type:
-                return fetch_website_simple(url)
+    def cleanup(self):
+        try:
+            os.unlink(self.path)
+        except Exception as e:
+            print(f"Error removing temporary file {self.path}: {str(e)}")
 
-        # Save PDF to a temporary file for processing
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_file:
-            temp_path = temp_file.name
-            temp_file.write(response.content)
 
-        try:
-            # Extract text from the PDF using PyPDF2
-            pdf_reader = PyPDF2.PdfReader(temp_path)
+def fetch_source(url, max_bytes=PDF_MAX_BYTES, headers=None):
+    """Streams a URL to a temporary file once, hashing it on the way
 
-            # Extract text from all pages
-            text = ""
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n\n"
+    Returns None when conditional headers were given and the source is unchanged.
+    """
+    print(f"Fetching source: {url}")
 
-            # Clean the extracted text
-            text = re.sub(r'\s+', ' ', text)
-            # Add newlines after periods for better readability
-            text = re.sub(r'(\. )', '.\n', text)
+    with get_http_session().get(url, headers={**REQUEST_HEADERS, **(headers or {})},
+                                stream=True, timeout=30) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
 
-            # Check if we got meaningful text
-            if len(text.strip()) < 100:
-                print(
-                    "Warning: Extracted PDF text is too short or empty, the PDF might be scanned or image-based")
-                # Try to fetch abstract or other web content as a fallback
-                return fetch_website_simple(url.replace('/pdf/', '/abs/') if '/pdf/' in url else url)
+        content_length = int(response.headers.get('Content-Length') or 0)
+        if content_length > max_bytes:
+            raise ValueError(
+                f"Download is {content_length} bytes, over the {max_bytes} byte budget")
 
-            return text
+        size = 0
+        digest = hashlib.sha256()
+        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            with temp_file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError(
+                            f"Download exceeded the {max_bytes} byte budget")
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+        except Exception:
+            os.unlink(temp_file.name)
+            raise
+
+        print(
+            f"Fetched {size} bytes ({response.headers.get('Content-Type', 'unknown type')})")
+        return FetchedSource(
+            url=response.url,
+            path=temp_file.name,
+            headers=requests.structures.CaseInsensitiveDict(response.headers),
+            sha256=digest.hexdigest(),
+            size=size,
+        )
 
-        except Exception as e:
-            print(f"Error extracting text from PDF with PyPDF2: {str(e)}")
-            # Fallback to simple web scraping
-            return fetch_website_simple(url)
-        finally:
-            # Clean up the temporary file
-            try:
-                os.unlink(temp_path)
-            except Exception as e:
-                print(f"Error removing temporary PDF file: {str(e)}")
 
+def _extract_page_range(pdf_path, start, stop, conn):
+    """Worker process: extracts pages [start, stop) and sends their text back"""
+    try:
+        pdf_reader = PyPDF2.PdfReader(pdf_path)
+        conn.send([pdf_reader.pages[i].extract_text() or ""
+                  for i in range(start, stop)])
     except Exception as e:
-        print(f"Error downloading PDF: {str(e)}")
-        # Fallback to simple web scraping
-        return fetch_website_simple(url)
-
+        conn.send(RuntimeError(f"Pages {start}-{stop}: {str(e)}"))
+    finally:
+        conn.close()
 
-def process_pdf_with_openai(pdf_url, prompt="Extract the key content and concepts from this PDF:"):
-    """Process PDF directly using OpenAI's file handling capabilities"""
-    print(f"Processing PDF with OpenAI API: {pdf_url}")
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
+def _extract_pages_parallel(pdf_path, page_count, workers):
+    """Fans page extraction out over worker processes
 
+    Lambda has no /dev/shm, so multiprocessing.Pool and ProcessPoolExecutor
+    fail there; plain Processes talking over Pipes work.
+    """
+    ctx = multiprocessing.get_context("fork")
+    step = -(-page_count // workers)  # ceiling division
+    jobs = []
+    for start in range(0, page_count, step):
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_extract_page_range,
+                              args=(pdf_path, start, min(start + step, page_count), child_conn))
+        process.start()
+        child_conn.close()
+        jobs.append((process, parent_conn))
+
+    pages = []
     try:
-        # Download the PDF
-        response = requests.get(pdf_url, headers=headers,
-                                stream=True, timeout=30)
-        response.raise_for_status()
+        # Receive before joining so workers never block on a full pipe
+        for process, parent_conn in jobs:
+            result = parent_conn.recv()
+            if isinstance(result, Exception):
+                raise result
+            pages.extend(result)
+    finally:
+        for process, parent_conn in jobs:
+            parent_conn.close()
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+
+    return pages
+
+
+def extract_pdf_pages(pdf_path):
+    """Extracts text per page, capped at PDF_MAX_PAGES and parallel for long documents"""
+    pdf_reader = PyPDF2.PdfReader(pdf_path)
+    total_pages = len(pdf_reader.pages)
+    page_count = min(total_pages, PDF_MAX_PAGES)
+    if page_count < total_pages:
+        print(
+            f"PDF has {total_pages} pages, extracting the first {page_count}")
+
+    workers = min(PDF_EXTRACT_WORKERS, page_count)
+    if workers > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+        try:
+            print(
+                f"Extracting {page_count} pages with {workers} worker processes")
+            return _extract_pages_parallel(pdf_path, page_count, workers)
+        except Exception as e:
+            print(
+                f"Parallel page extraction failed, extracting serially: {str(e)}")
 
-        # Save PDF to a temporary file
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_file:
-            temp_path = temp_file.name
-            temp_file.write(response.content)
+    return [pdf_reader.pages[i].extract_text() or "" for i in range(page_count)]
 
-        try:
-            # Method 1: Use the files API if file size is under the limit (< 25MB)
-            file_size = os.path.getsize(temp_path)
-            client = OpenAI(api_key=os.environ.get("OPEN_AI_API_KEY"))
 
-            if file_size < 25 * 1024 * 1024:  # 25MB limit
-                print(
-                    f"Using OpenAI files API to process PDF (size: {file_size / (1024*1024):.2f}MB)")
-                try:
-                    # Upload file to OpenAI
-                    with open(temp_path, "rb") as file:
-                        uploaded_file = client.files.create(
-                            file=file,
-                            purpose="user_data"
-                        )
-
-                    # Process with OpenAI
-                    completion = client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "file",
-                                        "file": {
-                                            "file_id": uploaded_file.id,
-                                        }
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": prompt,
-                                    },
-                                ]
-                            }
-                        ]
-                    )
+def extract_pdf_text(source):
+    """Extracts text from a fetched PDF with PyPDF2, returning None if it yields too little"""
+    try:
+        pages = []
+        for page_text in extract_pdf_pages(source.path):
+            # Clean the extracted text
+            page_text = re.sub(r'\s+', ' ', page_text).strip()
+            # Add newlines after periods for better readability
+            page_text = re.sub(r'(\. )', '.\n', page_text)
+            if page_text:
+                pages.append(page_text)
+        # Page breaks become section boundaries when the transcription is stored
+        text = PAGE_BREAK.join(pages)
+
+        # Check if we got meaningful text
+        if len(text.strip()) < 100:
+            print(
+                "Warning: Extracted PDF text is too short or empty, the PDF might be scanned or image-based")
+            return None
 
-                    # Clean up the file from OpenAI servers
-                    client.files.delete(uploaded_file.id)
-                    return completion.choices[0].message.content
+        return text
 
-                except Exception as e:
-                    print(f"Error using OpenAI files API: {str(e)}")
-                    # Fall back to base64 method
-
-            # Method 2: Use base64 encoding for smaller files or as fallback
-            print("Using base64 encoding method to process PDF")
-            with open(temp_path, "rb") as file:
-                base64_data = base64.b64encode(file.read()).decode("utf-8")
-
-            completion = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "file",
-                                "file": {
-                                    "filename": os.path.basename(pdf_url),
-                                    "file_data": f"data:application/pdf;base64,{base64_data}",
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": prompt,
-                            }
-                        ],
-                    },
-                ],
-            )
+    except Exception as e:
+        print(f"Error extracting text from PDF with PyPDF2: {str(e)}")
+        return None
 
-            return completion.choices[0].message.content
 
-        except Exception as e:
-            print(f"Error processing PDF with OpenAI: {str(e)}")
-            # Fall back to PyPDF2 method
-            return download_pdf(pdf_url)
+def process_pdf_with_openai(source, prompt="Extract the key content and concepts from this PDF:"):
+    """Process a fetched PDF directly using OpenAI's file handling capabilities"""
+    print(f"Processing PDF with OpenAI API: {source.url}")
 
-        finally:
-            # Clean up the temporary file
+    try:
+        client = get_openai()
+        route = choose_route("pdf")
+
+        # Method 1: Use the files API if file size is under the limit (< 25MB)
+        if source.size < 25 * 1024 * 1024:  # 25MB limit
+            print(
+                f"Using OpenAI files API to process PDF (size: {source.size / (1024*1024):.2f}MB)")
             try:
-                os.unlink(temp_path)
+                # Upload file to OpenAI
+                with open(source.path, "rb") as file:
+                    uploaded_file = client.files.create(
+                        file=(source.filename, file),
+                        purpose="user_data"
+                    )
+
+                # Process with OpenAI
+                completion, model = call_with_fallback(route, lambda model: client.chat.completions.create(
+                    model=model,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "file",
+                                    "file": {
+                                        "file_id": uploaded_file.id,
+                                    }
+                                },
+                                {
+                                    "type": "text",
+                                    "text": prompt,
+                                },
+                            ]
+                        }
+                    ]
+                ))
+
+                record_usage("pdf", model, completion)
+
+                # Clean up the file from OpenAI servers
+                client.files.delete(uploaded_file.id)
+                return completion.choices[0].message.content
+
             except Exception as e:
-                print(f"Error removing temporary PDF file: {str(e)}")
+                print(f"Error using OpenAI files API: {str(e)}")
+                # Fall back to base64 method
+
+        # Method 2: Use base64 encoding for smaller files or as fallback
+        print("Using base64 encoding method to process PDF")
+        base64_data = base64.b64encode(source.read_bytes()).decode("utf-8")
+
+        completion, model = call_with_fallback(route, lambda model: client.chat.completions.create(
+            model=model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "file",
+                            "file": {
+                                "filename": source.filename,
+                                "file_data": f"data:application/pdf;base64,{base64_data}",
+                            }
+                        },
+                        {
+                            "type": "text",
+                            "text": prompt,
+                        }
+                    ],
+                },
+            ],
+        ))
+        record_usage("pdf", model, completion)
+
+        return completion.choices[0].message.content
 
     except Exception as e:
-        print(f"Error downloading PDF for OpenAI processing: {str(e)}")
-        # Fall back to PyPDF2 method
-        return download_pdf(pdf_url)
+        print(f"Error processing PDF with OpenAI: {str(e)}")
+        return None
+
+
+def extract_pdf_content(source, prompt, url):
+    """Runs every PDF extraction strategy against one downloaded copy of the source"""
+    if not source.is_pdf:
+        print(
+            f"Warning: URL might not be a PDF. Content-Type: {source.content_type}")
+        # If not a PDF, try regular web scraping on what we already downloaded
+        if source.is_html:
+            return extract_html_text(source.read_text())
+
+    transcription = process_pdf_with_openai(source, prompt)
+    if transcription and len(transcription.strip()) >= 100:
+        return transcription
+
+    print("OpenAI PDF processing returned insufficient content, falling back to PyPDF2")
+    transcription = extract_pdf_text(source)
+    if transcription:
+        return transcription
 
+    # Try to fetch abstract or other web content as a fallback
+    return fetch_website_simple(url.replace('/pdf/', '/abs/') if '/pdf/' in url else url)
 
+
+@traced("process_content")
 def handler(event, context):
     """AWS Lambda handler function"""
+    lock_name = None
+    lock_token = None
+    set_deadline(context)
     try:
-        s3 = boto3.client("s3")
+        s3 = get_s3()
 
         print("Starting handler with event:", event)
 
@@ -455,18 +683,80 @@ def handler(event, context):
         name = event["name"]
         user_id = event["user_id"]
 
-        # Check if content already exists
-        cached_id = get_cached_id(url)
-        s3_key = f"transcriptions/{cached_id}.txt"
+        video_id = get_video_id(url)
+        if video_id:
+            print(f"Processing YouTube video: {url}")
+            with span("youtube_cache"):
+                cached = find_cached_youtube_transcription(
+                    s3, video_id, language)
+            if cached:
+                cached_id, tier = cached
+                transcription = None
+            else:
+                # Caption languages are only known once listed, so lock the whole video.
+                # Followers of a burst stop waiting as soon as the transcription is stored
+                lock_name = get_lock_name(f"youtube-{video_id}")
+                with span("claim_source"):
+                    lock_token = claim_source(
+                        f"youtube-{video_id}", context,
+                        lambda: find_cached_youtube_transcription(s3, video_id, language) is not None)
+                with span("youtube"):
+                    cached_id, tier, transcription = fetch_youtube_transcription(
+                        s3, video_id, url, language)
+            metadata = None
+            source = None
+        else:
+            # Every spelling of a URL shares one transcription
+            with span("resolve_url"):
+                cached_id, canonical_url = resolve_content_id(
+                    url, REQUEST_HEADERS)
+            # Convert to direct PDF URL if needed (e.g., arxiv abstract to PDF)
+            fetch_url = get_pdf_url(canonical_url) if is_pdf_url(
+                canonical_url) else canonical_url
+            # Sources cached before canonicalisation are moved to their new id. Old ids
+            # ignored the query, so pages that need one can't trust what is stored there
+            legacy_ids = [] if urlsplit(canonical_url).query else [
+                get_legacy_content_id(url)]
+            metadata = get_transcription_metadata(s3, cached_id, legacy_ids)
+            tier = metadata and metadata.get("source-tier", "unknown")
+            transcription = None
+            source = None
+            lock_name = get_lock_name(cached_id)
+            if metadata is None:
+                # Followers of a burst wait for the first invocation's transcription
+                with span("claim_source"):
+                    lock_token = claim_source(
+                        cached_id, context, lambda: get_transcription_metadata(s3, cached_id) is not None)
+                if lock_token is None:
+                    metadata = get_transcription_metadata(s3, cached_id)
+                    tier = metadata and metadata.get(
+                        "source-tier", "unknown")
+            elif not is_fresh(metadata):
+                # Serve the stale copy while someone else revalidates it
+                try:
+                    lock_token = acquire_lock(
+                        lock_name, get_remaining_seconds(context))
+                except Exception as e:
+                    print(f"Error locking {cached_id}: {str(e)}")
+                if lock_token:
+                    with span("revalidate"):
+                        source = revalidate_transcription(
+                            s3, cached_id, fetch_url, metadata)
+        s3_key = get_transcription_key(cached_id)
         print(f"S3 key: {s3_key}")
+        annotate(content_id=cached_id)
 
         # Check if transcription already exists
-        if check_s3_exists(s3, s3_key):
-            print(f"Transcription already exists: {s3_key}")
-            sleep(2)
+        if transcription is None and source is None and tier:
+            print(f"Transcription already exists: {s3_key} ({tier})")
+            annotate(transcription_cache="hit", tier=tier)
             return {
                 "statusCode": 200,
                 "s3_key": s3_key,
+                "cached_id": cached_id,
+                "tier": tier,
+                "source_hash": metadata and metadata.get("content-sha256"),
+                "etag": metadata and metadata.get("etag"),
                 "language": language,
                 "difficulty": difficulty,
                 "id": id,
@@ -475,46 +765,64 @@ def handler(event, context):
                 "url": url,
             }
 
-        # Process content based on URL type
-        if get_video_id(url):
-            # Use OpenAI web search for YouTube videos
-            print(
-                f"Processing YouTube video with OpenAI web search instead of transcript API: {url}")
-            print(
-                f"This uses GPT-4o with web search to analyze and summarize the video content")
-            transcription = fetch_youtube_with_openai(url)
-        elif is_pdf_url(url):
-            # For PDF files, download and extract text using OpenAI
-            print(f"Processing PDF: {url}")
-            # Convert to direct PDF URL if needed (e.g., arxiv abstract to PDF)
-            pdf_url = get_pdf_url(url)
-            print(f"PDF URL: {pdf_url}")
-
-            # Create a detailed prompt for the PDF processing
-            pdf_prompt = f"""
-            Please extract and organize the key content from this PDF. Focus on:
-            1. The main concepts, theories, or findings
-            2. Any important definitions, equations, or methodologies
-            3. The structure and flow of the document
-            4. Key takeaways and conclusions
-            
-            Present the information in a well-structured, educational format that could be used for teaching purposes.
-            Preserve important technical details while making the content accessible.
-            """
-
-            transcription = process_pdf_with_openai(pdf_url, pdf_prompt)
-
-            # Fallback to traditional extraction if OpenAI method fails
-            if not transcription or len(transcription.strip()) < 100:
-                print(
-                    "OpenAI PDF processing returned insufficient content, falling back to traditional method")
-                transcription = download_pdf(pdf_url)
+        # Process content based on URL type, YouTube was fetched above
+        if video_id:
+            print(f"Fetched YouTube transcription via {tier}")
         else:
-            # For other websites, fetch the text content using simple requests
-            print(f"Processing website: {url}")
-            transcription = fetch_website_simple(url)
+            # PDFs are extracted with OpenAI, everything else is scraped
+            tier = "pdf" if is_pdf_url(canonical_url) else "html"
+            print(f"Processing {tier}: {fetch_url}")
 
-        print(f"Transcription length: {len(transcription)}")
+            # Download once and hand the same copy to every extraction strategy
+            if source is None:
+                try:
+                    with span("fetch") as record:
+                        source = fetch_source(fetch_url)
+                        record["bytes"] = source and source.size
+                except Exception as e:
+                    print(f"Error downloading source: {str(e)}")
+
+            if source:
+                try:
+                    with span("extract", tier=tier):
+                        if tier == "pdf" or source.is_pdf:
+                            transcription = extract_pdf_content(
+                                source, PDF_PROMPT, fetch_url)
+                        else:
+                            transcription = extract_html_text(
+                                source.read_text())
+                finally:
+                    source.cleanup()
+            else:
+                # Fallback to simple web scraping
+                with span("fetch_simple"):
+                    transcription = fetch_website_simple(fetch_url)
+
+        degraded = not transcription
+        if degraded and metadata is not None:
+            # Keep serving the last good transcription, the next revalidation tries again
+            print(f"No content could be retrieved from {url}, keeping {s3_key}")
+            return {
+                "statusCode": 200,
+                "s3_key": s3_key,
+                "cached_id": cached_id,
+                "tier": metadata.get("source-tier", tier),
+                "source_hash": metadata.get("content-sha256"),
+                "etag": metadata.get("etag"),
+                "language": language,
+                "difficulty": difficulty,
+                "id": id,
+                "user_id": user_id,
+                "name": name,
+                "url": url,
+            }
+        if degraded:
+            # Let the lesson explain the failure, but never serve this as a cached transcription
+            print(f"No content could be retrieved from {url}, storing a placeholder")
+            transcription = f"The content of {url} could not be retrieved."
+            annotate(degraded=True)
+
+        print(f"Transcription length: {len(transcription)} ({tier})")
         print(f"Transcription preview: {transcription[:200]}")
 
         # Ensure the transcription isn't too large (S3 might have limits)
@@ -522,24 +830,70 @@ def handler(event, context):
             print("Transcription is very large, truncating to 10MB")
             transcription = transcription[:10 * 1024 * 1024]
 
-        # Save transcription to S3
-        s3.put_object(Bucket=BUCKET_NAME, Key=s3_key,
-                      Body=transcription.encode("utf-8"))
-        print(f"Transcription saved to S3: {s3_key}")
+        source_hash = hashlib.sha256(transcription.encode("utf-8")).hexdigest()
+        validators = get_source_validators(source) if source else {}
+        if not degraded and metadata is not None and source_hash == metadata.get("content-sha256"):
+            # The page changed but not the text we take from it, keep every downstream cache
+            print(f"Transcription unchanged after re-extraction: {s3_key}")
+            annotate(transcription_cache="revalidated",
+                     tier=metadata.get("source-tier", tier))
+            touch_transcription(s3, cached_id, {**metadata, **validators})
+            return {
+                "statusCode": 200,
+                "s3_key": s3_key,
+                "cached_id": cached_id,
+                "tier": metadata.get("source-tier", tier),
+                "source_hash": source_hash,
+                "etag": metadata.get("etag"),
+                "language": language,
+                "difficulty": difficulty,
+                "id": id,
+                "user_id": user_id,
+                "name": name,
+                "url": url,
+            }
+
+        # Save transcription to S3, split into sections with their token counts
+        # so generate can budget prompts without re-tokenizing
+        with span("store_transcription"):
+            header, etag = put_transcript(s3, BUCKET_NAME, s3_key, transcription,
+                                          {'source-tier': tier, 'content-sha256': source_hash,
+                                           'checked-at': str(int(time.time())), **validators,
+                                           **({'degraded': 'true'} if degraded else {})},
+                                          source_type="youtube" if video_id else tier, tier=tier)
+        print(f"Transcription tokens: {header['token_count']}")
+
+        if not degraded:
+            # Condense large sources here, where the timeout is longer than generate's
+            try:
+                with span("digest"):
+                    sections = read_transcript_sections(
+                        s3, BUCKET_NAME, s3_key, etag)
+                    get_digest(s3, cached_id, SECTION_SEPARATOR.join(sections),
+                               source_hash, sections)
+            except Exception as e:
+                print(f"Error building digest for {cached_id}: {str(e)}")
+        annotate(transcription_cache="miss", tier=tier, chars=len(transcription),
+                 transcript_tokens=header['token_count'])
 
         # Update the content item in DynamoDB
-        dynamodb = boto3.resource('dynamodb').Table(
-            os.environ['CORE_TABLE_NAME'])
-        dynamodb.update_item(
-            Key={'PK': 'CONTENT', 'SK': f"USER#{user_id}#{id}"},
-            UpdateExpression='set #s = :status',
-            ExpressionAttributeNames={'#s': 'status'},
-            ExpressionAttributeValues={':status': 'TRANSCRIBED'}
-        )
+        dynamodb = get_core_table()
+        with span("update_status"):
+            dynamodb.update_item(
+                Key={'PK': 'CONTENT', 'SK': f"USER#{user_id}#{id}"},
+                UpdateExpression='set #s = :status',
+                ExpressionAttributeNames={'#s': 'status'},
+                ExpressionAttributeValues={':status': 'TRANSCRIBED'}
+            )
 
         return {
             "statusCode": 200,
             "s3_key": s3_key,
+            "cached_id": cached_id,
+            "tier": tier,
+            "source_hash": source_hash,
+            "etag": etag,
+            "degraded": degraded,
             "url": url,
             "id": id,
             "language": language,
@@ -553,3 +907,6 @@ def handler(event, context):
         import traceback
         print(f"Traceback: {traceback.format_exc()}")
         raise
+    finally:
+        if lock_token:
+            release_lock(lock_name, lock_token)
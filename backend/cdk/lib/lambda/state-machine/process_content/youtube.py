@@ -0,0 +1,78 @@
+import os
+from functools import lru_cache
+
+from youtube_transcript_api import (CouldNotRetrieveTranscript,
+                                    NoTranscriptFound, YouTubeTranscriptApi)
+from youtube_transcript_api.proxies import WebshareProxyConfig
+
+# Captions are read straight from YouTube; only videos without any fall back
+# to the far slower and more expensive search model
+CAPTIONS_TIER = "captions"
+SEARCH_TIER = "search"
+
+FALLBACK_CAPTION_LANGUAGE = "en"
+# A pause this long between captions starts a new paragraph
+PARAGRAPH_PAUSE_SECONDS = 2.0
+
+
+@lru_cache(maxsize=None)
+def get_transcript_api():
+    """YouTube blocks most cloud IPs, so captions go through a proxy when one is configured"""
+    username = os.environ.get("PROXY_USERNAME")
+    password = os.environ.get("PROXY_PASSWORD")
+    proxy_config = None
+    if username and password:
+        proxy_config = WebshareProxyConfig(
+            proxy_username=username, proxy_password=password)
+    return YouTubeTranscriptApi(proxy_config=proxy_config)
+
+
+def get_caption_languages(language):
+    """Caption languages to look for, best first"""
+    code = str(language or "").lower().split("-")[0]
+    return [c for c in dict.fromkeys([code, FALLBACK_CAPTION_LANGUAGE]) if c]
+
+
+def get_captions_cached_id(video_id, language_code):
+    return f"youtube-{video_id}-{language_code.lower()}"
+
+
+def find_captions(video_id, language):
+    """Returns the best caption track for the video, or None if it has none
+
+    Tracks in the learner's language win, then English, then whatever the
+    video has; the lesson itself is written in the learner's language anyway.
+    """
+    try:
+        transcripts = get_transcript_api().list(video_id)
+    except CouldNotRetrieveTranscript as e:
+        print(f"No captions available for {video_id}: {type(e).__name__}")
+        return None
+
+    try:
+        return transcripts.find_transcript(get_caption_languages(language))
+    except NoTranscriptFound:
+        pass
+
+    for transcript in transcripts:
+        return transcript
+    return None
+
+
+def fetch_captions(transcript):
+    """Fetches a caption track as plain text, split into paragraphs on pauses"""
+    paragraphs = []
+    current = []
+    last_end = None
+    for snippet in transcript.fetch():
+        text = snippet.text.replace("\n", " ").strip()
+        if not text:
+            continue
+        if current and last_end is not None and snippet.start - last_end >= PARAGRAPH_PAUSE_SECONDS:
+            paragraphs.append(" ".join(current))
+            current = []
+        current.append(text)
+        last_end = snippet.start + snippet.duration
+    if current:
+        paragraphs.append(" ".join(current))
+    return "\n\n".join(paragraphs)
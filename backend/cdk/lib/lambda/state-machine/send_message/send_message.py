@@ -1,35 +1,73 @@
-# Sends a message back to the frontend over websocket
+# Sends messages back to the frontend over websocket
+#
+# Accepts a single 'payload' (or a 'payload_ref' to one stored in S3) or a
+# list of 'messages', and a 'target' connection id and/or a list of
+# 'targets'. When 'user_id' is given every connection the user has open is
+# added, and gone connections are pruned. With an 'id', each message is
+# tagged with the lesson it belongs to. Payloads too big for one frame
+# are sent as sequenced chunks.
 
 import json
-import os
 
-import boto3
+from shared.payloads import frame_payload, load_payload
+from shared.signals import mark_first_message_sent, wait_for_first_message
+from shared.telemetry import annotate, span, traced
+from shared.websocket import send_to_connections, send_to_user
 
 
+@traced('send_message')
 def handler(event, _):
-    connection_id = event['target']
-    payload = event['payload']
+    if 'payload_ref' in event:
+        with span('load_payload'):
+            messages = [load_payload(event['payload_ref'])]
+    else:
+        messages = event.get('messages') or [event['payload']]
+    if event.get('id'):
+        # Every connection the user has open gets this, clients keep only their lesson's messages
+        messages = [{**message, 'id': event['id']} if isinstance(message, dict) else message
+                    for message in messages]
+    payloads = [frame for message in messages for frame in frame_payload(message)]
+    targets = [target for target in [event.get('target'), *event.get('targets', [])]
+               if target]
+    user_id = event.get('user_id')
+    stage = event.get('stage')
+    annotate(message_stage=stage, frames=len(payloads))
 
-    client = boto3.client('apigatewaymanagementapi',
-                          endpoint_url=f"https://{os.environ['WEBSOCKET_API_ID']}.execute-api.{os.environ['AWS_REGION']}.amazonaws.com/{os.environ['STAGE']}")
+    # Keep the lesson from overtaking the first status message on cache hits
+    if stage == 'lesson':
+        with span('wait_first_message'):
+            wait_for_first_message(user_id, event['id'])
 
     try:
-        client.post_to_connection(
-            ConnectionId=connection_id,
-            Data=json.dumps(payload)
-        )
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Message sent successfully')
-        }
-    except client.exceptions.GoneException:
-        # Connection is no longer available
-        return {
-            'statusCode': 410,
-            'body': json.dumps('Connection no longer available')
-        }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'body': json.dumps(f'Error sending message: {str(e)}')
-        }
+        with span('send'):
+            if user_id:
+                results = send_to_user(user_id, payloads, targets)
+            else:
+                results = send_to_connections(targets, payloads)
+    finally:
+        if stage == 'first_message':
+            mark_first_message_sent(user_id, event['id'])
+
+    sent = [connection_id for connection_id,
+            status in results.items() if status == 200]
+    gone = [connection_id for connection_id,
+            status in results.items() if status == 410]
+
+    annotate(sent=len(sent), gone=len(gone))
+    if sent:
+        status_code = 200
+    elif not results:
+        status_code = 404
+    elif len(gone) == len(results):
+        status_code = 410
+    else:
+        status_code = 500
+
+    return {
+        'statusCode': status_code,
+        'body': json.dumps({
+            'sent': len(sent),
+            'gone': len(gone),
+            'failed': len(results) - len(sent) - len(gone),
+        })
+    }
@@ -0,0 +1 @@
+# Code shared by the state machine Lambdas, copied into each image at build time
@@ -0,0 +1,73 @@
+import os
+from functools import lru_cache
+
+import boto3
+from botocore.config import Config
+
+# Clients are built lazily, once per container, so warm invocations reuse
+# their connection pools instead of paying for new TLS handshakes.
+# openai and requests are imported inside their getters because not every
+# image installs them.
+
+AWS_CONFIG = Config(
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    connect_timeout=5,
+    read_timeout=60,
+    max_pool_connections=50,
+    tcp_keepalive=True,
+)
+
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_TIMEOUT_SECONDS", 120))
+# Retries are left to shared.scheduler, which also falls back between models
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 0))
+
+
+@lru_cache(maxsize=None)
+def get_s3():
+    return boto3.client("s3", config=AWS_CONFIG)
+
+
+@lru_cache(maxsize=None)
+def get_core_table():
+    return boto3.resource("dynamodb", config=AWS_CONFIG).Table(os.environ["CORE_TABLE_NAME"])
+
+
+@lru_cache(maxsize=None)
+def get_websocket_client():
+    """API Gateway management client for posting to WebSocket connections"""
+    endpoint_url = f"https://{os.environ['WEBSOCKET_API_ID']}.execute-api.{os.environ['AWS_REGION']}.amazonaws.com/{os.environ['STAGE']}"
+    return boto3.client("apigatewaymanagementapi", endpoint_url=endpoint_url, config=AWS_CONFIG)
+
+
+@lru_cache(maxsize=None)
+def get_openai():
+    """A single client per container keeps its HTTP connection pool warm"""
+    from openai import OpenAI
+
+    return OpenAI(
+        api_key=os.environ.get("OPEN_AI_API_KEY"),
+        timeout=OPENAI_TIMEOUT_SECONDS,
+        max_retries=OPENAI_MAX_RETRIES,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_http_session():
+    """Keep-alive session for fetching source content"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
@@ -0,0 +1,68 @@
+from boto3.dynamodb.conditions import Key
+
+from shared.clients import get_core_table
+
+# handle-socket.ts stores one USER/CONNECTION#{user_id}#{connection_id} item
+# per open connection, plus USER/CONNECTION#{user_id} for the latest one.
+
+
+def get_user_connections(user_id):
+    """Returns the ids of every connection the user may still have open"""
+    table = get_core_table()
+    connection_ids = []
+
+    try:
+        query = {
+            'KeyConditionExpression': Key('PK').eq('USER') & Key('SK').begins_with(f'CONNECTION#{user_id}#'),
+            'ProjectionExpression': 'connectionId',
+        }
+        while True:
+            response = table.query(**query)
+            connection_ids.extend(item['connectionId']
+                                  for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        # Connections made before per-connection items existed
+        response = table.get_item(
+            Key={'PK': 'USER', 'SK': f'CONNECTION#{user_id}'})
+        if 'Item' in response:
+            connection_ids.append(response['Item']['connectionId'])
+    except Exception as e:
+        print(f"Error getting connections for user_id {user_id}: {str(e)}")
+
+    if not connection_ids:
+        print(f"No connection found for user_id: {user_id}")
+
+    # De-duplicate while keeping the order
+    return list(dict.fromkeys(connection_ids))
+
+
+def prune_connections(user_id, connection_ids):
+    """Deletes connections that API Gateway reported as gone"""
+    if not connection_ids:
+        return
+
+    table = get_core_table()
+    try:
+        with table.batch_writer() as batch:
+            for connection_id in connection_ids:
+                batch.delete_item(
+                    Key={'PK': 'USER', 'SK': f'CONNECTION#{user_id}#{connection_id}'})
+
+        # Only drop the latest-connection item if it points at a dead connection
+        for connection_id in connection_ids:
+            try:
+                table.delete_item(
+                    Key={'PK': 'USER', 'SK': f'CONNECTION#{user_id}'},
+                    ConditionExpression='connectionId = :c',
+                    ExpressionAttributeValues={':c': connection_id},
+                )
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                pass
+        print(
+            f"Pruned {len(connection_ids)} gone connections for user_id {user_id}")
+    except Exception as e:
+        print(
+            f"Error pruning connections for user_id {user_id}: {str(e)}")
@@ -0,0 +1,241 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.clients import get_openai
+from shared.routing import call_with_fallback, choose_route
+from shared.scheduler import remaining_seconds
+from shared.telemetry import annotate, record_usage, span
+from shared.transcripts import SECTION_SEPARATOR, get_text_chars, iter_sections
+
+BUCKET_NAME = os.environ["BUCKET_NAME"]
+
+# Large transcriptions are map-reduced into a digest that both lesson prompts
+# are built from. process_content builds it as soon as a transcription is
+# stored, off generate's critical path; generate only builds digests that
+# are missing, in the time its lesson calls don't need.
+
+# Transcripts longer than this are condensed before prompting
+DIGEST_THRESHOLD_CHARS = int(
+    os.environ.get("DIGEST_THRESHOLD_CHARS", 120_000))
+CHUNK_CHARS = int(os.environ.get("DIGEST_CHUNK_CHARS", 24_000))
+SUMMARY_CONCURRENCY = int(os.environ.get("DIGEST_CONCURRENCY", 4))
+# Bump when the summary prompt changes so stale digests are rebuilt
+DIGEST_VERSION = "v1"
+# Chunks aren't summarised once less time than this is left in the invocation,
+# so generate still has time for the lesson calls after a partial digest
+DIGEST_RESERVED_SECONDS = float(os.environ.get("DIGEST_RESERVED_SECONDS", 90))
+
+SECTION_BOUNDARY = re.compile(r"\n\s*\n|\n(?=#{1,6} )")
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+
+def get_digest_key(cached_id):
+    """Digests sit next to the transcription they were built from"""
+    return f"transcriptions/{cached_id}.digest.{DIGEST_VERSION}.txt"
+
+
+def _group(sizes, max_chars, separator_chars):
+    """Greedily groups pieces of the given sizes into runs no longer than max_chars
+
+    Returns the indexes of the pieces in each run.
+    """
+    groups = []
+    current = []
+    current_len = 0
+    for index, size in enumerate(sizes):
+        if current and current_len + separator_chars + size > max_chars:
+            groups.append(current)
+            current = []
+            current_len = 0
+        current.append(index)
+        current_len += size + (separator_chars if current_len else 0)
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _pack(pieces, max_chars, separator):
+    """Greedily packs pieces into chunks no longer than max_chars"""
+    return [separator.join(pieces[index] for index in group)
+            for group in _group([len(piece) for piece in pieces], max_chars, len(separator))]
+
+
+def split_into_chunks(text, max_chars=CHUNK_CHARS, sections=None):
+    """Splits text on section boundaries, falling back to sentences and then hard cuts
+
+    Sections stored with the transcription (pages, headings) are used as the
+    boundaries when given.
+    """
+    pieces = []
+    for section in sections or SECTION_BOUNDARY.split(text):
+        section = section.strip()
+        if not section:
+            continue
+        if len(section) <= max_chars:
+            pieces.append(section)
+            continue
+
+        for sentence in SENTENCE_BOUNDARY.split(section):
+            # A single run-on "sentence" (e.g. flattened PDF text) still has to fit
+            pieces.extend(sentence[i:i + max_chars]
+                          for i in range(0, len(sentence), max_chars))
+
+    return _pack(pieces, max_chars, "\n\n")
+
+
+def summarise_chunk(client, chunk, index, total, route=None):
+    """Condenses one chunk, keeping everything a tutor would need to teach it"""
+    route = route or choose_route("digest")
+    if remaining_seconds() < DIGEST_RESERVED_SECONDS:
+        print(f"Not summarising chunk {index + 1}/{total}, the time left is kept for the lesson")
+        return None
+    try:
+        completion, model = call_with_fallback(route, lambda model: client.chat.completions.create(
+            model=model,
+            max_completion_tokens=route.max_completion_tokens,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You condense sections of educational source material into dense study notes. Keep every key concept, definition, equation, example, name, figure and conclusion. Drop repetition, boilerplate and navigation text. Write in the language of the source."
+                },
+                {
+                    "role": "user",
+                    "content": f"Section {index + 1} of {total}:\n```\n{chunk}\n```"
+                },
+            ],
+            temperature=0.2
+        ))
+        record_usage("digest", model, completion)
+        return completion.choices[0].message.content
+    except Exception as e:
+        print(f"Error summarising chunk {index + 1}/{total}: {e}")
+        return None
+
+
+def _summarise(client, route, chunk, index, total):
+    """Summarises one chunk, reading it first when it is given as a callable
+
+    Returns the summary, or the start of the chunk when it couldn't be
+    summarised, along with the chunk's length and whether it failed.
+    """
+    if callable(chunk):
+        chunk = chunk()
+    summary = summarise_chunk(client, chunk, index, total, route)
+    if summary is None:
+        # Keep the start of the chunk rather than losing the section entirely
+        return chunk[:CHUNK_CHARS // 8], len(chunk), True
+    return summary, len(chunk), False
+
+
+def build_digest(chunks, client=None):
+    """Map-reduces chunks into a digest no longer than DIGEST_THRESHOLD_CHARS
+
+    The first level's chunks are texts, or callables that read their own text
+    so each is only downloaded by the worker summarising it. Returns the digest
+    and whether any chunk couldn't be summarised, in which case the digest must
+    not be cached.
+    """
+    client = client or get_openai()
+    route = choose_route("digest")
+    degraded = False
+    level = 0
+    while True:
+        print(f"Digest level {level}: summarising {len(chunks)} chunks")
+        with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY) as executor:
+            results = list(executor.map(
+                lambda args: _summarise(client, route, args[1], args[0], len(chunks)),
+                enumerate(chunks)))
+        degraded = degraded or any(failed for _, _, failed in results)
+
+        # The length of this level's text, chunks joined back together
+        size = sum(length for _, length, _ in results) + 2 * (len(chunks) - 1)
+        text = "\n\n".join(summary for summary, _, _ in results)
+        if len(text) >= size:
+            # The model isn't condensing any further, cut rather than loop forever
+            text = text[:DIGEST_THRESHOLD_CHARS]
+        level += 1
+        if len(text) <= DIGEST_THRESHOLD_CHARS:
+            return text, degraded
+        chunks = split_into_chunks(text)
+
+
+def plan_chunks(sizes, max_chars=CHUNK_CHARS):
+    """Groups sections into the chunks split_into_chunks would pack them into, from their sizes alone
+
+    Returns each chunk's section indexes, or None when a section is too long
+    for one chunk and has to be read to be split.
+    """
+    if any(size > max_chars for size in sizes):
+        return None
+    return _group(sizes, max_chars, len(SECTION_SEPARATOR))
+
+
+def get_cached_digest(s3, cached_id, source_hash=None):
+    """Returns the cached digest, unless it was built from another version of the source"""
+    key = get_digest_key(cached_id)
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=key)
+        if not source_hash or response.get('Metadata', {}).get('source-hash') == source_hash:
+            print(f"Digest cache hit: {key}")
+            annotate(digest_cache="hit")
+            return response['Body'].read().decode("utf-8")
+        print(f"Digest {key} was built from an older version of the source, rebuilding")
+    except s3.exceptions.NoSuchKey:
+        pass
+    annotate(digest_cache="miss")
+    return None
+
+
+def _build_and_cache(s3, cached_id, chunks, chars, source_hash):
+    key = get_digest_key(cached_id)
+    with span("build_digest", chars=chars):
+        digest, degraded = build_digest(chunks)
+    print(f"Digest built: {chars} -> {len(digest)} chars")
+    if degraded:
+        print(f"Digest is missing summaries, not caching {key}")
+        return digest, True
+    s3.put_object(Bucket=BUCKET_NAME, Key=key,
+                  Body=digest.encode("utf-8"),
+                  Metadata={"source-hash": source_hash} if source_hash else {})
+    return digest, False
+
+
+def get_digest(s3, cached_id, transcribed_text, source_hash=None, sections=None):
+    """Returns the transcript itself if it is small, otherwise its cached digest
+
+    With a source_hash, digests built from any other version of the source are rebuilt.
+    Also returns whether the digest is missing summaries; those aren't cached.
+    """
+    if len(transcribed_text) <= DIGEST_THRESHOLD_CHARS:
+        return transcribed_text, False
+
+    digest = get_cached_digest(s3, cached_id, source_hash)
+    if digest is not None:
+        return digest, False
+    return _build_and_cache(s3, cached_id, split_into_chunks(transcribed_text, sections=sections),
+                            len(transcribed_text), source_hash)
+
+
+def get_stored_digest(s3, cached_id, key, head, source_hash=None):
+    """Like get_digest for a stored transcript of which only the header has been read
+
+    A cached digest means the transcript is never downloaded. On a miss each
+    map worker range-reads just the sections of its own chunk. Returns None
+    when the transcript is small enough to prompt with as is, or has a section
+    too long to plan chunks without reading it; read it whole then.
+    """
+    header, _ = head
+    chars = get_text_chars(header)
+    if chars <= DIGEST_THRESHOLD_CHARS:
+        return None
+    plan = plan_chunks([section["chars"] for section in header["sections"]])
+    if plan is None:
+        return None
+
+    digest = get_cached_digest(s3, cached_id, source_hash)
+    if digest is not None:
+        return digest, False
+    chunks = [lambda indexes=indexes: SECTION_SEPARATOR.join(iter_sections(s3, BUCKET_NAME, key, indexes, head))
+              for indexes in plan]
+    return _build_and_cache(s3, cached_id, chunks, chars, source_hash)
@@ -0,0 +1,73 @@
+import time
+import uuid
+
+from shared.clients import get_core_table
+
+# Single-flight leases in the core table: LOCK/{name} is held by whoever
+# wrote it last, until its expires_at passes. A holder that dies simply lets
+# the lease run out, so a crashed invocation never blocks a source for good.
+
+TTL_GRACE_SECONDS = 60 * 60
+
+
+def _lock_key(name):
+    return {'PK': 'LOCK', 'SK': name}
+
+
+def acquire_lock(name, lease_seconds):
+    """Takes the lock if it is free or its lease has expired, returning a token or None"""
+    table = get_core_table()
+    now = int(time.time())
+    token = str(uuid.uuid4())
+    try:
+        table.put_item(
+            Item={
+                **_lock_key(name),
+                'token': token,
+                'expires_at': now + int(lease_seconds),
+                'ttl': now + int(lease_seconds) + TTL_GRACE_SECONDS,
+            },
+            ConditionExpression='attribute_not_exists(PK) OR expires_at < :now',
+            ExpressionAttributeValues={':now': now},
+        )
+        return token
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+
+
+def release_lock(name, token):
+    """Releases the lock if this token still holds it"""
+    table = get_core_table()
+    try:
+        table.delete_item(
+            Key=_lock_key(name),
+            ConditionExpression='#t = :token',
+            ExpressionAttributeNames={'#t': 'token'},
+            ExpressionAttributeValues={':token': token},
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Lock {name} was taken over before it was released")
+    except Exception as e:
+        print(f"Error releasing lock {name}: {str(e)}")
+
+
+def wait_for_lock(name, lease_seconds, timeout, is_done=None):
+    """Polls with backoff until the lock is ours or is_done() says the holder finished
+
+    Returns the token if the lock was acquired, otherwise None (done or timed out).
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    while True:
+        if is_done and is_done():
+            return None
+        token = acquire_lock(name, lease_seconds)
+        if token:
+            return token
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print(f"Lock {name} still held after {timeout}s, giving up")
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 5)
@@ -0,0 +1,72 @@
+import json
+import os
+import uuid
+
+from shared.clients import get_s3
+
+# Step Functions caps state payloads at 256 KB and API Gateway caps WebSocket
+# frames at 128 KB, so lessons travel between states as S3 references and
+# are split into sequenced chunks when a single frame would be too big.
+
+DELIVERY_PREFIX = "deliveries"
+MAX_FRAME_BYTES = 120 * 1024
+
+
+def put_payload(user_id, lesson_id, payload):
+    """Stores a payload for delivery and returns a reference to pass between states"""
+    key = f"{DELIVERY_PREFIX}/{user_id}/{lesson_id}.json"
+    get_s3().put_object(
+        Bucket=os.environ["BUCKET_NAME"],
+        Key=key,
+        Body=json.dumps(payload).encode("utf-8"),
+        ContentType="application/json",
+    )
+    return {"key": key}
+
+
+def load_payload(payload_ref):
+    """Reads a payload stored by put_payload"""
+    response = get_s3().get_object(
+        Bucket=os.environ["BUCKET_NAME"], Key=payload_ref["key"])
+    return json.loads(response["Body"].read())
+
+
+def _frame_size(frame):
+    return len(json.dumps(frame).encode("utf-8"))
+
+
+def frame_payload(payload, max_frame_bytes=MAX_FRAME_BYTES):
+    """Returns the frames to send for a payload: itself if it fits, otherwise chunks
+
+    Chunks are {"type": "chunk", "message_id", "seq", "total", "data"} where the
+    client joins every chunk's data in seq order and parses the result as JSON.
+    """
+    if _frame_size(payload) <= max_frame_bytes:
+        return [payload]
+
+    serialized = json.dumps(payload)
+    message_id = str(uuid.uuid4())
+    envelope = _frame_size({"type": "chunk", "message_id": message_id,
+                           "seq": 0, "total": 0, "data": ""}) + 32
+    budget = max_frame_bytes - envelope
+
+    pieces = []
+    start = 0
+    while start < len(serialized):
+        # Escaping grows the data inside a frame, so take the longest piece
+        # whose escaped form fits; it only grows as the piece does
+        low, high = 1, min(budget, len(serialized) - start)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(json.dumps(serialized[start:start + middle]).encode("utf-8")) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        pieces.append(serialized[start:start + low])
+        start += low
+
+    return [
+        {"type": "chunk", "message_id": message_id,
+            "seq": seq, "total": len(pieces), "data": piece}
+        for seq, piece in enumerate(pieces)
+    ]
@@ -0,0 +1,107 @@
+import json
+import os
+from dataclasses import dataclass
+
+from shared.scheduler import call_once, is_retryable, run
+from shared.telemetry import annotate
+
+# Which model serves each model call. Every stage has rules checked in
+# order; the first whose limits the call fits in wins. A rule without
+# max_source_tokens or max_difficulty has no limit on it. Each rule lists a
+# chain of models: when one is rate limited, times out or errors on the
+# server, the next is tried with the same request.
+#
+# MODEL_ROUTES='{"content": [{"name": "standard", "models": ["gpt-4o"], "max_completion_tokens": 8192}]}'
+# replaces the rules of the stages it names.
+
+DEFAULT_ROUTES = {
+    "flash_cards": [
+        # Short, easy sources don't need the big model for six cards
+        {"name": "light", "max_source_tokens": 12_000, "max_difficulty": 5,
+         "models": ["gpt-4o-mini", "gpt-4o"], "max_completion_tokens": 2048},
+        {"name": "standard", "models": ["gpt-4o", "gpt-4o-mini"],
+         "max_completion_tokens": 4096},
+    ],
+    "content": [
+        {"name": "light", "max_source_tokens": 6_000, "max_difficulty": 3,
+         "models": ["gpt-4o-mini", "gpt-4o"], "max_completion_tokens": 4096},
+        {"name": "standard", "models": ["gpt-4o", "gpt-4o-mini"],
+         "max_completion_tokens": 8192},
+    ],
+    "digest": [
+        {"name": "standard", "models": ["gpt-4o-mini", "gpt-4o"],
+         "max_completion_tokens": 2048},
+    ],
+    "pdf": [
+        {"name": "standard", "models": ["gpt-4o", "gpt-4o-mini"]},
+    ],
+    "youtube_search": [
+        {"name": "standard", "models": ["gpt-4o-search-preview", "gpt-4o-mini-search-preview"]},
+    ],
+}
+
+ROUTES = {**DEFAULT_ROUTES, **json.loads(os.environ.get("MODEL_ROUTES", "{}"))}
+
+
+@dataclass(frozen=True)
+class Route:
+    stage: str
+    name: str
+    models: tuple
+    max_completion_tokens: int = None
+
+    @property
+    def model(self):
+        return self.models[0]
+
+
+def _fits(rule, source_tokens, difficulty):
+    if rule.get("max_source_tokens") is not None and (
+            source_tokens is None or source_tokens > rule["max_source_tokens"]):
+        return False
+    if rule.get("max_difficulty") is not None and (
+            difficulty is None or int(difficulty) > rule["max_difficulty"]):
+        return False
+    return True
+
+
+def choose_route(stage, source_tokens=None, difficulty=None):
+    """Picks the route for a model call from the size of its source and the lesson's difficulty"""
+    for rule in ROUTES[stage]:
+        if _fits(rule, source_tokens, difficulty):
+            route = Route(stage, rule["name"], tuple(rule["models"]),
+                          rule.get("max_completion_tokens"))
+            print(f"Route for {stage}: {route.name} ({', '.join(route.models)})")
+            return route
+    raise ValueError(f"No route for {stage} fits {source_tokens} tokens at difficulty {difficulty}")
+
+
+def call_with_fallback(route, call):
+    """Runs call(model) down the route's chain until a model succeeds
+
+    Each model gets one scheduled attempt. When the whole chain fails with
+    retryable errors it is tried again from the top after a backoff, for as
+    long as the invocation has time. Errors that aren't worth retrying are
+    raised at once.
+
+    Returns the result and the model that served it, and records both in the
+    trace.
+    """
+    served = {}
+
+    def attempt_chain():
+        for index, model in enumerate(route.models):
+            try:
+                result = call_once(model, lambda: call(model))
+            except Exception as e:
+                if index == len(route.models) - 1 or not is_retryable(e):
+                    raise
+                print(f"{model} failed for {route.stage} ({type(e).__name__}), falling back to "
+                      f"{route.models[index + 1]}")
+                continue
+            served["model"] = model
+            return result
+
+    result = run(attempt_chain, route.stage)
+    annotate(**{f"{route.stage}_route": route.name, f"{route.stage}_model": served["model"]})
+    return result, served["model"]
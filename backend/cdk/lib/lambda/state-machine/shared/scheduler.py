@@ -0,0 +1,156 @@
+import os
+import random
+import threading
+import time
+from decimal import Decimal
+
+from shared.clients import get_core_table
+
+# Every OpenAI call goes through run(), which:
+# - takes a token from a per-model bucket in the core table, so a classroom
+#   burst across many containers stays under the account's rate limit
+# - caps the calls in flight in this container
+# - retries rate limits, timeouts and server errors with jittered
+#   exponential backoff, waiting at least as long as retry-after asks
+# - gives up early rather than let the Lambda time out mid-call
+#
+# RATE_LIMIT/OPENAI#{model} holds the bucket: tokens left and when it was
+# last refilled. Buckets refill at OPENAI_REQUESTS_PER_SECOND up to
+# OPENAI_BURST; setting the rate to 0 turns them off.
+
+REQUESTS_PER_SECOND = float(os.environ.get("OPENAI_REQUESTS_PER_SECOND", 8))
+BURST = float(os.environ.get("OPENAI_BURST", 16))
+MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 8))
+MAX_ATTEMPTS = int(os.environ.get("OPENAI_MAX_ATTEMPTS", 6))
+BASE_DELAY_SECONDS = 0.5
+MAX_DELAY_SECONDS = 20
+# Time kept back for writing results once the calls are done
+DEADLINE_MARGIN_SECONDS = float(os.environ.get("OPENAI_DEADLINE_MARGIN_SECONDS", 20))
+# Optimistic bucket updates that lose a race are retried this many times
+BUCKET_UPDATE_ATTEMPTS = 5
+
+_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+_deadline = None
+
+
+class OutOfTime(Exception):
+    """Raised instead of starting a wait or call the invocation can't finish"""
+
+
+def set_deadline(context):
+    """Bounds retries by the invocation's remaining time, call at the start of a handler"""
+    global _deadline
+    _deadline = None if context is None else \
+        time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
+
+
+def remaining_seconds():
+    return float("inf") if _deadline is None else _deadline - time.monotonic()
+
+
+def _sleep(seconds, reason):
+    if seconds >= remaining_seconds():
+        raise OutOfTime(f"{reason}: no time left to wait {seconds:.1f}s")
+    time.sleep(seconds)
+
+
+def _bucket_key(model):
+    return {"PK": "RATE_LIMIT", "SK": f"OPENAI#{model}"}
+
+
+def _take_token(model):
+    """Takes a token from the model's bucket, returning how long to wait if it is empty"""
+    table = get_core_table()
+    for _ in range(BUCKET_UPDATE_ATTEMPTS):
+        now = time.time()
+        item = table.get_item(Key=_bucket_key(model), ConsistentRead=True).get("Item")
+        if item:
+            tokens = min(BURST, float(item["tokens"]) +
+                         (now - float(item["updated_at"])) * REQUESTS_PER_SECOND)
+        else:
+            tokens = BURST
+        if tokens < 1:
+            return (1 - tokens) / REQUESTS_PER_SECOND
+
+        update = {
+            "Item": {**_bucket_key(model), "tokens": Decimal(f"{tokens - 1:.3f}"),
+                     "updated_at": Decimal(f"{now:.3f}"), "ttl": int(now) + 24 * 60 * 60},
+        }
+        if item:
+            update["ConditionExpression"] = "updated_at = :seen"
+            update["ExpressionAttributeValues"] = {":seen": item["updated_at"]}
+        else:
+            update["ConditionExpression"] = "attribute_not_exists(PK)"
+        try:
+            table.put_item(**update)
+            return 0
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            # Another container took a token in between, look again
+            continue
+    return 1 / REQUESTS_PER_SECOND
+
+
+def acquire_rate_limit(model):
+    """Waits for a token from the model's shared bucket; the bucket failing never blocks a call"""
+    if REQUESTS_PER_SECOND <= 0:
+        return
+    while True:
+        try:
+            wait = _take_token(model)
+        except Exception as e:
+            print(f"Error using the rate limit bucket for {model}: {str(e)}")
+            return
+        if not wait:
+            return
+        _sleep(wait + random.uniform(0, 0.1), f"waiting for {model} rate limit")
+
+
+def is_retryable(error):
+    """Errors worth another attempt: rate limits, timeouts and server errors"""
+    import openai
+
+    return isinstance(error, (openai.RateLimitError, openai.APITimeoutError,
+                              openai.APIConnectionError, openai.InternalServerError))
+
+
+def get_retry_after(error):
+    """Seconds the API asked us to wait, or None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def get_backoff(attempt, error=None):
+    """Full-jitter exponential backoff, never shorter than retry-after"""
+    delay = random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** attempt))
+    retry_after = get_retry_after(error) if error is not None else None
+    return max(delay, retry_after or 0)
+
+
+def call_once(model, call):
+    """One scheduled attempt: waits for the shared bucket and a local slot, then calls"""
+    acquire_rate_limit(model)
+    with _slots:
+        if remaining_seconds() <= 0:
+            raise OutOfTime(f"no time left to call {model}")
+        return call()
+
+
+def run(call, label, max_attempts=MAX_ATTEMPTS):
+    """Runs call() until it succeeds, retrying retryable errors with backoff in the time left"""
+    for attempt in range(max_attempts):
+        try:
+            return call()
+        except Exception as e:
+            if not is_retryable(e) or attempt == max_attempts - 1:
+                raise
+            delay = get_backoff(attempt, e)
+            print(f"{label} attempt {attempt + 1} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            _sleep(delay, label)
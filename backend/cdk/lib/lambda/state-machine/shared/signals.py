@@ -0,0 +1,52 @@
+import os
+import time
+
+from shared.clients import get_core_table
+
+# Orders the two state machine branches: the lesson must not reach the
+# client before the first status message, but on cache hits the lesson
+# branch can finish first. The first message's send records a signal and
+# the lesson's send waits for it.
+
+SIGNAL_TTL_SECONDS = 60 * 60
+FIRST_MESSAGE_WAIT_SECONDS = float(
+    os.environ.get("FIRST_MESSAGE_WAIT_SECONDS", 5))
+
+
+def _first_message_key(user_id, lesson_id):
+    return {'PK': 'SIGNAL', 'SK': f'FIRST_MESSAGE#{user_id}#{lesson_id}'}
+
+
+def mark_first_message_sent(user_id, lesson_id):
+    """Records that the first message for a lesson has been delivered (or given up on)"""
+    try:
+        get_core_table().put_item(Item={
+            **_first_message_key(user_id, lesson_id),
+            'ttl': int(time.time()) + SIGNAL_TTL_SECONDS,
+        })
+    except Exception as e:
+        print(
+            f"Error marking first message sent for {user_id}/{lesson_id}: {str(e)}")
+
+
+def wait_for_first_message(user_id, lesson_id, timeout=FIRST_MESSAGE_WAIT_SECONDS):
+    """Polls with backoff until the first message has gone out, returning False on timeout"""
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        try:
+            response = get_core_table().get_item(
+                Key=_first_message_key(user_id, lesson_id), ConsistentRead=True)
+            if 'Item' in response:
+                return True
+        except Exception as e:
+            print(
+                f"Error checking first message for {user_id}/{lesson_id}: {str(e)}")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print(
+                f"First message for {user_id}/{lesson_id} not sent after {timeout}s, sending anyway")
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.5)
@@ -0,0 +1,218 @@
+import functools
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Every traced invocation logs one JSON line ("type": "trace") with its stage,
+# the request id shared by the whole pipeline run, the spans it went through,
+# the tokens each model call used and attributes like cache hits and the
+# extraction tier. The line is also in CloudWatch embedded metric format, so
+# durations, tokens and cost become metrics per stage without extra API calls.
+#
+# Lambda runs one invocation per container at a time, so the current trace is
+# module state. That also lets spans opened in worker threads land in it.
+#
+# Exported logs can be summarised offline:
+#   python -m shared.telemetry logs.jsonl
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "Alexandria")
+TELEMETRY_ENABLED = os.environ.get(
+    "TELEMETRY_ENABLED", "true").lower() == "true"
+
+# USD per million (prompt, completion) tokens. Every model in
+# shared.routing.DEFAULT_ROUTES needs an entry, models routed to through
+# MODEL_ROUTES without one are logged and cost nothing in the metrics
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-search-preview": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o-mini-search-preview": (0.15, 0.60),
+}
+
+_trace = None
+_lock = threading.Lock()
+_unpriced_models = set()
+
+
+class Trace:
+    def __init__(self, stage, request_id, invocation_id=None):
+        self.stage = stage
+        self.request_id = request_id
+        self.invocation_id = invocation_id
+        self.started = time.perf_counter()
+        self.timestamp = int(time.time() * 1000)
+        self.spans = []
+        self.usage = []
+        self.attributes = {}
+
+    def to_record(self, status, error=None):
+        prompt_tokens = sum(u["prompt_tokens"] or 0 for u in self.usage)
+        completion_tokens = sum(u["completion_tokens"] or 0 for u in self.usage)
+        record = {
+            "type": "trace",
+            "stage": self.stage,
+            "request_id": self.request_id,
+            "invocation_id": self.invocation_id,
+            "status": status,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": round(sum(u["cost_usd"] or 0 for u in self.usage), 6),
+            **self.attributes,
+            "spans": self.spans,
+            "usage": self.usage,
+        }
+        if error:
+            record["error"] = error
+        record["_aws"] = {
+            "Timestamp": self.timestamp,
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["stage"]],
+                "Metrics": [
+                    {"Name": "duration_ms", "Unit": "Milliseconds"},
+                    {"Name": "prompt_tokens", "Unit": "Count"},
+                    {"Name": "completion_tokens", "Unit": "Count"},
+                    {"Name": "cost_usd", "Unit": "None"},
+                ],
+            }],
+        }
+        return record
+
+
+def emit(record):
+    if TELEMETRY_ENABLED:
+        print(json.dumps(record, default=str))
+
+
+def traced(stage):
+    """Decorates a Lambda handler so each invocation emits a trace"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context=None):
+            global _trace
+            request_id = event.get("id") if isinstance(event, dict) else None
+            _trace = Trace(stage, request_id,
+                           getattr(context, "aws_request_id", None))
+            trace = _trace
+            try:
+                result = handler(event, context)
+            except Exception as e:
+                emit(trace.to_record("error", f"{type(e).__name__}: {str(e)}"))
+                raise
+            else:
+                emit(trace.to_record("ok"))
+                return result
+            finally:
+                _trace = None
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times a block of work into the current trace, attributes can be added to the yielded dict"""
+    record = {"name": name, **attributes}
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["ms"] = round((time.perf_counter() - start) * 1000, 1)
+        trace = _trace
+        if trace is not None:
+            with _lock:
+                trace.spans.append(record)
+
+
+def annotate(**attributes):
+    """Adds attributes (cache results, tier, sizes...) to the current trace"""
+    trace = _trace
+    if trace is not None:
+        with _lock:
+            trace.attributes.update(attributes)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        if model not in _unpriced_models:
+            _unpriced_models.add(model)
+            print(f"No price for {model}, its calls are left out of cost_usd")
+        return None
+    if prompt_tokens is None:
+        return None
+    return (prompt_tokens * prices[0] + (completion_tokens or 0) * prices[1]) / 1_000_000
+
+
+def record_usage(label, model, completion):
+    """Adds the tokens a model call used to the current trace and returns the entry"""
+    usage = getattr(completion, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    entry = {
+        "call": label,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost_usd": estimate_cost(model, prompt_tokens, completion_tokens),
+    }
+    trace = _trace
+    if trace is not None:
+        with _lock:
+            trace.usage.append(entry)
+    return entry
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarise(lines):
+    """Aggregates trace lines into per stage and per span timings, tokens and cost"""
+    stages = {}
+    spans = {}
+    for line in lines:
+        # CloudWatch exports prefix each message with a timestamp
+        start = line.find("{")
+        if start < 0:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        if record.get("type") != "trace":
+            continue
+        stage = stages.setdefault(record["stage"], {
+            "ms": [], "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+        stage["ms"].append(record["duration_ms"])
+        stage["errors"] += record["status"] != "ok"
+        stage["prompt_tokens"] += record.get("prompt_tokens", 0)
+        stage["completion_tokens"] += record.get("completion_tokens", 0)
+        stage["cost_usd"] += record.get("cost_usd", 0)
+        for s in record.get("spans", []):
+            spans.setdefault(f"{record['stage']}.{s['name']}", []).append(s["ms"])
+
+    rows = []
+    for name, stage in sorted(stages.items()):
+        rows.append({"name": name, "count": len(stage["ms"]), "errors": stage["errors"],
+                     "p50_ms": statistics.median(stage["ms"]), "p95_ms": _percentile(stage["ms"], 0.95),
+                     "prompt_tokens": stage["prompt_tokens"], "completion_tokens": stage["completion_tokens"],
+                     "cost_usd": round(stage["cost_usd"], 4)})
+    for name, timings in sorted(spans.items()):
+        rows.append({"name": name, "count": len(timings),
+                     "p50_ms": statistics.median(timings), "p95_ms": _percentile(timings, 0.95)})
+    return rows
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin as f:
+        for row in summarise(f):
+            print(json.dumps(row))
@@ -0,0 +1,38 @@
+from functools import lru_cache
+
+import tiktoken
+
+# Tokenizer used by the gpt-4o model family
+ENCODING_NAME = "o200k_base"
+# Rough characters per token, used when the tokenizer can't be loaded
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    """Loads the tokenizer once per container, or None if it is unavailable"""
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as e:
+        print(f"Error loading tokenizer, token counts will be estimated: {str(e)}")
+        return None
+
+
+def count_tokens(text):
+    """Counts the tokens in text"""
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cuts text down to at most max_tokens tokens"""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
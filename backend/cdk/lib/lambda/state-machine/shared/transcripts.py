@@ -0,0 +1,317 @@
+import gzip
+import json
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from shared.tokens import ENCODING_NAME, count_tokens
+
+# Transcriptions are stored as a small container rather than one big .txt:
+#
+#   MAGIC | header length (uint32, big endian) | JSON header | sections
+#
+# Each section is its own gzip member, and the header lists every section's
+# offset and length (relative to the end of the header) along with its kind,
+# title, size and token count. A reader can fetch the header with one range
+# request and then only the sections it needs. Concatenated, the sections
+# are still one valid gzip stream.
+
+MAGIC = b"ALXT"
+FORMAT_VERSION = 1
+TRANSCRIPT_EXTENSION = ".alxt"
+LEGACY_EXTENSION = ".txt"
+
+# Sections are packed up to roughly this size when the text has no page breaks
+SECTION_CHARS = int(os.environ.get("TRANSCRIPT_SECTION_CHARS", 16_000))
+# First range request, big enough to hold the header of most transcriptions
+HEADER_PROBE_BYTES = 64 * 1024
+SECTION_SEPARATOR = "\n\n"
+PAGE_BREAK = "\f"
+
+# Sections read in this container, so repeated lessons on one source skip S3
+TRANSCRIPT_CACHE_BYTES = int(os.environ.get(
+    "TRANSCRIPT_CACHE_BYTES", 32 * 1024 * 1024))
+STREAM_READ_BYTES = 1024 * 1024
+
+HEADING = re.compile(r"^#{1,6} +(.+)$", re.M)
+PARAGRAPH_BOUNDARY = re.compile(r"\n\s*\n")
+
+
+def get_transcript_key(cached_id):
+    return f"transcriptions/{cached_id}{TRANSCRIPT_EXTENSION}"
+
+
+def get_legacy_transcript_key(cached_id):
+    return f"transcriptions/{cached_id}{LEGACY_EXTENSION}"
+
+
+def _pack_paragraphs(text, kind, title=None):
+    """Packs paragraphs into sections of about SECTION_CHARS"""
+    sections = []
+    current = []
+    size = 0
+    for paragraph in PARAGRAPH_BOUNDARY.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and size + len(paragraph) > SECTION_CHARS:
+            sections.append(
+                {"kind": kind, "title": title, "text": SECTION_SEPARATOR.join(current)})
+            current = []
+            size = 0
+        current.append(paragraph)
+        size += len(paragraph) + len(SECTION_SEPARATOR)
+    if current:
+        sections.append(
+            {"kind": kind, "title": title, "text": SECTION_SEPARATOR.join(current)})
+    return sections
+
+
+def build_sections(text):
+    """Splits text on its natural boundaries
+
+    Form feeds mark PDF pages, markdown headings mark sections, anything else
+    is packed by paragraph. Oversized sections are packed further.
+    """
+    if PAGE_BREAK in text:
+        sections = []
+        for number, page in enumerate(text.split(PAGE_BREAK), start=1):
+            sections.extend(_pack_paragraphs(page, "page", f"Page {number}"))
+        return sections
+
+    headings = list(HEADING.finditer(text))
+    if headings:
+        sections = _pack_paragraphs(text[:headings[0].start()], "preamble")
+        for heading, following in zip(headings, headings[1:] + [None]):
+            end = following.start() if following else len(text)
+            sections.extend(_pack_paragraphs(
+                text[heading.start():end], "section", heading.group(1).strip()))
+        return sections
+
+    return _pack_paragraphs(text, "chunk")
+
+
+def encode_transcript(sections, **info):
+    """Serialises sections and descriptive info (source type, tier...) into a container"""
+    members = []
+    index = []
+    offset = 0
+    for section in sections:
+        data = gzip.compress(section["text"].encode("utf-8"), mtime=0)
+        index.append({
+            "kind": section["kind"],
+            "title": section["title"],
+            "offset": offset,
+            "length": len(data),
+            "chars": len(section["text"]),
+            "tokens": count_tokens(section["text"]),
+        })
+        members.append(data)
+        offset += len(data)
+
+    header = json.dumps({
+        "version": FORMAT_VERSION,
+        **info,
+        "tokenizer": ENCODING_NAME,
+        "token_count": sum(section["tokens"] for section in index),
+        "chars": sum(section["chars"] for section in index),
+        "sections": index,
+    }).encode("utf-8")
+    return b"".join([MAGIC, struct.pack(">I", len(header)), header, *members])
+
+
+def _parse_prefix(prefix):
+    if prefix[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a transcript container")
+    (header_length,) = struct.unpack(
+        ">I", prefix[len(MAGIC):len(MAGIC) + 4])
+    return len(MAGIC) + 4, header_length
+
+
+def decode_transcript(data, indexes=None):
+    """Returns (header, section texts) from a whole container already in memory"""
+    start, header_length = _parse_prefix(data)
+    header = json.loads(data[start:start + header_length])
+    body = start + header_length
+    sections = header["sections"]
+    if indexes is not None:
+        sections = [sections[i] for i in indexes]
+    return header, [gzip.decompress(data[body + section["offset"]:body + section["offset"] + section["length"]]).decode("utf-8")
+                    for section in sections]
+
+
+def put_transcript(s3, bucket, key, text, metadata=None, **info):
+    """Stores text as a container and returns its header
+
+    The token count and tokenizer are also written as object metadata so a
+    HEAD is enough to budget prompts.
+    """
+    sections = build_sections(text)
+    data = encode_transcript(sections, **info)
+    header, _ = decode_transcript(data, [])
+    response = s3.put_object(Bucket=bucket, Key=key, Body=data,
+                  ContentType="application/octet-stream",
+                  Metadata={**(metadata or {}),
+                            "token-count": str(header["token_count"]),
+                            "tokenizer": header["tokenizer"]})
+    print(
+        f"Stored {key}: {len(text)} chars in {len(sections)} sections, {len(data)} bytes")
+    _cache.put(key, response.get("ETag"), [section["text"] for section in sections])
+    return header, response.get("ETag")
+
+
+def get_text_chars(header):
+    """Length of the text the header's sections join back into"""
+    sections = header["sections"]
+    return header["chars"] + len(SECTION_SEPARATOR) * max(len(sections) - 1, 0)
+
+
+def _get_range(s3, bucket, key, start, end):
+    response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+    return response["Body"].read()
+
+
+def read_header(s3, bucket, key):
+    """Reads a container's header with a ranged GET, returning (header, body offset)"""
+    prefix = _get_range(s3, bucket, key, 0, HEADER_PROBE_BYTES - 1)
+    start, header_length = _parse_prefix(prefix)
+    if len(prefix) < start + header_length:
+        prefix += _get_range(s3, bucket, key, len(prefix),
+                             start + header_length - 1)
+    return json.loads(prefix[start:start + header_length]), start + header_length
+
+
+def iter_sections(s3, bucket, key, indexes=None, head=None):
+    """Yields the text of the sections asked for, in order
+
+    Only those sections are downloaded, each run of adjacent sections with one
+    ranged GET. Pass read_header's result as head to skip reading it again.
+    """
+    header, body = head or read_header(s3, bucket, key)
+    sections = header["sections"]
+    indexes = list(range(len(sections)) if indexes is None else indexes)
+    run = []
+    for position, index in enumerate(indexes):
+        run.append(sections[index])
+        if position + 1 < len(indexes) and indexes[position + 1] == index + 1:
+            continue
+        first = run[0]["offset"]
+        data = _get_range(s3, bucket, key, body + first,
+                          body + run[-1]["offset"] + run[-1]["length"] - 1)
+        for section in run:
+            start = section["offset"] - first
+            yield gzip.decompress(data[start:start + section["length"]]).decode("utf-8")
+        run = []
+
+
+class _SectionCache:
+    """LRU of transcript sections keyed by S3 key, each entry pinned to the ETag it was read at"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, etag, sections):
+        size = sum(len(section) for section in sections)
+        if not etag or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._size -= old[2]
+            self._entries[key] = (etag, sections, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+
+_cache = _SectionCache(TRANSCRIPT_CACHE_BYTES)
+
+
+def _read_exactly(body, length):
+    chunks = []
+    while length > 0:
+        chunk = body.read(min(length, STREAM_READ_BYTES))
+        if not chunk:
+            raise ValueError("Transcript ended early")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+
+def _stream_sections(body):
+    """Decompresses a container section by section as it downloads"""
+    prefix = _read_exactly(body, len(MAGIC) + 4)
+    _, header_length = _parse_prefix(prefix)
+    header = json.loads(_read_exactly(body, header_length))
+    sections = []
+    position = 0
+    for section in header["sections"]:
+        # Sections are stored back to back, but honour the offsets anyway
+        _read_exactly(body, section["offset"] - position)
+        data = _read_exactly(body, section["length"])
+        sections.append(gzip.decompress(data).decode("utf-8"))
+        position = section["offset"] + section["length"]
+    return sections
+
+
+def get_cached_sections(key, etag):
+    """Sections this container already holds for key at etag, without touching S3"""
+    cached = _cache.get(key)
+    if cached and etag and cached[0] == etag:
+        return cached[1]
+    return None
+
+
+def read_transcript_sections(s3, bucket, key, etag=None):
+    """Reads every section of a transcript, legacy .txt included
+
+    Sections are kept in an in-memory LRU. When the caller knows the
+    object's ETag and it matches, S3 isn't touched at all; otherwise a
+    conditional GET only downloads the body if it changed.
+    """
+    cached = _cache.get(key)
+    if cached and etag and cached[0] == etag:
+        print(f"Transcript cache hit: {key}")
+        return cached[1]
+
+    request = {"Bucket": bucket, "Key": key}
+    if cached:
+        request["IfNoneMatch"] = cached[0]
+    try:
+        response = s3.get_object(**request)
+    except ClientError as e:
+        if cached and e.response["Error"]["Code"] in ("304", "NotModified"):
+            print(f"Transcript not modified: {key}")
+            return cached[1]
+        raise
+
+    body = response["Body"]
+    try:
+        if key.endswith(LEGACY_EXTENSION):
+            sections = [body.read().decode("utf-8")]
+        else:
+            sections = _stream_sections(body)
+    finally:
+        body.close()
+
+    _cache.put(key, response.get("ETag"), sections)
+    return sections
+
+
+def read_transcript_text(s3, bucket, key, etag=None):
+    return SECTION_SEPARATOR.join(read_transcript_sections(s3, bucket, key, etag))
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import re
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlsplit, urlunsplit
+from xml.etree import ElementTree
+
+from shared.clients import get_core_table, get_http_session
+
+# Many URLs point at the same content. Each is canonicalised and mapped to a
+# content id, and the mapping is remembered in the core table:
+#   URL_ALIAS/{raw url}  -> content id and canonical URL, expires so that
+#                           redirects and "latest" arXiv versions are re-resolved
+#   CANONICAL/{content id} -> the canonical URL, so hashed ids can be reversed
+#
+# Content ids changed with canonicalisation (arXiv versions are pinned, www.
+# and m. are stripped from every host, query strings are kept), which moves
+# every source to a new transcriptions/ key. Transcriptions stored under the
+# old ids are found through get_legacy_content_id and copied to the new key
+# the first time their source is requested. Digests and cached lessons are
+# not carried over; they are rebuilt from the migrated transcription.
+
+ALIAS_TTL_SECONDS = int(os.environ.get(
+    "URL_ALIAS_TTL_SECONDS", 7 * 24 * 60 * 60))
+RESOLVE_TIMEOUT_SECONDS = 10
+MAX_CONTENT_ID_LENGTH = 100
+# DynamoDB caps sort keys at 1024 bytes
+MAX_ALIAS_KEY_BYTES = 1000
+
+TRACKING_PARAMS = frozenset([
+    'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'twclid', 'igshid',
+    'mc_cid', 'mc_eid', '_hsenc', '_hsmi', 'mkt_tok', 'ref', 'ref_src', 'ref_url',
+    'si', 'spm', 'cmpid', 'trk', 'trkcampaign', 'sc_campaign',
+])
+TRACKING_PREFIXES = ('utm_', 'pk_', 'mtm_', 'hsa_', 'vero_', 'oly_')
+
+ARXIV_PATH = re.compile(
+    r"^/(?:abs|pdf|html|format)/(?P<id>\d{4}\.\d{4,5}|[a-z\-]+(?:\.[a-z]{2})?/\d{7})(?P<version>v\d+)?(?:\.pdf)?/?$",
+    re.I)
+ATOM = "{http://www.w3.org/2005/Atom}"
+
+
+def get_video_id(url):
+    """Extracts YouTube video ID from the URL"""
+    match = re.search(
+        r"(?:v=|youtu\.be/|embed/|shorts/|watch\?v=)([\w-]{11})", url)
+    if match:
+        return match.group(1)
+    return None
+
+
+def is_pdf_url(url):
+    """Determines if a URL points to a PDF file"""
+    # Check if URL ends with .pdf
+    if url.lower().endswith('.pdf'):
+        return True
+
+    # Check if URL contains pdf in the path (common for academic papers)
+    url_path = urlparse(url).path.lower()
+    if '/pdf/' in url_path or 'pdf' in url_path.split('.')[-1]:
+        return True
+
+    # Check for specific academic repositories
+    parsed_url = urlparse(url)
+    hostname = parsed_url.netloc.lower()
+
+    # Handle arxiv URLs
+    if 'arxiv.org' in hostname and ('/pdf/' in url_path or url_path.startswith('/abs/')):
+        return True
+
+    # Handle other academic repositories that commonly serve PDFs
+    academic_repos = ['biorxiv.org', 'medrxiv.org',
+                      'ssrn.com', 'researchgate.net']
+    if any(repo in hostname for repo in academic_repos):
+        return True
+
+    return False
+
+
+def get_pdf_url(url):
+    """For academic repository URLs, convert abstract URLs to direct PDF URLs if needed"""
+    parsed_url = urlparse(url)
+    hostname = parsed_url.netloc.lower()
+    path = parsed_url.path
+
+    # Handle arXiv URLs
+    if 'arxiv.org' in hostname:
+        if path.startswith('/abs/'):
+            # Convert abstract URL to PDF URL
+            paper_id = path.split('/abs/')[-1]
+            return f"https://arxiv.org/pdf/{paper_id}.pdf"
+        elif '/pdf/' in path and not path.endswith('.pdf'):
+            # Ensure PDF URL ends with .pdf
+            paper_id = path.split('/pdf/')[-1]
+            return f"https://arxiv.org/pdf/{paper_id}.pdf"
+
+    return url
+
+
+def parse_arxiv_id(url):
+    """Returns (paper id, version) for arXiv URLs, version being '' when unpinned"""
+    parts = urlsplit(url)
+    if not (parts.hostname or '').lower().endswith('arxiv.org'):
+        return None
+    match = ARXIV_PATH.match(parts.path)
+    if not match:
+        return None
+    return match.group('id'), (match.group('version') or '').lower()
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def canonicalize_url(url):
+    """Normalises a URL so every spelling of the same resource compares equal
+
+    Drops fragments, tracking parameters, default ports and duplicate slashes,
+    sorts the query, and rewrites YouTube and arXiv URLs to a single form.
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = f"https://{url}"
+
+    video_id = get_video_id(url)
+    if video_id:
+        return f"https://www.youtube.com/watch?v={video_id}"
+
+    arxiv = parse_arxiv_id(url)
+    if arxiv:
+        paper_id, version = arxiv
+        return f"https://arxiv.org/abs/{paper_id}{version}"
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').rstrip('.')
+    if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        netloc = f"{netloc}:{parts.port}"
+
+    path = re.sub(r"/{2,}", "/", parts.path) or '/'
+    if len(path) > 1:
+        path = path.rstrip('/')
+
+    query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if not is_tracking_param(name))
+    return urlunsplit((scheme, netloc, path, urlencode(query), ''))
+
+
+def get_content_id(canonical_url):
+    """Builds the content id a canonical URL is cached under"""
+    video_id = get_video_id(canonical_url)
+    if video_id:
+        return f"youtube-{video_id}"
+
+    arxiv = parse_arxiv_id(canonical_url)
+    if arxiv:
+        paper_id, version = arxiv
+        return f"arxiv-{paper_id.replace('/', '-')}{version}".lower()
+
+    parts = urlsplit(canonical_url)
+    host = re.sub(r"^(?:www|m)\.", "", parts.netloc)
+    identifier = f"{host}{parts.path.rstrip('/')}"
+    if parts.query:
+        query_slug = re.sub(r"[^\w.-]+", "-", parts.query)
+        identifier = f"{identifier}-{query_slug}"
+    identifier = identifier.replace('/', '-')
+    if is_pdf_url(canonical_url):
+        identifier = f"pdf-{identifier}".lower()
+
+    if len(identifier) > MAX_CONTENT_ID_LENGTH:
+        # Still readable, and CANONICAL items map it back to the URL
+        digest = hashlib.sha256(canonical_url.encode('utf-8')).hexdigest()
+        identifier = f"{identifier[:60]}-{digest[:16]}"
+    return identifier
+
+
+def get_legacy_content_id(url):
+    """The id a raw URL was cached under before canonicalisation, for migrating old transcriptions"""
+    video_id = get_video_id(url)
+    if video_id:
+        return f"youtube-{video_id}"
+
+    parsed_url = urlparse(url)
+    if is_pdf_url(url):
+        hostname = parsed_url.netloc.lower()
+        path = parsed_url.path.lower()
+
+        if 'arxiv.org' in hostname:
+            if '/pdf/' in path:
+                paper_id = path.split('/pdf/')[-1].replace('.pdf', '')
+            elif '/abs/' in path:
+                paper_id = path.split('/abs/')[-1]
+            else:
+                paper_id = path.split('/')[-1].replace('.pdf', '')
+            return f"arxiv-{paper_id}"
+
+        pdf_identifier = f"pdf-{hostname}{path}".replace('/', '-')
+        if len(pdf_identifier) > 100:
+            pdf_identifier = f"pdf-{hashlib.md5(url.encode()).hexdigest()}"
+        return pdf_identifier
+
+    identifier = f"{parsed_url.netloc}{parsed_url.path.rstrip('/')}".replace(
+        'www.', '').replace('/', '-')
+    if len(identifier) > 100:
+        identifier = f"{identifier[:50]}-{hashlib.md5(identifier.encode()).hexdigest()[:10]}"
+    return identifier
+
+
+def get_latest_arxiv_version(paper_id):
+    """Asks the arXiv export API for the newest version of a paper, e.g. 'v3'"""
+    try:
+        response = get_http_session().get(
+            "https://export.arxiv.org/api/query",
+            params={"id_list": paper_id, "max_results": 1},
+            timeout=RESOLVE_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        entry_id = ElementTree.fromstring(response.content).findtext(
+            f"{ATOM}entry/{ATOM}id") or ''
+        match = re.search(r"(v\d+)$", entry_id)
+        return match.group(1) if match else None
+    except Exception as e:
+        print(f"Error resolving latest arXiv version of {paper_id}: {str(e)}")
+        return None
+
+
+def follow_redirects(url, headers=None):
+    """Returns where a URL finally lands, or None if it can't be reached"""
+    session = get_http_session()
+    try:
+        response = session.head(url, headers=headers, allow_redirects=True,
+                                timeout=RESOLVE_TIMEOUT_SECONDS)
+        if response.status_code in (403, 405, 501):
+            # Some servers refuse HEAD, a streamed GET stops after the headers
+            with session.get(url, headers=headers, allow_redirects=True, stream=True,
+                             timeout=RESOLVE_TIMEOUT_SECONDS) as response:
+                return response.url
+        return response.url
+    except Exception as e:
+        print(f"Error following redirects for {url}: {str(e)}")
+        return None
+
+
+def resolve_canonical_url(url, headers=None):
+    """Canonicalises a URL, pinning arXiv versions and following redirects"""
+    canonical_url = canonicalize_url(url)
+
+    arxiv = parse_arxiv_id(canonical_url)
+    if arxiv:
+        paper_id, version = arxiv
+        version = version or get_latest_arxiv_version(paper_id)
+        return f"https://arxiv.org/abs/{paper_id}{version or ''}"
+
+    if get_video_id(canonical_url):
+        return canonical_url
+
+    final_url = follow_redirects(canonical_url, headers)
+    if final_url and final_url != canonical_url:
+        print(f"{canonical_url} redirects to {final_url}")
+        return canonicalize_url(final_url)
+    return canonical_url
+
+
+def _alias_key(url):
+    if len(url.encode('utf-8')) > MAX_ALIAS_KEY_BYTES:
+        url = f"SHA256#{hashlib.sha256(url.encode('utf-8')).hexdigest()}"
+    return {'PK': 'URL_ALIAS', 'SK': url}
+
+
+def resolve_content_id(url, headers=None):
+    """Maps a raw URL to (content id, canonical URL) through the alias index"""
+    table = get_core_table()
+    try:
+        item = table.get_item(Key=_alias_key(url)).get('Item')
+        # TTL deletion lags, so expired aliases are skipped here too
+        if item and int(item.get('ttl', 0)) > time.time():
+            return item['content_id'], item['canonical_url']
+    except Exception as e:
+        print(f"Error reading URL alias for {url}: {str(e)}")
+
+    canonical_url = resolve_canonical_url(url, headers)
+    content_id = get_content_id(canonical_url)
+    print(f"Resolved {url} to {content_id} ({canonical_url})")
+
+    try:
+        table.put_item(Item={
+            **_alias_key(url),
+            'content_id': content_id,
+            'canonical_url': canonical_url,
+            'ttl': int(time.time()) + ALIAS_TTL_SECONDS,
+        })
+        table.put_item(
+            Item={'PK': 'CANONICAL', 'SK': content_id, 'url': canonical_url})
+    except Exception as e:
+        print(f"Error writing URL alias for {url}: {str(e)}")
+
+    return content_id, canonical_url
@@ -0,0 +1,60 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.clients import get_websocket_client
+from shared.connections import get_user_connections, prune_connections
+
+MAX_SEND_WORKERS = 10
+
+
+def post_to_connection(connection_id, payload):
+    """Posts one payload, returning an HTTP-style status code"""
+    client = get_websocket_client()
+
+    try:
+        client.post_to_connection(
+            ConnectionId=connection_id,
+            Data=json.dumps(payload)
+        )
+        return 200
+    except client.exceptions.GoneException:
+        # Connection is no longer available
+        return 410
+    except Exception as e:
+        print(f"Error sending message to {connection_id}: {str(e)}")
+        return 500
+
+
+def _send_in_order(connection_id, payloads):
+    """Sends payloads to one connection in order, stopping if it has gone"""
+    status = 200
+    for payload in payloads:
+        status = post_to_connection(connection_id, payload)
+        if status == 410:
+            break
+    return status
+
+
+def send_to_connections(connection_ids, payloads):
+    """Sends every payload to every connection, connections in parallel
+
+    Returns a map of connection id to the status of its last send.
+    """
+    if not connection_ids or not payloads:
+        return {}
+
+    workers = min(MAX_SEND_WORKERS, len(connection_ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = executor.map(
+            lambda connection_id: _send_in_order(connection_id, payloads), connection_ids)
+        return dict(zip(connection_ids, statuses))
+
+
+def send_to_user(user_id, payloads, extra_connection_ids=()):
+    """Sends payloads to all of a user's open connections and prunes the dead ones"""
+    connection_ids = list(dict.fromkeys(
+        [*extra_connection_ids, *get_user_connections(user_id)]))
+    results = send_to_connections(connection_ids, payloads)
+    prune_connections(
+        user_id, [connection_id for connection_id, status in results.items() if status == 410])
+    return results
@@ -0,0 +1,19 @@
+"""Unit tests for the hand-written parsers and formats the handlers share
+
+    python -m pytest tests
+
+Run from the state-machine directory. Each handler's directory is put on
+the path the way its image lays it out, next to the shared package.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("generate",):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+sys.path.insert(0, ROOT)
+
+# Modules read these at import time
+for name, value in {"BUCKET_NAME": "test", "CORE_TABLE_NAME": "test",
+                    "AWS_REGION": "us-east-1", "AWS_DEFAULT_REGION": "us-east-1"}.items():
+    os.environ.setdefault(name, value)
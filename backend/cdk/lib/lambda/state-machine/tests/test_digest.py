@@ -0,0 +1,18 @@
+import random
+
+from shared.digest import plan_chunks, split_into_chunks
+from shared.transcripts import SECTION_SEPARATOR
+
+
+def test_planned_chunks_match_split_into_chunks():
+    rng = random.Random(7)
+    for _ in range(200):
+        sections = ["x" * rng.randint(1, 300) for _ in range(rng.randint(1, 40))]
+        plan = plan_chunks([len(section) for section in sections], max_chars=500)
+        chunks = split_into_chunks(SECTION_SEPARATOR.join(sections), 500, sections)
+        assert [SECTION_SEPARATOR.join(sections[i] for i in group) for group in plan] == chunks
+
+
+def test_no_plan_when_a_section_has_to_be_split():
+    assert plan_chunks([10, 501, 10], max_chars=500) is None
+    assert plan_chunks([10, 500, 10], max_chars=500) == [[0], [1], [2]]
@@ -0,0 +1,55 @@
+import json
+
+from shared.payloads import MAX_FRAME_BYTES, frame_payload
+
+
+def frame_bytes(frame):
+    return len(json.dumps(frame).encode("utf-8"))
+
+
+def reassemble(frames):
+    """Joins chunks the way useWebSocket does"""
+    chunks = [None] * frames[0]["total"]
+    for frame in frames:
+        chunks[frame["seq"]] = frame["data"]
+    return json.loads("".join(chunks))
+
+
+def test_small_payload_is_sent_as_is():
+    payload = {"topic": "Sets", "flash_cards": []}
+    assert frame_payload(payload) == [payload]
+
+
+def test_payload_exactly_at_the_limit_is_not_chunked():
+    payload = {"data": ""}
+    payload["data"] = "x" * (MAX_FRAME_BYTES - frame_bytes(payload))
+    assert frame_bytes(payload) == MAX_FRAME_BYTES
+    assert frame_payload(payload) == [payload]
+
+
+def test_large_payload_is_chunked_and_reassembles():
+    payload = {"agent_system_prompt": "lorem ipsum " * 30_000, "flash_cards": [{"id": "1"}]}
+    frames = frame_payload(payload)
+    assert len(frames) > 1
+    assert {frame["message_id"] for frame in frames} == {frames[0]["message_id"]}
+    assert [frame["seq"] for frame in frames] == list(range(len(frames)))
+    assert all(frame["type"] == "chunk" and frame["total"] == len(frames) for frame in frames)
+    assert all(frame_bytes(frame) <= MAX_FRAME_BYTES for frame in frames)
+    assert reassemble(frames) == payload
+
+
+def test_text_that_grows_when_escaped_still_fits():
+    # Quotes and backslashes double when the serialised payload is escaped
+    # again as chunk data, and non-ASCII text is \u-escaped first
+    for text in ('"\\' * 2_000, "é" * 2_000, "図書館😀" * 1_000, 'a"é\\😀\n' * 1_000):
+        payload = {"text": text}
+        frames = frame_payload(payload, max_frame_bytes=1024)
+        assert len(frames) > 1
+        assert all(frame_bytes(frame) <= 1024 for frame in frames)
+        assert reassemble(frames) == payload
+
+
+def test_chunks_are_filled_close_to_the_limit():
+    payload = {"text": "a" * 100_000}
+    frames = frame_payload(payload, max_frame_bytes=4096)
+    assert all(frame_bytes(frame) > 3000 for frame in frames[:-1])
@@ -0,0 +1,68 @@
+import json
+
+from streaming import JsonArrayStream
+
+CARDS = [
+    {"id": "1", "question": "What does {x} mean?", "answer": "A set"},
+    {"id": "2", "question": 'Who said "}]{["?', "answer": "Nobody, \\ honestly"},
+    {"id": "3", "question": "Où est la bibliothèque ? 図書館", "answer": "😀 ici"},
+]
+DOCUMENT = json.dumps({"topic": "flash_cards", "flash_cards": CARDS, "other": [{"id": "x"}]})
+
+
+def feed_in_pieces(parser, text, size):
+    items = []
+    for start in range(0, len(text), size):
+        items.extend(parser.feed(text[start:start + size]))
+    return items
+
+
+def test_yields_each_item_of_the_named_array():
+    items = JsonArrayStream("flash_cards").feed(DOCUMENT)
+    assert [json.loads(item) for item in items] == CARDS
+
+
+def test_items_are_the_same_however_the_text_is_split():
+    for size in (1, 2, 3, 7, 64):
+        items = feed_in_pieces(JsonArrayStream("flash_cards"), DOCUMENT, size)
+        assert [json.loads(item) for item in items] == CARDS
+
+
+def test_item_is_returned_as_soon_as_it_closes():
+    parser = JsonArrayStream("flash_cards")
+    first = json.dumps(CARDS[0])
+    assert parser.feed('{"flash_cards": [' + first[:-1]) == []
+    assert parser.feed(first[-1]) == [first]
+    assert parser.feed(", ") == []
+
+
+def test_escaped_quotes_and_braces_in_strings_do_not_end_items():
+    text = r'{"flash_cards": [{"question": "a \"}\" b \\", "answer": "]}{"}]}'
+    items = JsonArrayStream("flash_cards").feed(text)
+    assert [json.loads(item) for item in items] == [
+        {"question": 'a "}" b \\', "answer": "]}{"}]
+
+
+def test_escape_split_across_feeds():
+    parser = JsonArrayStream("flash_cards")
+    items = parser.feed('{"flash_cards": [{"q": "a \\')
+    items += parser.feed('"}"}]}')
+    assert [json.loads(item) for item in items] == [{"q": 'a "}'}]
+
+
+def test_nested_values_stay_inside_their_item():
+    card = {"id": "1", "tags": ["a", {"b": [1, 2]}], "meta": {"x": {}}}
+    items = JsonArrayStream("flash_cards").feed(json.dumps({"flash_cards": [card]}))
+    assert [json.loads(item) for item in items] == [card]
+
+
+def test_other_arrays_and_string_values_equal_to_the_key_are_ignored():
+    text = json.dumps({"cards": [{"id": "x"}], "name": "flash_cards", "list": ["flash_cards"]})
+    assert JsonArrayStream("flash_cards").feed(text) == []
+
+
+def test_unicode_escapes_are_kept_raw():
+    text = json.dumps({"flash_cards": CARDS})  # ensure_ascii escapes the non-ASCII text
+    items = JsonArrayStream("flash_cards").feed(text)
+    assert "\\u" in items[2]
+    assert json.loads(items[2]) == CARDS[2]
@@ -0,0 +1,152 @@
+import gzip
+import io
+import json
+import struct
+
+import pytest
+
+from shared import transcripts
+from shared.transcripts import (MAGIC, PAGE_BREAK, SECTION_SEPARATOR,
+                                _stream_sections, build_sections,
+                                decode_transcript, encode_transcript,
+                                get_text_chars, iter_sections, read_header)
+
+SECTIONS = [
+    {"kind": "page", "title": "Page 1", "text": "Première page, avec des accents."},
+    {"kind": "page", "title": "Page 2", "text": "図書館 " * 500},
+    {"kind": "page", "title": None, "text": "x"},
+    {"kind": "page", "title": "Page 4", "text": "The end.\n\nReally."},
+]
+
+
+class RangeS3:
+    """Serves one object and records the ranges read from it"""
+
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        start, end = (int(n) for n in Range.removeprefix("bytes=").split("-"))
+        self.ranges.append((start, end))
+        return {"Body": io.BytesIO(self.data[start:end + 1])}
+
+
+def split(data):
+    (header_length,) = struct.unpack(">I", data[len(MAGIC):len(MAGIC) + 4])
+    body = len(MAGIC) + 4 + header_length
+    return json.loads(data[len(MAGIC) + 4:body]), body
+
+
+def test_round_trip():
+    header, texts = decode_transcript(encode_transcript(SECTIONS, source_type="pdf"))
+    assert texts == [section["text"] for section in SECTIONS]
+    assert header["version"] == transcripts.FORMAT_VERSION
+    assert header["source_type"] == "pdf"
+    assert [(s["kind"], s["title"]) for s in header["sections"]] == [
+        (s["kind"], s["title"]) for s in SECTIONS]
+
+
+def test_header_sizes_and_offsets():
+    data = encode_transcript(SECTIONS)
+    header, body = split(data)
+    offset = 0
+    for info, section in zip(header["sections"], SECTIONS):
+        assert info["offset"] == offset
+        assert info["chars"] == len(section["text"])
+        member = data[body + info["offset"]:body + info["offset"] + info["length"]]
+        assert gzip.decompress(member).decode("utf-8") == section["text"]
+        offset += info["length"]
+    assert body + offset == len(data)
+    assert header["chars"] == sum(len(section["text"]) for section in SECTIONS)
+    assert header["token_count"] == sum(info["tokens"] for info in header["sections"])
+
+
+def test_body_is_one_gzip_stream():
+    data = encode_transcript(SECTIONS)
+    _, body = split(data)
+    assert gzip.decompress(data[body:]).decode("utf-8") == "".join(
+        section["text"] for section in SECTIONS)
+
+
+def test_encoding_is_deterministic():
+    assert encode_transcript(SECTIONS) == encode_transcript(SECTIONS)
+
+
+def test_decode_selected_sections():
+    _, texts = decode_transcript(encode_transcript(SECTIONS), [3, 1])
+    assert texts == [SECTIONS[3]["text"], SECTIONS[1]["text"]]
+
+
+def test_rejects_other_data():
+    with pytest.raises(ValueError):
+        decode_transcript(b"plain text transcription")
+
+
+def test_empty_transcript():
+    header, texts = decode_transcript(encode_transcript([]))
+    assert texts == [] and header["chars"] == 0
+    assert get_text_chars(header) == 0
+
+
+def test_streamed_read_matches_decode():
+    data = encode_transcript(SECTIONS)
+    assert _stream_sections(io.BytesIO(data)) == decode_transcript(data)[1]
+
+
+def test_text_chars_is_the_joined_length():
+    header, texts = decode_transcript(encode_transcript(SECTIONS))
+    assert get_text_chars(header) == len(SECTION_SEPARATOR.join(texts))
+
+
+def test_read_header_with_a_header_bigger_than_the_probe(monkeypatch):
+    monkeypatch.setattr(transcripts, "HEADER_PROBE_BYTES", 16)
+    data = encode_transcript(SECTIONS)
+    s3 = RangeS3(data)
+    header, body = read_header(s3, "bucket", "key")
+    assert (header, body) == split(data)
+    assert s3.ranges == [(0, 15), (16, body - 1)]
+
+
+def test_iter_sections_reads_only_the_sections_asked_for():
+    data = encode_transcript(SECTIONS)
+    s3 = RangeS3(data)
+    head = read_header(s3, "bucket", "key")
+    s3.ranges.clear()
+    texts = list(iter_sections(s3, "bucket", "key", [0, 1, 3], head))
+    assert texts == [SECTIONS[0]["text"], SECTIONS[1]["text"], SECTIONS[3]["text"]]
+    # Adjacent sections share one ranged GET, and nothing outside them is read
+    header, body = head
+    sections = header["sections"]
+    assert s3.ranges == [
+        (body, body + sections[1]["offset"] + sections[1]["length"] - 1),
+        (body + sections[3]["offset"], len(data) - 1),
+    ]
+
+
+def test_iter_sections_reads_everything_by_default():
+    data = encode_transcript(SECTIONS)
+    assert list(iter_sections(RangeS3(data), "bucket", "key")) == decode_transcript(data)[1]
+
+
+def test_build_sections_splits_pages():
+    sections = build_sections(f"one{PAGE_BREAK}two{PAGE_BREAK}three")
+    assert [(s["kind"], s["title"], s["text"]) for s in sections] == [
+        ("page", "Page 1", "one"), ("page", "Page 2", "two"), ("page", "Page 3", "three")]
+
+
+def test_build_sections_splits_headings():
+    sections = build_sections("intro\n\n# First\n\nbody\n\n## Second\n\nmore")
+    assert [(s["kind"], s["title"]) for s in sections] == [
+        ("preamble", None), ("section", "First"), ("section", "Second")]
+    assert sections[1]["text"] == "# First\n\nbody"
+
+
+def test_build_sections_packs_long_text(monkeypatch):
+    monkeypatch.setattr(transcripts, "SECTION_CHARS", 100)
+    paragraphs = [f"paragraph {i} " + "word " * 10 for i in range(20)]
+    sections = build_sections("\n\n".join(paragraphs))
+    assert len(sections) > 1
+    assert all(s["kind"] == "chunk" for s in sections)
+    assert SECTION_SEPARATOR.join(s["text"] for s in sections) == "\n\n".join(
+        p.strip() for p in paragraphs)
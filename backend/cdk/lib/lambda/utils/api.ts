@@ -67,6 +67,7 @@ export interface Connection {
   SK: string,
   connectionId: string,
   userId: string,
+  ttl?: number,
 }
 
 export interface QueryExpression {
@@ -11,7 +11,7 @@ import { FlashCardModal } from "./FlashCards/FlashCardModal";
 import { Button } from "./ui/button";
 
 export const LessonPageContent = ({ lessonId }: { lessonId: string }) => {
-  const { flashCardsOpen, toggleFlashCardsModal } = useAppStore();
+  const { flashCardsOpen, toggleFlashCardsModal, streamedFlashCards } = useAppStore();
   const { address } = useAccount();
   const { connect, spokenText, isSpeaking } = useWebSocket(address as `0x${string}`, lessonId);
   const [firstSpeak, setFirstSpeak] = useState(false);
@@ -107,7 +107,7 @@ export const LessonPageContent = ({ lessonId }: { lessonId: string }) => {
         isSpeaking={isSpeaking}
       // key={spokenText} // Force re-render when text changes
       />
-      <FlashCardModal isOpen={flashCardsOpen} onClose={() => { toggleFlashCardsModal() }} cards={content?.content.flash_cards ?? []} />
+      <FlashCardModal isOpen={flashCardsOpen} onClose={() => { toggleFlashCardsModal() }} cards={content?.content.flash_cards ?? streamedFlashCards.filter(Boolean)} />
       {/* <AgentBar spokenText={spokenText} /> */}
     </div>
   );
@@ -2,7 +2,7 @@
 
 import { useAppStore } from "@/state/appStore";
 import { Language, useConversation } from '@11labs/react';
-import { useCallback, useRef, useState } from "react";
+import { useCallback, useEffect, useRef, useState } from "react";
 import { toast } from "sonner";
 
 export type Role = "user" | "ai";
@@ -14,8 +14,17 @@ export const useWebSocket = (userId: string, lessonId: string) => {
   const setSocket = useAppStore((s) => s.setSocket);
   const [spokenText, setSpokenText] = useState("");
   const [prevSpokenText, setPrevSpokenText] = useState("");
-  const { toggleFlashCardsModal } = useAppStore();
+  const { toggleFlashCardsModal, setStreamedFlashCard, clearStreamedFlashCards } = useAppStore();
   const isSessionStartedRef = useRef(false);
+  const chunksRef = useRef<Record<string, string[]>>({});
+  // Read by the socket's handlers, which outlive the render that created them
+  const lessonIdRef = useRef(lessonId);
+  lessonIdRef.current = lessonId;
+
+  // Cards streamed for the previous lesson don't belong to this one
+  useEffect(() => {
+    clearStreamedFlashCards();
+  }, [lessonId, clearStreamedFlashCards]);
 
   console.log("useWebSocket initialized with userId:", userId);
 
@@ -64,9 +73,28 @@ export const useWebSocket = (userId: string, lessonId: string) => {
     };
 
     ws.onmessage = async (msg) => {
-      const data = JSON.parse(msg.data);
+      let data = JSON.parse(msg.data);
       console.log("Incoming message:", data);
 
+      if (data.type === "chunk") {
+        // Lessons too large for one frame arrive in sequenced chunks
+        const chunks = (chunksRef.current[data.message_id] ??= []);
+        chunks[data.seq] = data.data;
+        if (chunks.filter((chunk) => chunk !== undefined).length < data.total) {
+          return;
+        }
+        delete chunksRef.current[data.message_id];
+        data = JSON.parse(chunks.join(""));
+        console.log("Reassembled message:", data);
+      }
+
+      // Lesson messages go to every connection the user has open, keep only this lesson's.
+      // Status updates can arrive before the lesson page connects, so the homepage shows them too
+      if (data.type !== "status_update" && data.id !== undefined && data.id !== lessonIdRef.current) {
+        console.log(`Ignoring message for lesson ${data.id}`);
+        return;
+      }
+
       if (data.type === "NOTIFICATION") {
         // Show toast notification for successful payment
         toast.success("Payment Successful!", {
@@ -77,6 +105,18 @@ export const useWebSocket = (userId: string, lessonId: string) => {
             onClick: () => window.open(`https://basescan.org/tx/${data.txHash}`, "_blank"),
           },
         });
+      } else if (data.type === "lesson_update") {
+        // Pieces of the lesson streamed while the rest is still generating
+        if (data.field === "topic") {
+          toast.success("Lesson topic ready", {
+            description: data.value,
+            duration: 8000,
+          });
+        }
+      } else if (data.type === "flash_card") {
+        if (data.id === lessonIdRef.current) {
+          setStreamedFlashCard(data.index, data.card);
+        }
       } else if (data.type === "status_update") {
         toast.success("Processing content...", {
           description: data.message,
@@ -95,7 +135,7 @@ export const useWebSocket = (userId: string, lessonId: string) => {
         //   },
         // });
         // console.log("Session started:", session);
-      } else if (data.topic && !isSessionStartedRef.current) {
+      } else if (data.topic && data.id === lessonIdRef.current && !isSessionStartedRef.current) {
         // Set flag to prevent duplicate sessions
         isSessionStartedRef.current = true;
 
@@ -2,6 +2,7 @@ import { Payload } from "@/app/types/payload";
 import { create } from "zustand";
 
 type ChatMessage = { sender: "user" | "ai"; message: string };
+type FlashCard = { id: string; question: string; answer: string };
 
 type AppState = {
   // Lesson info
@@ -19,6 +20,10 @@ type AppState = {
   //flashcards
   toggleFlashCardsModal: () => void;
   flashCardsOpen: boolean;
+  // Cards pushed over the websocket while the lesson is still generating
+  streamedFlashCards: FlashCard[];
+  setStreamedFlashCard: (index: number, card: FlashCard) => void;
+  clearStreamedFlashCards: () => void;
 
   //payload
   payload: Payload | null;
@@ -40,6 +45,7 @@ export const useAppStore = create<AppState>((set) => ({
   // Initial state
   lessonId: "",
   flashCardsOpen: false,
+  streamedFlashCards: [],
   lessonMeta: null,
   lessonModules: [],
   currentModuleIndex: 0,
@@ -59,6 +65,13 @@ export const useAppStore = create<AppState>((set) => ({
   nextModule: () => set((state) => ({ currentModuleIndex: state.currentModuleIndex + 1 })),
   setTranscript: (text) => set({ transcript: text }),
   toggleFlashCardsModal: () => set((state) => ({ flashCardsOpen: !state.flashCardsOpen })),
+  setStreamedFlashCard: (index, card) =>
+    set((state) => {
+      const streamedFlashCards = [...state.streamedFlashCards];
+      streamedFlashCards[index] = card;
+      return { streamedFlashCards };
+    }),
+  clearStreamedFlashCards: () => set({ streamedFlashCards: [] }),
   pushChat: (message) => set((state) => ({ chatHistory: [...state.chatHistory, message] })),
   resetLesson: () =>
     set({
@@ -66,5 +79,6 @@ export const useAppStore = create<AppState>((set) => ({
       currentModuleIndex: 0,
       chatHistory: [],
       transcript: "",
+      streamedFlashCards: [],
     }),
 }));